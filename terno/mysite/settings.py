@@ -119,6 +119,25 @@ else:
         }
     }
 
+# Shared by all web and celery processes, metadata versions, admission
+# slots, single flight locks and cancel handles live here, so use Redis.
+# The file based cache is shared but not atomic, without either setting
+# every process has its own local memory cache.
+if os.getenv('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_CACHE_URL'),
+        }
+    }
+elif os.getenv('CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('CACHE_DIR'),
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -258,6 +277,71 @@ if not DEBUG:
 
 USER_SQLITE_PATH = os.getenv('USER_SQLITE_PATH')
 
+# Connection pool used for every datasource engine
+DATASOURCE_POOL_SIZE = int(os.getenv('DATASOURCE_POOL_SIZE', 5))
+DATASOURCE_POOL_MAX_OVERFLOW = int(os.getenv('DATASOURCE_POOL_MAX_OVERFLOW', 10))
+DATASOURCE_POOL_TIMEOUT = int(os.getenv('DATASOURCE_POOL_TIMEOUT', 30))
+DATASOURCE_POOL_RECYCLE = int(os.getenv('DATASOURCE_POOL_RECYCLE', 1800))
+DATASOURCE_POOL_PRE_PING = os.getenv('DATASOURCE_POOL_PRE_PING', 'True').lower() == 'true'
+
+# Seconds a user query may run, DataSource.statement_timeout overrides it
+DEFAULT_STATEMENT_TIMEOUT = int(os.getenv('DEFAULT_STATEMENT_TIMEOUT', 300))
+
+DATASOURCE_MAX_CONCURRENT_QUERIES = int(os.getenv('DATASOURCE_MAX_CONCURRENT_QUERIES', 10))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 20))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 30))
+ADMISSION_POLL_INTERVAL = float(os.getenv('ADMISSION_POLL_INTERVAL', 0.1))
+# Slots of crashed processes are freed after this many seconds
+ADMISSION_SLOT_LEASE = int(os.getenv('ADMISSION_SLOT_LEASE', 3600))
+# Queue positions of killed processes are freed after this many seconds
+ADMISSION_WAITER_LEASE = int(os.getenv('ADMISSION_WAITER_LEASE', 10))
+ADMISSION_RETRY_DELAY = int(os.getenv('ADMISSION_RETRY_DELAY', 30))
+
+# Serve get-sql, execute-sql and console with the async views, for ASGI
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False').lower() == 'true'
+ASYNC_BLOCKING_WORKERS = int(os.getenv('ASYNC_BLOCKING_WORKERS', 32))
+
+MDB_CACHE_TIMEOUT = int(os.getenv('MDB_CACHE_TIMEOUT', 3600))
+# Per-process LRU of unpickled MDatabases in front of the shared cache
+MDB_LOCAL_CACHE_SIZE = int(os.getenv('MDB_LOCAL_CACHE_SIZE', 64))
+MDB_LOCAL_CACHE_MAX_BYTES = int(os.getenv('MDB_LOCAL_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Precompute the schema caches of every active role set after
+# load_metadata and, CACHE_WARMING_DELAY seconds later, after ACL changes
+CACHE_WARMING_ENABLED = os.getenv('CACHE_WARMING_ENABLED', 'True').lower() == 'true'
+CACHE_WARMING_WORKERS = int(os.getenv('CACHE_WARMING_WORKERS', 4))
+CACHE_WARMING_DELAY = int(os.getenv('CACHE_WARMING_DELAY', 10))
+# Entries in the per-process LRU of translated native SQL
+NATIVE_SQL_CACHE_SIZE = int(os.getenv('NATIVE_SQL_CACHE_SIZE', 1024))
+
+# Total row count of paginated results, cached per native SQL
+ROW_COUNT_CACHE_TIMEOUT = int(os.getenv('ROW_COUNT_CACHE_TIMEOUT', 3600))
+ROW_COUNT_CONCURRENT = os.getenv('ROW_COUNT_CONCURRENT', 'True').lower() == 'true'
+ROW_COUNT_TIMEOUT = int(os.getenv('ROW_COUNT_TIMEOUT', 30))
+ROW_COUNT_WORKERS = int(os.getenv('ROW_COUNT_WORKERS', 4))
+# Cost estimates of the query cost guard, cached per native SQL
+QUERY_COST_CACHE_TIMEOUT = int(os.getenv('QUERY_COST_CACHE_TIMEOUT', 3600))
+
+# Pages of execute_sql results, cached per native SQL and metadata version
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'True').lower() == 'true'
+RESULT_CACHE_TIMEOUT = int(os.getenv('RESULT_CACHE_TIMEOUT', 300))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 1024 * 1024))
+
+# Identical concurrent execute_sql calls share one execution
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'True').lower() == 'true'
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv('SINGLE_FLIGHT_TIMEOUT', 600))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', 0.1))
+
+# Rows fetched per round trip when streaming CSV exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 5000))
+BIGQUERY_STORAGE_ENABLED = os.getenv('BIGQUERY_STORAGE_ENABLED', 'True').lower() == 'true'
+# Smaller BigQuery results are read through the REST API
+BIGQUERY_STORAGE_MIN_ROWS = int(os.getenv('BIGQUERY_STORAGE_MIN_ROWS', 100000))
+
+# Results of async query jobs are spooled here, the web and celery
+# workers must share this directory.
+QUERY_JOB_SPOOL_DIR = os.getenv('QUERY_JOB_SPOOL_DIR', os.path.join(BASE_DIR, 'query_jobs'))
+QUERY_JOB_TTL = int(os.getenv('QUERY_JOB_TTL', 24 * 3600))
+
 if not DEBUG:
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
     CELERY_RESULT_BACKEND = 'rpc://'
@@ -268,6 +352,12 @@ else:
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+CELERY_BEAT_SCHEDULE = {
+    'delete-expired-query-jobs': {
+        'task': 'terno.tasks.delete_expired_query_jobs',
+        'schedule': int(os.getenv('QUERY_JOB_CLEANUP_INTERVAL', 3600)),
+    },
+}
 
 
 if not DEBUG:
@@ -369,11 +369,7 @@ def generate_table_and_column_description(datasource_id, org_id=None, input_tabl
         Mtables = mDB.get_table_dict()
 
         # 3. Create engine and connect safely using context manager
-        engine = terno_utils.create_db_engine(
-            datasource.type,
-            datasource.connection_str,
-            credentials_info=datasource.connection_json
-        )
+        engine = terno_utils.get_datasource_engine(datasource)
 
         with engine.connect() as conn:
             # 4. Reflect SQLAlchemy metadata inside the connection
@@ -594,12 +590,17 @@ def create_store_vector_DB(datasource_id, table_descriptions=[]):
                 sync=True
             )
         
+        partition = {}
         if settings.MILVUS_SERVER:
             if partition_name not in milvus_client.list_partitions(collection_name):
                 milvus_client.create_partition(collection_name, partition_name)
-            milvus_client.insert(collection_name, table_descriptions, partition_name=partition_name)
-        else:
-            milvus_client.insert(collection_name, table_descriptions)
+            partition = {'partition_name': partition_name}
+        # Replaces the vectors of tables described again
+        table_names = [record['table_name'] for record in table_descriptions]
+        if table_names:
+            milvus_client.delete(collection_name, filter=f"table_name in {json.dumps(table_names)}",
+                                 **partition)
+        milvus_client.insert(collection_name, table_descriptions, **partition)
 
         print(f"Stored {len(table_descriptions)} tables in Milvus DB: {db_name}, Collection: {collection_name}, Partition: {partition_name}")
 
@@ -564,6 +564,19 @@ class QueryHistoryAdmin(OrganisationFilterMixin, admin.ModelAdmin):
     organisation_list_filter_field_names = ['data_source__organisationdatasource__organisation']
 
 
+@admin.register(models.QueryJob)
+class QueryJobAdmin(OrganisationFilterMixin, admin.ModelAdmin):
+    list_display = ['job_id', 'user', 'data_source', 'status', 'row_count', 'created_at', 'finished_at']
+    organisation_related_field_names = ['user__organisationuser__organisation', 'data_source__organisationdatasource__organisation']
+    list_filter = [DataSourceFilter, 'status', 'created_at']
+    search_fields = ['job_id', 'user__username', 'native_sql']
+    organisation_foreignkey_field_names = {
+        'data_source': 'organisationdatasource__organisation',
+        'user': 'organisationuser__organisation'
+    }
+    organisation_list_filter_field_names = ['data_source__organisationdatasource__organisation']
+
+
 @admin.register(models.PromptLog)
 class PromptLogAdmin(OrganisationFilterMixin, admin.ModelAdmin):
     list_display = ['user', 'llm_prompt', 'created_at']
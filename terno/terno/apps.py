@@ -1,4 +1,16 @@
+import logging
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Backends shared by all processes with atomic add and incr
+SHARED_CACHE_BACKENDS = (
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+)
 
 
 class TernoConfig(AppConfig):
@@ -7,3 +19,10 @@ class TernoConfig(AppConfig):
 
     def ready(self):
         from . import receivers
+        backend = settings.CACHES['default']['BACKEND']
+        if backend not in SHARED_CACHE_BACKENDS:
+            logger.warning(
+                f"Cache backend {backend} is not shared between processes or "
+                "not atomic, metadata changes made by celery are not seen by "
+                "the web processes and concurrency limits hold per process "
+                "only. Set REDIS_CACHE_URL.")
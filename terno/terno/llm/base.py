@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 from django.core.exceptions import ObjectDoesNotExist
 from ..models import LLMConfiguration, OrganisationLLM, Organisation
 from django.conf import settings
+from asgiref.sync import sync_to_async
 import terno.utils as utils
 
 
@@ -37,6 +38,13 @@ class BaseLLM(ABC):
     def get_response(self, query) -> dict:
         pass
 
+    async def aget_response(self, query) -> dict:
+        """
+        Async version of get_response. Providers with an async client
+        override it, the others run get_response in a worker thread.
+        """
+        return await sync_to_async(self.get_response, thread_sensitive=False)(query)
+
     @abstractmethod
     def csv_llm_response(self, messages):
         pass
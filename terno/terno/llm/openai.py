@@ -1,5 +1,5 @@
 from .base import BaseLLM
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import json
 
 
@@ -66,26 +66,29 @@ class OpenAILLM(BaseLLM):
         ]
         return messages
 
-    def get_response(self, messages) -> dict:
-        model = self.get_model_instance()
-        model_name = self.model_name
-        if model_name in self.o_series_models:
+    def get_async_model_instance(self):
+        return AsyncOpenAI(
+            api_key=self.api_key,
+        )
+
+    def get_completion_parameters(self, messages):
+        if self.model_name in self.o_series_models:
             messages[0]['role'] = 'developer'
-            response = model.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                **self.custom_parameters
-            )
-        else:
-            response = model.chat.completions.create(
+            return dict(
                 model=self.model_name,
                 messages=messages,
-                temperature=self.temperature,
-                # max_tokens=self.max_tokens,
-                top_p=self.top_p,
                 **self.custom_parameters
             )
+        return dict(
+            model=self.model_name,
+            messages=messages,
+            temperature=self.temperature,
+            # max_tokens=self.max_tokens,
+            top_p=self.top_p,
+            **self.custom_parameters
+        )
 
+    def parse_response(self, response) -> dict:
         return_dict = {}
         generated_sql = response.choices[0].message.content
         return_dict['generated_sql'] = generated_sql.strip().removeprefix("```json").removeprefix("```sql").removeprefix("```").removesuffix("```").strip()
@@ -100,6 +103,18 @@ class OpenAILLM(BaseLLM):
             pass
         return return_dict
 
+    def get_response(self, messages) -> dict:
+        model = self.get_model_instance()
+        response = model.chat.completions.create(
+            **self.get_completion_parameters(messages))
+        return self.parse_response(response)
+
+    async def aget_response(self, messages) -> dict:
+        model = self.get_async_model_instance()
+        response = await model.chat.completions.create(
+            **self.get_completion_parameters(messages))
+        return self.parse_response(response)
+
     def csv_llm_response(self, messages):
         model = self.get_model_instance()
         model_name = self.model_name
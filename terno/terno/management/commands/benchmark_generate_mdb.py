@@ -0,0 +1,51 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from terno.models import DataSource, Table, TableColumn, ForeignKey
+from terno.utils import generate_mdb
+
+
+class Command(BaseCommand):
+    help = 'Benchmark generate_mdb on synthetic datasources. Nothing is saved.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tables', nargs='*', type=int, default=[100, 1000, 10000],
+                            help='Optional: Table counts to benchmark')
+        parser.add_argument('--columns', type=int, default=10,
+                            help='Optional: Columns per table')
+
+    def handle(self, *args, **options):
+        for table_count in options['tables']:
+            with transaction.atomic():
+                datasource = self.create_datasource(table_count, options['columns'])
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    mdb = generate_mdb(datasource)
+                    elapsed = time.perf_counter() - start
+                # Roll back, also skips the load_metadata scheduled on commit
+                transaction.set_rollback(True)
+
+            self.stdout.write(
+                f'{table_count} tables: {len(mdb.tables)} loaded with '
+                f'{len(queries)} queries in {elapsed:.3f}s')
+
+    def create_datasource(self, table_count, column_count):
+        datasource = DataSource.objects.create(
+            display_name='generate_mdb benchmark', type='default',
+            connection_str='sqlite://', enabled=False)
+        tables = Table.objects.bulk_create(
+            [Table(name=f'table_{i}', public_name=f'table_{i}', data_source=datasource)
+             for i in range(table_count)], batch_size=1000)
+        columns = TableColumn.objects.bulk_create(
+            [TableColumn(name=f'column_{j}', public_name=f'column_{j}',
+                         table=table, data_type='INTEGER')
+             for table in tables for j in range(column_count)], batch_size=1000)
+        # Every table refers to the first column of the previous table
+        ForeignKey.objects.bulk_create(
+            [ForeignKey(constrained_table=tables[i],
+                        constrained_columns=columns[i * column_count],
+                        referred_table=tables[i - 1],
+                        referred_columns=columns[(i - 1) * column_count])
+             for i in range(1, table_count)], batch_size=1000)
+        return datasource
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from terno.models import DataSource
+from terno.utils import warm_datasource_caches
+
+
+class Command(BaseCommand):
+    help = 'Precompute the ACL index, MDatabase and schema text of every active role set.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--datasources', nargs='*', type=int,
+                            help='Optional: IDs of the DataSources to warm, all enabled ones by default')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Optional: Role sets warmed at once, CACHE_WARMING_WORKERS by default')
+
+    def handle(self, *args, **options):
+        datasources = DataSource.objects.filter(enabled=True)
+        if options['datasources']:
+            datasources = DataSource.objects.filter(id__in=options['datasources'])
+            missing = set(options['datasources']) - set(datasources.values_list('id', flat=True))
+            if missing:
+                raise CommandError(f'DataSources with IDs {sorted(missing)} do not exist.')
+
+        failed = 0
+        for datasource in datasources:
+            def progress(done, total, role_ids, error):
+                status = 'failed' if error is not None else 'warmed'
+                self.stdout.write(f'  [{done}/{total}] roles {list(role_ids)} {status}')
+
+            self.stdout.write(f'Warming DataSource {datasource.id} ({datasource.display_name})')
+            report = warm_datasource_caches(
+                datasource, workers=options['workers'], progress=progress)
+            failed += report['failed']
+            self.stdout.write(
+                f"Warmed {report['warmed']} of {report['role_sets']} role sets "
+                f"in {report['elapsed']:.2f}s")
+
+        if failed:
+            raise CommandError(f'{failed} role sets could not be warmed.')
+        self.stdout.write(self.style.SUCCESS('Caches warmed.'))
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 08:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0050_queryjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='statement_timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum seconds a query may run, 0 disables the timeout. Leave blank for the default.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='queryhistory',
+            name='data_type',
+            field=models.CharField(choices=[('user_prompt', 'User Prompt'), ('generated_sql', 'Generated SQL'), ('user_executed_sql', 'User Executed SQL'), ('actual_executed_sql', 'Actual Executed SQL'), ('timed_out_sql', 'Timed Out SQL'), ('cancelled_sql', 'Cancelled SQL')], help_text='Select the type of data you want to save', max_length=64),
+        ),
+    ]
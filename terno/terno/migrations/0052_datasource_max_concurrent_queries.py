@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 08:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0051_datasource_statement_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='max_concurrent_queries',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum queries running on this datasource at the same time, 0 disables the limit. Leave blank for the default.', null=True),
+        ),
+    ]
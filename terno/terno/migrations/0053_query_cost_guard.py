@@ -0,0 +1,38 @@
+# Generated by Django 5.1.1 on 2026-10-18 08:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0052_datasource_max_concurrent_queries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organisation',
+            name='cost_guard_action',
+            field=models.CharField(choices=[('confirm', 'Ask the user to confirm'), ('reject', 'Reject the query')], default='confirm', help_text='What to do with queries estimated over the limits.', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='organisation',
+            name='max_bytes_processed',
+            field=models.BigIntegerField(blank=True, help_text='Estimated bytes a query may scan (BigQuery dry run). Leave blank for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='organisation',
+            name='max_estimated_rows',
+            field=models.BigIntegerField(blank=True, help_text='Estimated rows a query may examine (EXPLAIN). Leave blank for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='queryhistory',
+            name='cost_estimate',
+            field=models.JSONField(blank=True, help_text='Estimated cost of the SQL before it was executed', null=True),
+        ),
+        migrations.AlterField(
+            model_name='queryhistory',
+            name='data_type',
+            field=models.CharField(choices=[('user_prompt', 'User Prompt'), ('generated_sql', 'Generated SQL'), ('user_executed_sql', 'User Executed SQL'), ('actual_executed_sql', 'Actual Executed SQL'), ('timed_out_sql', 'Timed Out SQL'), ('cancelled_sql', 'Cancelled SQL'), ('rejected_sql', 'Rejected SQL')], help_text='Select the type of data you want to save', max_length=64),
+        ),
+    ]
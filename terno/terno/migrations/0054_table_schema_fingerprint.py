@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 08:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0053_query_cost_guard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='schema_fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the reflected columns and foreign keys, the table is reflected again when it changes.', max_length=64, null=True),
+        ),
+    ]
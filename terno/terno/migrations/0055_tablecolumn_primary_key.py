@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 09:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0054_table_schema_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tablecolumn',
+            name='primary_key',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
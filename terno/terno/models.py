@@ -2,6 +2,7 @@ from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import User, Group
 import json
+import uuid
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import Permission
 from subscription.models import LLMCredit
@@ -114,6 +115,14 @@ class DataSource(models.Model):
     dialect_version = models.CharField(max_length=20, default='',
                                        null=True, blank=True)
     enabled = models.BooleanField(default=True)
+    statement_timeout = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Maximum seconds a query may run, 0 disables the timeout. "
+                  "Leave blank for the default.")
+    max_concurrent_queries = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Maximum queries running on this datasource at the same time, "
+                  "0 disables the limit. Leave blank for the default.")
 
     def __str__(self):
         return self.display_name
@@ -129,6 +138,9 @@ class Table(models.Model):
     category = models.CharField(max_length=255, null=True, blank=True)
     sample_rows = models.JSONField(null=True, blank=True)
     description_updated_at = models.DateTimeField(blank=True, null=True)
+    schema_fingerprint = models.CharField(
+        max_length=64, null=True, blank=True, editable=False,
+        help_text="Hash of the reflected columns and foreign keys, the table is reflected again when it changes.")
 
     def __str__(self):
         return f"{self.data_source.display_name} - {self.name}"
@@ -140,6 +152,7 @@ class TableColumn(models.Model):
     public_name = models.CharField(max_length=255, null=True, blank=True)
     table = models.ForeignKey(Table, on_delete=models.CASCADE)
     data_type = models.CharField(max_length=50, blank=True)
+    primary_key = models.BooleanField(default=False, editable=False)
     description = models.CharField(max_length=300, null=True, blank=True)
     unique_categories = models.JSONField(default=dict, null=True, blank=True)
 
@@ -227,6 +240,21 @@ class Organisation(models.Model):
     logo = models.URLField(null=True, blank=True)
     is_active = models.BooleanField(default=False)
     llm_credit = models.ForeignKey(LLMCredit, null=True, blank=True, on_delete=models.SET_NULL)
+    COST_GUARD_ACTIONS = [
+        ('confirm', 'Ask the user to confirm'),
+        ('reject', 'Reject the query'),
+    ]
+    max_bytes_processed = models.BigIntegerField(
+        null=True, blank=True,
+        help_text="Estimated bytes a query may scan (BigQuery dry run). "
+                  "Leave blank for no limit.")
+    max_estimated_rows = models.BigIntegerField(
+        null=True, blank=True,
+        help_text="Estimated rows a query may examine (EXPLAIN). "
+                  "Leave blank for no limit.")
+    cost_guard_action = models.CharField(
+        max_length=16, choices=COST_GUARD_ACTIONS, default='confirm',
+        help_text="What to do with queries estimated over the limits.")
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
     updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
 
@@ -288,7 +316,10 @@ class QueryHistory(models.Model):
         ('user_prompt', 'User Prompt'),
         ('generated_sql', 'Generated SQL'),
         ('user_executed_sql', 'User Executed SQL'),
-        ('actual_executed_sql', 'Actual Executed SQL')
+        ('actual_executed_sql', 'Actual Executed SQL'),
+        ('timed_out_sql', 'Timed Out SQL'),
+        ('cancelled_sql', 'Cancelled SQL'),
+        ('rejected_sql', 'Rejected SQL')
     ]
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -297,8 +328,39 @@ class QueryHistory(models.Model):
         max_length=64, choices=DATA_TYPES,
         help_text="Select the type of data you want to save")
     data = models.TextField(blank=True, null=True)
+    cost_estimate = models.JSONField(
+        null=True, blank=True,
+        help_text="Estimated cost of the SQL before it was executed")
+    created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
+
+
+class QueryJob(models.Model):
+    """Query executed in the background with its result spooled to disk."""
+    STATUSES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('success', 'Success'),
+        ('error', 'Error'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    data_source = models.ForeignKey(DataSource, on_delete=models.CASCADE)
+    native_sql = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUSES, default='queued')
+    task_id = models.CharField(max_length=255, blank=True, default='')
+    columns = models.JSONField(null=True, blank=True)
+    row_count = models.BigIntegerField(null=True, blank=True)
+    result_path = models.CharField(max_length=1024, blank=True, default='')
+    error = models.TextField(blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
     updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.job_id} - {self.status}"
 
 
 class PromptLog(models.Model):
@@ -31,3 +31,18 @@ class Pipeline(AbstractPipeline):
 
         except Exception as e:
             logger.warning(e)
+
+    async def arun(self):
+        try:
+            result = []
+            for step in self._steps:
+                start_time = time.time()
+
+                step_result = await step.aexecute()
+
+                execution_time = time.time() - start_time
+                result.append([step_result, execution_time])
+            return result
+
+        except Exception as e:
+            logger.warning(e)
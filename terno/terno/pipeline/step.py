@@ -5,3 +5,6 @@ class Step():
 
     def execute(self):
         return self.llm.get_response(self.messages)
+
+    async def aexecute(self):
+        return await self.llm.aget_response(self.messages)
@@ -2,15 +2,16 @@ import logging
 import traceback
 from terno.models import DataSource, Table, TableColumn, ForeignKey
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed
 import sqlalchemy
 import terno.utils as utils
 from sqlshield.models import MDatabase
 import terno.models as models
-from django.core.cache import cache
 from django.contrib.auth.models import User
-from .tasks import load_metadata
+from .tasks import load_metadata, warm_caches
 from django.db import transaction
+from django.conf import settings
+from django.core.cache import cache
 from suggestions.utils import drop_vector_DB
 
 logger = logging.getLogger(__name__)
@@ -29,18 +30,15 @@ def update_tables_on_datasource_change(sender, instance, created, **kwargs):
     #         Table.objects.create(name=table_name, data_source=instance)
 
 
-def delete_cache(datasource):
-    org_data_source = models.OrganisationDataSource.objects.filter(
-        datasource=datasource).first()
-    org_users = models.OrganisationUser.objects.filter(organisation=org_data_source.organisation)
-    cache_key_set = set()
-    for org_user in org_users:
-        roles = org_user.user.groups.all()
-        role_ids = sorted(roles.values_list('id', flat=True))
-        cache_key = f"datasource_{datasource.id}_roles_{'_'.join(map(str, role_ids))}"
-        cache_key_set.add(cache_key)
-    for cache_key in cache_key_set:
-        cache.delete(cache_key)
+@receiver(post_save, sender=DataSource)
+@receiver(post_delete, sender=DataSource)
+def dispose_engine_on_datasource_change(sender, instance, **kwargs):
+    """Drops the pooled engine so that it is rebuilt with the new settings."""
+    utils.dispose_datasource_engine(instance.id)
+
+
+ACL_SELECTORS = [models.PrivateTableSelector, models.GroupTableSelector,
+                 models.PrivateColumnSelector, models.GroupColumnSelector]
 
 
 @receiver(post_save, sender=models.TableRowFilter)
@@ -63,21 +61,158 @@ def delete_cache_for_datasource(sender, instance, created, **kwargs):
     if sender is models.PrivateTableSelector:
         data_sources.add(instance.data_source)
     if sender is models.GroupTableSelector:
-        for table in instance.tables.all():
-            data_sources.add(table.data_source)
+        data_sources.update(DataSource.objects.filter(
+            table__in=instance.tables.all()).distinct())
     if sender is models.PrivateColumnSelector:
         data_sources.add(instance.data_source)
     if sender is models.GroupColumnSelector:
-        for column in instance.columns.all():
-            data_sources.add(column.table.data_source)
+        data_sources.update(DataSource.objects.filter(
+            table__tablecolumn__in=instance.columns.all()).distinct())
     if sender is models.GroupTableRowFilter:
         data_sources.add(instance.data_source)
     if sender is models.TableRowFilter:
         data_sources.add(instance.data_source)
 
+    datasource_ids = {data_source.id for data_source in data_sources}
+    # Moved to another datasource or group, the previous one changes too
+    previous_datasource_id, previous_group_id = getattr(instance, '_acl_previous', (None, None))
+    if previous_datasource_id is not None:
+        datasource_ids.add(previous_datasource_id)
+
     if not (sender in [models.Table, models.TableColumn, models.ForeignKey] and created):
-        for data_source in data_sources:
-            delete_cache(data_source)
+        # Cache keys contain the metadata version, the old entries expire
+        for datasource_id in datasource_ids:
+            utils.bump_metadata_version(DataSource(id=datasource_id))
+        _schedule_cache_warming(datasource_ids)
+
+    if sender in ACL_SELECTORS:
+        _refresh_acl_index(instance, datasource_ids)
+        if previous_group_id is not None:
+            for datasource_id in datasource_ids:
+                utils.refresh_acl_index(datasource_id, previous_group_id)
+
+
+@receiver(pre_save, sender=models.TableRowFilter)
+@receiver(pre_save, sender=models.GroupTableRowFilter)
+@receiver(pre_save, sender=models.GroupColumnSelector)
+@receiver(pre_save, sender=models.PrivateColumnSelector)
+@receiver(pre_save, sender=models.GroupTableSelector)
+@receiver(pre_save, sender=models.PrivateTableSelector)
+def remember_previous_acl_owner(sender, instance, **kwargs):
+    """
+    Keeps the datasource and group the instance had before the save, so
+    that the ACL of both the old and the new ones is refreshed when it is
+    moved.
+    """
+    instance._acl_previous = (None, None)
+    if instance.pk is None:
+        return
+    field_names = [name for name in ('data_source_id', 'group_id') if hasattr(instance, name)]
+    previous = sender.objects.filter(pk=instance.pk).values(*field_names).first()
+    if previous is None:
+        return
+    instance._acl_previous = tuple(
+        previous[name] if name in previous and previous[name] != getattr(instance, name) else None
+        for name in ('data_source_id', 'group_id'))
+
+
+def _schedule_cache_warming(datasource_ids):
+    if not settings.CACHE_WARMING_ENABLED:
+        return
+    for datasource_id in datasource_ids:
+        # A burst of changes is warmed once, after the delay
+        if cache.add(utils.get_cache_warming_cache_key(datasource_id), True,
+                     timeout=settings.CACHE_WARMING_DELAY):
+            transaction.on_commit(lambda datasource_id=datasource_id: warm_caches.apply_async(
+                (datasource_id,), countdown=settings.CACHE_WARMING_DELAY))
+
+
+def _selector_datasource_ids(instance):
+    if isinstance(instance, (models.PrivateTableSelector, models.PrivateColumnSelector)):
+        return {instance.data_source_id}
+    if isinstance(instance, models.GroupTableSelector):
+        return set(instance.tables.values_list('data_source_id', flat=True))
+    return set(instance.columns.values_list('table__data_source_id', flat=True))
+
+
+def _refresh_acl_index(selector, datasource_ids):
+    # Group selectors have a part per group, private selectors share one
+    group_id = getattr(selector, 'group_id', None)
+    for datasource_id in datasource_ids:
+        utils.refresh_acl_index(datasource_id, group_id)
+
+
+@receiver(pre_delete, sender=models.GroupColumnSelector)
+@receiver(pre_delete, sender=models.PrivateColumnSelector)
+@receiver(pre_delete, sender=models.GroupTableSelector)
+@receiver(pre_delete, sender=models.PrivateTableSelector)
+def remember_selector_datasources(sender, instance, **kwargs):
+    # The selections are deleted with the selector, without m2m_changed
+    instance._acl_datasource_ids = _selector_datasource_ids(instance)
+
+
+@receiver(post_delete, sender=models.GroupColumnSelector)
+@receiver(post_delete, sender=models.PrivateColumnSelector)
+@receiver(post_delete, sender=models.GroupTableSelector)
+@receiver(post_delete, sender=models.PrivateTableSelector)
+def update_acl_index_on_selector_delete(sender, instance, **kwargs):
+    datasource_ids = getattr(instance, '_acl_datasource_ids', set())
+    for datasource_id in datasource_ids:
+        utils.bump_metadata_version(DataSource(id=datasource_id))
+    _refresh_acl_index(instance, datasource_ids)
+    _schedule_cache_warming(datasource_ids)
+
+
+@receiver(m2m_changed, sender=models.GroupColumnSelector.columns.through)
+@receiver(m2m_changed, sender=models.PrivateColumnSelector.columns.through)
+@receiver(m2m_changed, sender=models.GroupTableSelector.tables.through)
+@receiver(m2m_changed, sender=models.PrivateTableSelector.tables.through)
+def update_acl_index_on_selection_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Selections are saved after the selector, so post_save of the selector
+    does not see them. Refreshes the ACL index parts and the metadata
+    version of the datasources whose tables or columns were (de)selected.
+    """
+    if reverse:
+        # instance is the table or column, pk_set holds selector ids
+        if isinstance(instance, Table):
+            datasource_ids = {instance.data_source_id}
+        else:
+            datasource_ids = {instance.table.data_source_id}
+        if action == 'pre_clear':
+            field_name = 'tables' if isinstance(instance, Table) else 'columns'
+            instance._acl_selectors = list(model.objects.filter(**{field_name: instance}))
+            return
+        if action == 'post_clear':
+            selectors = getattr(instance, '_acl_selectors', [])
+        elif action in ('post_add', 'post_remove'):
+            selectors = model.objects.filter(id__in=pk_set)
+        else:
+            return
+    else:
+        if action == 'pre_clear':
+            instance._acl_datasource_ids = _selector_datasource_ids(instance)
+            return
+        if action == 'post_clear':
+            datasource_ids = getattr(instance, '_acl_datasource_ids', set())
+        elif action in ('post_add', 'post_remove'):
+            # Removed selections are no longer found through the selector
+            if model is Table:
+                datasource_ids = set(Table.objects.filter(
+                    id__in=pk_set).values_list('data_source_id', flat=True))
+            else:
+                datasource_ids = set(TableColumn.objects.filter(
+                    id__in=pk_set).values_list('table__data_source_id', flat=True))
+        else:
+            return
+        selectors = [instance]
+
+    # Parts are kept per metadata version, bump it before refreshing them
+    for datasource_id in datasource_ids:
+        utils.bump_metadata_version(DataSource(id=datasource_id))
+    for selector in selectors:
+        _refresh_acl_index(selector, datasource_ids)
+    _schedule_cache_warming(datasource_ids)
 
 
 @receiver(post_save, sender=User)
@@ -94,4 +229,9 @@ def delete_vector_DB_for_datasource(sender, instance, **kwargs):
     clean up vector DB when a DataSource is deleted.
     """
     print(f"[post_delete] DataSource deleted: {instance.display_name}")
-    drop_vector_DB(instance)
\ No newline at end of file
+    drop_vector_DB(instance)
+
+
+@receiver(post_delete, sender=models.QueryJob)
+def delete_query_job_result(sender, instance, **kwargs):
+    utils.delete_spooled_result(instance.result_path)
@@ -1,9 +1,17 @@
 from celery import shared_task
-from terno.models import DataSource, Table, TableColumn, ForeignKey
+from terno.models import DataSource, Table, QueryJob, QueryHistory
 import terno.utils as utils
 from suggestions.utils import is_ERP
+from suggestions.tasks import generate_table_and_column_descriptions_task
 import sqlalchemy
 from sqlshield.models import MDatabase
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
@@ -12,72 +20,126 @@ def add_num(x, y):
     return x + y
 
 
-# TODO: delete the extra tables and columns
 @shared_task
-def load_metadata(datasource_id):
+def load_metadata(datasource_id, full=False):
+    """
+    Reflects the tables whose schema fingerprint changed since the last
+    run, or every table when full is set, and syncs them into the models.
+    Descriptions are generated again for the changed tables only.
+    """
     datasource = DataSource.objects.get(id=datasource_id)
-    engine = utils.create_db_engine(datasource.type, datasource.connection_str,
-                                    credentials_info=datasource.connection_json)
+    engine = utils.get_datasource_engine(datasource)
     if not datasource.dialect_name or not datasource.dialect_version:
         with engine.connect():
             datasource.dialect_name = engine.dialect.name
             datasource.dialect_version = str(engine.dialect.server_version_info)
             datasource.save(update_fields=['dialect_name', 'dialect_version'])
 
+    fingerprints = utils.get_table_fingerprints(engine)
+    if full:
+        reflect_tables = list(fingerprints)
+    else:
+        stored_fingerprints = dict(Table.objects.filter(
+            data_source=datasource).values_list('name', 'schema_fingerprint'))
+        reflect_tables = [name for name, fingerprint in fingerprints.items()
+                          if stored_fingerprints.get(name) != fingerprint]
+
     metadata = sqlalchemy.MetaData()
-    metadata.reflect(bind=engine)
+    if reflect_tables:
+        # Tables referred to by foreign keys are reflected with them
+        metadata.reflect(bind=engine, only=reflect_tables)
 
     mdb = MDatabase.from_inspector(metadata)
 
-    for tbl_name, tbl in mdb.tables.items():
-        existing_tables = Table.objects.filter(
-            name=tbl_name, data_source=datasource)
-        if existing_tables:
-            mtable = existing_tables.first()
-        else:
-            mtable = Table.objects.create(
-                name=tbl_name, public_name=tbl_name,
-                data_source=datasource)
-
-        current_tabcols = []
-        for col_name, col in tbl.columns.items():
-            dbcol = TableColumn.objects.filter(
-                name=col_name, table=mtable)
-            if not dbcol:
-                TableColumn.objects.create(
-                    name=col_name, public_name=col_name,
-                    table=mtable, data_type=str(col.type))
-            current_tabcols.append(col)
-
-    for tbl_name, tbl in mdb.tables.items():
-        foreign_keys = tbl.Foreign_Keys
-        table = Table.objects.filter(
-            name=tbl_name, data_source=datasource
-        ).first()
-        for fk in foreign_keys:
-            constrained_columns = TableColumn.objects.filter(
-                name=fk.constrained_columns[0].name,
-                table__data_source=datasource).first()
-            referred_table = Table.objects.filter(
-                name=fk.referred_table.name, data_source=datasource).first()
-            referred_columns = TableColumn.objects.filter(
-                name=fk.referred_columns[0].name,
-                table__data_source=datasource).first()
-            dbfk = ForeignKey.objects.filter(
-                constrained_table=table,
-                constrained_columns=constrained_columns,
-                referred_table=referred_table,
-                referred_columns=referred_columns
-            )
-            if not dbfk:
-                ForeignKey.objects.create(
-                    constrained_table=table,
-                    constrained_columns=constrained_columns,
-                    referred_table=referred_table,
-                    referred_columns=referred_columns
-                )
-
-    # print("Finished building the tables!!")
-    print("Finished building the tables!!\nChecking for is it a ERP or not.")
-    
-    is_ERP(datasource_id)
\ No newline at end of file
+    report = utils.sync_datasource_metadata(
+        datasource, mdb, table_names=set(fingerprints), fingerprints=fingerprints)
+    report['reflected_tables'] = len(mdb.tables)
+    logger.info(f"Loaded metadata of datasource {datasource_id}: {report}")
+
+    changed_tables = report['changed_tables']
+    if not changed_tables and not report['tables']['deleted']:
+        # Nothing to invalidate, warm or classify again
+        return report
+
+    utils.bump_metadata_version(datasource)
+    if settings.CACHE_WARMING_ENABLED:
+        warm_caches.delay(datasource_id)
+
+    # Descriptions are only kept up to date once they have been generated
+    described_tables = Table.objects.filter(data_source=datasource, complete_description=True)
+    if changed_tables and described_tables.exists():
+        described_tables.filter(name__in=changed_tables).update(complete_description=False)
+        generate_table_and_column_descriptions_task.delay(
+            datasource_id=datasource_id, input_table_names=changed_tables)
+
+    if report['tables']['added'] or report['tables']['deleted']:
+        # Column changes of known tables do not make it an ERP or not
+        print("Finished building the tables!!\nChecking for is it a ERP or not.")
+        is_ERP(datasource_id)
+    return report
+
+
+@shared_task
+def warm_caches(datasource_id):
+    # Changes made from here on schedule another run
+    cache.delete(utils.get_cache_warming_cache_key(datasource_id))
+    datasource = DataSource.objects.filter(id=datasource_id).first()
+    if datasource is None:
+        return
+    return utils.warm_datasource_caches(datasource)
+
+
+@shared_task
+def run_query_job(job_id):
+    job = QueryJob.objects.select_related('data_source').get(job_id=job_id)
+    if job.status != 'queued':
+        return
+    job.status = 'running'
+    job.save(update_fields=['status', 'updated_at'])
+
+    def is_cancelled():
+        return QueryJob.objects.filter(job_id=job_id, status='cancelled').exists()
+
+    path = utils.get_query_job_path(job.job_id)
+    try:
+        result = utils.spool_native_sql_result(
+            job.data_source, job.native_sql, path, should_stop=is_cancelled,
+            request_id=str(job.job_id), user_id=job.user_id)
+    except utils.StatementCancelledException:
+        logger.info(f"Query job {job_id} cancelled")
+        return
+    except utils.DatasourceBusyException:
+        # Put the job back in the queue and try again later
+        updated = QueryJob.objects.filter(job_id=job_id, status='running').update(
+            status='queued')
+        if updated:
+            task = run_query_job.apply_async(
+                (job_id,), countdown=settings.ADMISSION_RETRY_DELAY)
+            QueryJob.objects.filter(job_id=job_id).update(task_id=task.id or '')
+        return
+    except Exception as e:
+        if isinstance(e, utils.StatementTimeoutException):
+            QueryHistory.objects.create(
+                user_id=job.user_id, data_source=job.data_source,
+                data_type='timed_out_sql', data=job.native_sql)
+        logger.exception(e)
+        QueryJob.objects.filter(job_id=job_id).exclude(status='cancelled').update(
+            status='error', error=str(e), finished_at=timezone.now())
+        return
+
+    if result is None:
+        logger.info(f"Query job {job_id} cancelled")
+        return
+    columns, row_count = result
+    updated = QueryJob.objects.filter(job_id=job_id).exclude(status='cancelled').update(
+        status='success', columns=columns, row_count=row_count,
+        result_path=path, finished_at=timezone.now())
+    if not updated:
+        utils.delete_spooled_result(path)
+
+
+@shared_task
+def delete_expired_query_jobs():
+    expiry = timezone.now() - datetime.timedelta(seconds=settings.QUERY_JOB_TTL)
+    for job in QueryJob.objects.filter(created_at__lt=expiry):
+        job.delete()
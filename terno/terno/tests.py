@@ -1,20 +1,38 @@
 import os
+import time
+import threading
+import json
+import datetime
+from decimal import Decimal
+import shutil
+import tempfile
 from unittest import mock
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from unittest.mock import patch, MagicMock
 from django.contrib.auth.models import User, Group
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from asgiref.sync import async_to_sync
+import pyarrow as pa
 import terno.models as models
 import terno.utils as utils
+import terno.views as views
 import terno.llm as llms
 from terno.pipeline.pipeline import Pipeline
 from terno.pipeline.step import Step
+from terno.tasks import load_metadata, run_query_job
+from sqlshield.models import MDatabase
 import csv
+import gzip
 from subscription.models import LLMCredit
 from terno.models import Organisation, OrganisationUser, OrganisationDataSource
 import io
 import sqlite3
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float, inspect
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float, inspect, text
 from io import BytesIO
 
 
@@ -30,11 +48,15 @@ class BaseTestCase(TestCase):
         return connection_str
 
     def create_datasource(self, display_name='test_db'):
-        datasource = models.DataSource.objects.create(
-            display_name=display_name, type='default',
-            connection_str=self.db_path(),
-            enabled=True,
-        )
+        # load_metadata is scheduled on commit, run it inline for tests
+        with patch('terno.receivers.load_metadata.delay', side_effect=load_metadata), \
+                patch('terno.tasks.is_ERP'), patch('terno.tasks.warm_caches.delay'), \
+                self.captureOnCommitCallbacks(execute=True):
+            datasource = models.DataSource.objects.create(
+                display_name=display_name, type='default',
+                connection_str=self.db_path(),
+                enabled=True,
+            )
         return datasource
 
     def create_organisationdatasource(self, datasource, organisation):
@@ -175,6 +197,39 @@ class DBEngineTestCase(TestCase):
         mock_create_engine.assert_not_called()
 
 
+class EngineRegistryTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.datasource = super().create_datasource()
+        utils.dispose_datasource_engine(self.datasource.id)
+
+    def test_engine_is_reused(self):
+        engine = utils.get_datasource_engine(self.datasource)
+        self.assertIs(utils.get_datasource_engine(self.datasource), engine)
+        self.assertEqual(engine.pool.size(), settings.DATASOURCE_POOL_SIZE)
+
+    def test_engine_is_dropped_on_datasource_save(self):
+        engine = utils.get_datasource_engine(self.datasource)
+        self.datasource.description = 'changed'
+        self.datasource.save()
+        self.assertIsNot(utils.get_datasource_engine(self.datasource), engine)
+
+    def test_engine_is_recreated_on_connection_change(self):
+        engine = utils.get_datasource_engine(self.datasource)
+        self.datasource.connection_str = self.datasource.connection_str + '?mode=ro'
+        self.assertIsNot(utils.get_datasource_engine(self.datasource), engine)
+
+    def test_pool_metrics(self):
+        with utils.datasource_connection(self.datasource):
+            metrics = utils.get_engine_pool_metrics()[self.datasource.id]
+            self.assertEqual(metrics['checked_out'], 1)
+        with utils.datasource_connection(self.datasource):
+            pass
+        metrics = utils.get_engine_pool_metrics()[self.datasource.id]
+        self.assertEqual(metrics['connects'], 1)
+        self.assertEqual(metrics['checkouts'], 2)
+        self.assertEqual(metrics['waits'], 2)
+
+
 class DataSourceTestCase(BaseTestCase):
     def setUp(self) -> None:
         self.datasource = super().create_datasource()
@@ -361,14 +416,1351 @@ class GenerateExecuteNativeSQLTestCase(BaseTestCase):
         result = utils.execute_native_sql(datasource, native_sql, 1, 25)
 
         self.assertListEqual(list(result['table_data'].keys()),
-                             ['columns', 'total_pages', 'row_count', 'page', 'data'])
+                             ['columns', 'total_pages', 'row_count',
+                              'row_count_status', 'page', 'data'])
         self.assertEqual(result['table_data']['columns'],
                          ['AlbumId', 'Title', 'ArtistId'])
-        self.assertEqual(result['table_data']['total_pages'], 13)
+        self.assertEqual(result['table_data']['total_pages'], 14)
+        self.assertEqual(result['table_data']['row_count_status'], 'exact')
         self.assertEqual(result['table_data']['row_count'], 347)
         self.assertEqual(result['table_data']['page'], 1)
 
 
+class PaginateNativeSQLTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.datasource = super().create_datasource()
+
+    def test_paginate_native_sql_limit_offset(self):
+        response = utils.paginate_native_sql(
+            'SELECT AlbumId, Title FROM Album', 'sqlite', 3, 25)
+        self.assertEqual(response['page_sql'],
+                         'SELECT AlbumId, Title FROM Album LIMIT 25 OFFSET 50')
+        self.assertEqual(response['count_sql'],
+                         'SELECT COUNT(*) FROM (SELECT AlbumId, Title FROM Album) AS terno_count')
+        self.assertIsNone(response['order_key'])
+
+    def test_paginate_native_sql_existing_limit(self):
+        response = utils.paginate_native_sql(
+            'SELECT AlbumId FROM Album LIMIT 60 OFFSET 5', 'sqlite', 3, 25)
+        self.assertEqual(response['page_sql'],
+                         'SELECT AlbumId FROM Album LIMIT 10 OFFSET 55')
+
+    def test_paginate_native_sql_dialect(self):
+        response = utils.paginate_native_sql(
+            'SELECT AlbumId FROM Album ORDER BY AlbumId', 'tsql', 2, 25)
+        self.assertEqual(response['page_sql'],
+                         'SELECT AlbumId FROM Album ORDER BY AlbumId '
+                         'OFFSET 25 ROWS FETCH FIRST 25 ROWS ONLY')
+
+    def test_paginate_native_sql_keyset(self):
+        response = utils.paginate_native_sql(
+            'SELECT AlbumId, Title FROM Album ORDER BY AlbumId DESC',
+            'sqlite', 2, 25, cursor=100, unique_keys={'Album': 'AlbumId'})
+        self.assertEqual(response['order_key'], ('AlbumId', True))
+        self.assertEqual(response['page_sql'],
+                         'SELECT * FROM (SELECT AlbumId, Title FROM Album) AS terno_page '
+                         'WHERE "AlbumId" < 100 ORDER BY "AlbumId" DESC LIMIT 25')
+
+    def test_paginate_native_sql_keyset_through_subqueries(self):
+        response = utils.paginate_native_sql(
+            'SELECT "a"."AlbumId" AS "id" FROM (SELECT "AlbumId" AS "AlbumId", '
+            '"Title" AS "Title" FROM "Album") AS "a" ORDER BY "id"',
+            'sqlite', 2, 25, cursor=25, unique_keys={'Album': 'AlbumId'})
+        self.assertEqual(response['order_key'], ('id', False))
+
+    def test_paginate_native_sql_non_unique_key_uses_offset(self):
+        unique_keys = {'Album': 'AlbumId', 'Track': 'TrackId'}
+        for native_sql in ['SELECT ArtistId FROM Album ORDER BY ArtistId',
+                           'SELECT AlbumId FROM Track ORDER BY AlbumId',
+                           'SELECT Album.AlbumId FROM Album JOIN Track '
+                           'ON Album.AlbumId = Track.AlbumId ORDER BY AlbumId']:
+            response = utils.paginate_native_sql(
+                native_sql, 'sqlite', 2, 25, cursor=25, unique_keys=unique_keys)
+            self.assertIsNone(response['order_key'])
+            self.assertTrue(response['page_sql'].endswith('LIMIT 25 OFFSET 25'))
+
+    def test_execute_native_sql_fetches_one_page(self):
+        native_sql = 'SELECT AlbumId, Title FROM Album ORDER BY AlbumId'
+        result = utils.execute_native_sql(self.datasource, native_sql, 2, 25)
+        table_data = result['table_data']
+        self.assertEqual(table_data['row_count'], 347)
+        self.assertEqual(len(table_data['data']), 25)
+        self.assertEqual(table_data['data'][0]['AlbumId'], 26)
+        self.assertEqual(table_data['next_cursor'], 50)
+
+        result = utils.execute_native_sql(self.datasource, native_sql, 3, 25,
+                                          cursor=table_data['next_cursor'])
+        self.assertEqual(result['table_data']['data'][0]['AlbumId'], 51)
+
+    def test_execute_native_sql_non_unique_key_has_no_cursor(self):
+        native_sql = 'SELECT AlbumId, ArtistId FROM Album ORDER BY ArtistId'
+        result = utils.execute_native_sql(self.datasource, native_sql, 1, 25)
+        self.assertNotIn('next_cursor', result['table_data'])
+
+
+class RowCountTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.datasource = super().create_datasource()
+        self.native_sql = 'SELECT AlbumId, Title FROM Album'
+
+    def test_row_count_is_cached(self):
+        result = utils.execute_native_sql(self.datasource, self.native_sql, 1, 25)
+        self.assertEqual(result['table_data']['row_count'], 347)
+
+        with patch('terno.utils.count_native_sql_rows') as mock_count:
+            result = utils.execute_native_sql(self.datasource, self.native_sql, 2, 25)
+            mock_count.assert_not_called()
+        self.assertEqual(result['table_data']['row_count'], 347)
+        self.assertEqual(result['table_data']['total_pages'], 14)
+        self.assertEqual(result['table_data']['row_count_status'], 'exact')
+
+    @patch.object(settings, 'ROW_COUNT_CONCURRENT', False)
+    def test_row_count_sequential(self):
+        result = utils.execute_native_sql(self.datasource, self.native_sql, 1, 25)
+        self.assertEqual(result['table_data']['row_count'], 347)
+
+    def test_row_count_waits_for_a_slot(self):
+        # The page holds the only slot, the count runs after it
+        utils._admission_metrics.clear()
+        self.datasource.max_concurrent_queries = 1
+        result = utils.execute_native_sql(self.datasource, self.native_sql, 1, 25)
+        self.assertEqual(result['table_data']['row_count'], 347)
+        self.assertEqual(result['table_data']['row_count_status'], 'exact')
+        self.assertEqual(utils.get_admission_metrics()[self.datasource.id]['timed_out'], 0)
+
+    def test_orphaned_row_count_is_cancelled(self):
+        release = threading.Event()
+        calls = []
+
+        def count_native_sql_rows(datasource, native_sql, count_sql,
+                                  request_id=None, should_stop=None):
+            calls.append((request_id, should_stop))
+            release.wait(5)
+            return 347
+        with patch('terno.utils.count_native_sql_rows', side_effect=count_native_sql_rows), \
+                patch('terno.utils.cancel_statement') as cancel_statement, \
+                patch.object(settings, 'ROW_COUNT_TIMEOUT', 0.05):
+            result = utils.execute_native_sql(self.datasource, self.native_sql, 1, 25)
+            release.set()
+        self.assertEqual(result['table_data']['row_count_status'], 'approximate')
+        request_id, should_stop = calls[0]
+        cancel_statement.assert_called_once_with(request_id)
+        self.assertTrue(should_stop())
+
+    def test_row_count_approximate(self):
+        result = utils.execute_native_sql(self.datasource, self.native_sql, 2, 25,
+                                          count_rows=False)
+        table_data = result['table_data']
+        self.assertEqual(table_data['row_count_status'], 'approximate')
+        self.assertEqual(table_data['row_count'], 50)
+        self.assertEqual(table_data['total_pages'], 3)
+
+        result = utils.execute_native_sql(self.datasource, self.native_sql, 14, 25,
+                                          count_rows=False)
+        table_data = result['table_data']
+        self.assertEqual(table_data['row_count_status'], 'exact')
+        self.assertEqual(table_data['row_count'], 347)
+
+
+class ResultCacheTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.datasource = super().create_datasource()
+        organisation, _ = super().create_organisation(super().create_user())
+        super().create_organisationdatasource(self.datasource, organisation)
+        self.native_sql = 'SELECT AlbumId, Title FROM Album'
+
+    def test_cached_page_does_not_touch_warehouse(self):
+        result = utils.execute_native_sql(self.datasource, self.native_sql, 2, 25)
+        with patch('terno.utils.datasource_connection') as mock_connection:
+            cached_result = utils.execute_native_sql(self.datasource, self.native_sql, 2, 25)
+            mock_connection.assert_not_called()
+        self.assertEqual(cached_result, result)
+
+    def test_cache_invalidated_on_metadata_change(self):
+        utils.execute_native_sql(self.datasource, self.native_sql, 1, 25)
+        version = utils.get_metadata_version(self.datasource)
+
+        table = models.Table.objects.get(name='Album', data_source=self.datasource)
+        table.description = 'Albums'
+        table.save()
+        self.assertEqual(utils.get_metadata_version(self.datasource), version + 1)
+
+        with patch('terno.utils.datasource_connection',
+                   wraps=utils.datasource_connection) as mock_connection:
+            utils.execute_native_sql(self.datasource, self.native_sql, 1, 25)
+            mock_connection.assert_called()
+
+    @patch.object(settings, 'RESULT_CACHE_MAX_BYTES', 100)
+    def test_large_pages_are_not_cached(self):
+        utils.execute_native_sql(self.datasource, self.native_sql, 1, 25)
+        cache_key = utils.get_result_cache_key(self.datasource, self.native_sql,
+                                               1, 25, None)
+        self.assertIsNone(cache.get(cache_key))
+
+
+class QueryJobTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.spool_dir = tempfile.mkdtemp()
+        self.settings_patch = patch.object(settings, 'QUERY_JOB_SPOOL_DIR', self.spool_dir)
+        self.settings_patch.start()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.job = models.QueryJob.objects.create(
+            user=self.user, data_source=self.datasource,
+            native_sql='SELECT AlbumId, Title FROM Album ORDER BY AlbumId')
+
+    def tearDown(self) -> None:
+        self.settings_patch.stop()
+        shutil.rmtree(self.spool_dir)
+
+    def test_run_query_job(self):
+        run_query_job(str(self.job.job_id))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'success')
+        self.assertEqual(self.job.row_count, 347)
+        self.assertEqual(self.job.columns, ['AlbumId', 'Title'])
+        self.assertTrue(os.path.exists(self.job.result_path))
+
+        table_data = utils.read_spooled_page(self.job.result_path, 2, 25)
+        self.assertEqual(table_data['row_count'], 347)
+        self.assertEqual(table_data['total_pages'], 14)
+        self.assertEqual(table_data['data'][0],
+                         {'AlbumId': 26, 'Title': 'Acústico MTV [Live]'})
+
+        result_path = self.job.result_path
+        self.job.delete()
+        self.assertFalse(os.path.exists(result_path))
+
+    def test_run_query_job_error(self):
+        models.QueryJob.objects.filter(id=self.job.id).update(
+            native_sql='SELECT * FROM InvalidTable')
+        run_query_job(str(self.job.job_id))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'error')
+        self.assertIn('InvalidTable', self.job.error)
+
+    def test_spool_stops_when_cancelled(self):
+        path = utils.get_query_job_path(self.job.job_id)
+        result = utils.spool_native_sql_result(
+            self.datasource, self.job.native_sql, path, should_stop=lambda: True)
+        self.assertIsNone(result)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def spool_chunks(self, *chunks):
+        path = utils.get_query_job_path(self.job.job_id)
+
+        def stream_native_sql(*args):
+            yield ['value']
+            yield from chunks
+        with patch('terno.utils.stream_native_sql', side_effect=stream_native_sql):
+            utils.spool_native_sql_result(self.datasource, 'SELECT 1', path)
+        self.assertEqual(os.listdir(self.spool_dir), [os.path.basename(path)])
+        table_data = utils.read_spooled_page(path, 1, 25)
+        return [row['value'] for row in table_data['data']]
+
+    def test_spool_widens_decimal_scale(self):
+        values = self.spool_chunks([[None]], [[Decimal('1.50')]], [[Decimal('12345.678')]])
+        self.assertEqual(values, [None, Decimal('1.500'), Decimal('12345.678')])
+
+    def test_spool_widens_int_to_float(self):
+        self.assertEqual(self.spool_chunks([[1]], [[1.5]]), [1.0, 1.5])
+
+    def test_spool_falls_back_to_string(self):
+        self.assertEqual(self.spool_chunks([[2 ** 62]], [[1.5]], [['a']]),
+                         [str(2 ** 62), '1.5', 'a'])
+
+
+class StatementTimeoutTestCase(BaseTestCase):
+    heavy_sql = ('SELECT COUNT(*) FROM Track t1, Track t2, Track t3')
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+
+    def test_statement_timeout(self):
+        self.datasource.statement_timeout = 1
+        with self.assertRaises(utils.StatementTimeoutException):
+            with utils.datasource_connection(self.datasource) as con:
+                with utils.statement_guard(con, self.datasource):
+                    con.execute(text(self.heavy_sql)).fetchall()
+
+    def test_execute_native_sql_timeout(self):
+        self.datasource.statement_timeout = 1
+        response = utils.execute_native_sql(
+            self.datasource, self.heavy_sql, 1, 25, count_rows=False)
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual(response['error_type'], 'timeout')
+
+    def test_cancel_statement(self):
+        with utils.datasource_connection(self.datasource) as con:
+            with self.assertRaises(utils.StatementCancelledException):
+                with utils.statement_guard(con, self.datasource, request_id='req-1',
+                                           user_id=self.user.id):
+                    self.assertFalse(utils.cancel_statement('req-1', user_id=self.user.id + 1))
+                    self.assertTrue(utils.cancel_statement('req-1', user_id=self.user.id))
+                    con.execute(text(self.heavy_sql)).fetchall()
+        self.assertFalse(utils.cancel_statement('req-1'))
+
+    @patch.object(settings, 'EXPORT_CHUNK_SIZE', 100)
+    def test_slow_consumer_does_not_time_out(self):
+        self.datasource.statement_timeout = 0.2
+        chunks = utils.stream_native_sql(self.datasource, 'SELECT * FROM Track')
+        next(chunks)
+        rows = len(next(chunks))
+        time.sleep(0.3)
+        for chunk in chunks:
+            rows += len(chunk)
+        self.assertEqual(rows, 3503)
+
+    def test_cancel_unknown_statement(self):
+        self.assertFalse(utils.cancel_statement('unknown'))
+
+    def test_mysql_timeout_is_restored(self):
+        con = MagicMock()
+        con.dialect.name = 'mysql'
+        self.datasource.statement_timeout = 5
+        with utils.statement_guard(con, self.datasource):
+            pass
+        # No connection id lookup without a request id
+        self.assertEqual([str(call.args[0]) for call in con.execute.call_args_list], [
+            'SET @terno_max_execution_time = @@SESSION.max_execution_time, '
+            'SESSION max_execution_time = 5000',
+            'SET SESSION max_execution_time = @terno_max_execution_time'])
+
+
+class AdmissionControlTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        utils._admission_metrics.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.datasource.max_concurrent_queries = 1
+        self.settings_patch = patch.multiple(
+            settings, ADMISSION_QUEUE_TIMEOUT=0.2, ADMISSION_POLL_INTERVAL=0.01)
+        self.settings_patch.start()
+
+    def tearDown(self) -> None:
+        self.settings_patch.stop()
+
+    def test_slot_is_released(self):
+        with utils.admission_slot(self.datasource):
+            pass
+        with utils.admission_slot(self.datasource):
+            pass
+        metrics = utils.get_admission_metrics()[self.datasource.id]
+        self.assertEqual(metrics['admitted'], 2)
+        self.assertEqual(metrics['queue_depth'], {'interactive': 0, 'export': 0})
+
+    def test_wait_times_out_when_busy(self):
+        with utils.admission_slot(self.datasource):
+            with self.assertRaises(utils.DatasourceBusyException):
+                with utils.admission_slot(self.datasource):
+                    pass
+            response = utils.execute_native_sql(
+                self.datasource, 'SELECT * FROM Album', 1, 25)
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual(response['error_type'], 'busy')
+        metrics = utils.get_admission_metrics()[self.datasource.id]
+        self.assertEqual(metrics['timed_out'], 2)
+        self.assertEqual(utils.get_admission_queue_depth(self.datasource.id), 0)
+
+    def test_rejected_when_queue_is_full(self):
+        with patch.object(settings, 'ADMISSION_QUEUE_SIZE', 0):
+            with utils.admission_slot(self.datasource):
+                with self.assertRaises(utils.DatasourceBusyException):
+                    with utils.admission_slot(self.datasource):
+                        pass
+        metrics = utils.get_admission_metrics()[self.datasource.id]
+        self.assertEqual(metrics['rejected'], 1)
+
+    def test_export_yields_to_interactive(self):
+        utils._take_queue_position(self.datasource.id, 'interactive', 'token')
+        with self.assertRaises(utils.DatasourceBusyException):
+            with utils.admission_slot(self.datasource, 'export'):
+                pass
+        with utils.admission_slot(self.datasource, 'interactive'):
+            pass
+
+    def test_position_of_killed_waiter_expires(self):
+        with patch.object(settings, 'ADMISSION_WAITER_LEASE', 0.05):
+            utils._take_queue_position(self.datasource.id, 'interactive', 'token')
+        self.assertEqual(utils.get_admission_queue_depth(self.datasource.id, 'interactive'), 1)
+        time.sleep(0.1)
+        self.assertEqual(utils.get_admission_queue_depth(self.datasource.id), 0)
+        with utils.admission_slot(self.datasource, 'export'):
+            pass
+
+    def test_no_limit(self):
+        self.datasource.max_concurrent_queries = 0
+        with utils.admission_slot(self.datasource):
+            with utils.admission_slot(self.datasource):
+                pass
+
+
+class QueryCostGuardTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.organisation, _ = super().create_organisation(self.user)
+        self.organisation.max_bytes_processed = 1000
+        self.organisation.max_estimated_rows = 100
+
+    def test_check_query_cost(self):
+        self.assertIsNone(utils.check_query_cost(self.organisation, None))
+        self.assertIsNone(utils.check_query_cost(
+            self.organisation, {'method': 'dry_run', 'bytes_processed': 1000}))
+        cost_check = utils.check_query_cost(
+            self.organisation, {'method': 'dry_run', 'bytes_processed': 1001})
+        self.assertEqual(cost_check['action'], 'confirm')
+        self.organisation.cost_guard_action = 'reject'
+        cost_check = utils.check_query_cost(
+            self.organisation, {'method': 'explain', 'rows': 101})
+        self.assertEqual(cost_check['action'], 'reject')
+        self.assertIn('101 rows', cost_check['error'])
+
+    def test_no_estimator_for_sqlite(self):
+        self.assertIsNone(utils.estimate_native_sql_cost(
+            self.datasource, 'SELECT * FROM Album'))
+
+    def test_estimate_is_cached(self):
+        cache.clear()
+        estimator = MagicMock(return_value={'method': 'explain', 'rows': 5})
+        with patch.dict(utils.COST_ESTIMATORS, {self.datasource.dialect_name: estimator}):
+            for _ in range(2):
+                self.assertEqual(utils.estimate_native_sql_cost(
+                    self.datasource, 'SELECT * FROM Album'), {'method': 'explain', 'rows': 5})
+            self.assertEqual(estimator.call_count, 1)
+            utils.bump_metadata_version(self.datasource)
+            utils.estimate_native_sql_cost(self.datasource, 'SELECT * FROM Album')
+            self.assertEqual(estimator.call_count, 2)
+
+    def test_postgres_explain(self):
+        con = MagicMock()
+        con.execute.return_value.scalar.return_value = [
+            {'Plan': {'Plan Rows': 250, 'Total Cost': 12.5}}]
+        cost_estimate = utils._postgres_explain(con, 'SELECT * FROM album')
+        self.assertEqual(cost_estimate, {'method': 'explain', 'rows': 250, 'cost': 12.5})
+
+    @patch('terno.utils.estimate_native_sql_cost')
+    def test_confirm_cost(self, estimate_native_sql_cost):
+        estimate_native_sql_cost.return_value = {'method': 'explain', 'rows': 500}
+        cost_estimate, response = views._guard_query_cost(
+            self.user, {}, self.organisation, self.datasource, 'SELECT 1')
+        self.assertEqual(cost_estimate['rows'], 500)
+        self.assertEqual(json.loads(response.content)['error_type'],
+                         'cost_confirmation_required')
+
+        cost_estimate, response = views._guard_query_cost(
+            self.user, {'confirmCost': True}, self.organisation,
+            self.datasource, 'SELECT 1')
+        self.assertIsNone(response)
+
+    @patch('terno.utils.estimate_native_sql_cost')
+    def test_reject_cost(self, estimate_native_sql_cost):
+        estimate_native_sql_cost.return_value = {'method': 'explain', 'rows': 500}
+        self.organisation.cost_guard_action = 'reject'
+        _, response = views._guard_query_cost(
+            self.user, {'confirmCost': True}, self.organisation,
+            self.datasource, 'SELECT 1')
+        self.assertEqual(json.loads(response.content)['error_type'], 'cost_rejected')
+        history = models.QueryHistory.objects.get(data_type='rejected_sql')
+        self.assertEqual(history.cost_estimate, {'method': 'explain', 'rows': 500})
+
+
+class AsyncViewsTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.organisation, _ = super().create_organisation(self.user)
+        super().create_organisationdatasource(self.datasource, self.organisation)
+
+    def post(self, data):
+        request = RequestFactory().post('/', data=json.dumps(data),
+                                        content_type='application/json')
+        request.org_id = self.organisation.id
+        request.user = self.user
+
+        async def auser():
+            return self.user
+        request.auser = auser
+        return request
+
+    def test_aexecute_sql(self):
+        request = self.post({
+            'sql': 'SELECT AlbumId, Title FROM Album ORDER BY AlbumId',
+            'datasourceId': self.datasource.id,
+            'page': 2,
+        })
+        response = async_to_sync(views.aexecute_sql)(request)
+        table_data = json.loads(response.content)['table_data']
+        self.assertEqual(table_data['row_count'], 347)
+        self.assertEqual(table_data['data'][0]['AlbumId'], 26)
+        self.assertTrue(models.QueryHistory.objects.filter(
+            data_type='actual_executed_sql', data_source=self.datasource).exists())
+
+    def test_aexecute_sql_estimates_in_blocking_pool(self):
+        self.organisation.max_estimated_rows = 100
+        self.organisation.save()
+        threads = []
+
+        def estimate(datasource, native_sql):
+            threads.append(threading.current_thread().name)
+            return {'method': 'explain', 'rows': 500}
+
+        request = self.post({'sql': 'SELECT * FROM Album', 'datasourceId': self.datasource.id})
+        with patch('terno.utils.estimate_native_sql_cost', side_effect=estimate):
+            response = async_to_sync(views.aexecute_sql)(request)
+        self.assertEqual(json.loads(response.content)['error_type'],
+                         'cost_confirmation_required')
+        self.assertTrue(threads[0].startswith('terno-blocking'))
+
+    def test_aexecute_sql_unknown_datasource(self):
+        request = self.post({'sql': 'SELECT 1', 'datasourceId': 0})
+        response = async_to_sync(views.aexecute_sql)(request)
+        self.assertEqual(json.loads(response.content)['error'], 'No Datasource found.')
+
+    @patch('terno.views.search_vector_DB', return_value=[])
+    @patch('terno.utils.LLMFactory.create_llm')
+    def test_aget_sql(self, create_llm, search_vector_DB):
+        create_llm.return_value = (llms.FakeLLM(api_key='test_key'), False)
+        request = self.post({'prompt': 'How many albums?',
+                             'datasourceId': self.datasource.id})
+        response = async_to_sync(views.aget_sql)(request)
+        self.assertEqual(json.loads(response.content), {
+            'status': 'success', 'generated_sql': 'SELECT 1'})
+        self.assertTrue(models.QueryHistory.objects.filter(
+            data_type='generated_sql', data='SELECT 1').exists())
+
+    def test_pipeline_arun(self):
+        pipeline = Pipeline([Step(llms.FakeLLM(api_key='test_key'), [])])
+        result = async_to_sync(pipeline.arun)()
+        self.assertEqual(result[0][0], {'generated_sql': 'SELECT 1'})
+
+    def test_run_blocking(self):
+        result = async_to_sync(utils.run_blocking)(sum, [1, 2, 3])
+        self.assertEqual(result, 6)
+
+
+class BigQueryStorageTestCase(TestCase):
+    def setUp(self) -> None:
+        self.batch = pa.RecordBatch.from_pydict({'id': [1, 2], 'name': ['a', 'b,c']})
+
+    def bigquery_con(self, total_rows):
+        con = MagicMock()
+        rows = con.connection.dbapi_connection._client.query.return_value.result.return_value
+        rows.total_rows = total_rows
+        id_field, name_field = MagicMock(), MagicMock()
+        id_field.name, name_field.name = 'id', 'name'
+        rows.schema = [id_field, name_field]
+        rows.to_arrow_iterable.return_value = iter([self.batch])
+        return con, rows
+
+    def test_small_result_uses_rest_api(self):
+        con, rows = self.bigquery_con(total_rows=10)
+        columns, batches = utils._read_bigquery_result(con, 'SELECT 1')
+        self.assertEqual(columns, ['id', 'name'])
+        self.assertEqual(list(batches), [self.batch])
+        rows.to_arrow_iterable.assert_called_once_with(bqstorage_client=None)
+
+    def test_large_result_uses_storage_api(self):
+        con, rows = self.bigquery_con(total_rows=settings.BIGQUERY_STORAGE_MIN_ROWS)
+        bqstorage_client = con.connection.dbapi_connection._bqstorage_client
+        utils._read_bigquery_result(con, 'SELECT 1')
+        rows.to_arrow_iterable.assert_called_once_with(bqstorage_client=bqstorage_client)
+
+    def test_csv_from_record_batches(self):
+        chunks = utils._csv_chunks(['id', 'name'], (b for b in [self.batch]))
+        self.assertEqual(b''.join(chunks).decode(), 'id,name\r\n1,a\r\n2,"b,c"\r\n')
+
+    def test_spool_record_batches(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        path = os.path.join(spool_dir, 'result.arrow')
+
+        def stream_native_sql(*args):
+            yield ['id', 'name']
+            yield self.batch
+        with patch('terno.utils.stream_native_sql', side_effect=stream_native_sql):
+            columns, row_count = utils.spool_native_sql_result(None, 'SELECT 1', path)
+        self.assertEqual(row_count, 2)
+        table_data = utils.read_spooled_page(path, 1, 25)
+        self.assertEqual(table_data['data'][1], {'id': 2, 'name': 'b,c'})
+
+
+class NativeSQLCacheTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        utils._native_sql_cache.clear()
+        for key in utils._native_sql_cache_metrics:
+            utils._native_sql_cache_metrics[key] = 0
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.roles = self.user.groups.all()
+
+    def test_normalise_sql(self):
+        self.assertEqual(utils.normalise_sql("  SELECT *  FROM\tAlbum ; "),
+                         "SELECT * FROM Album")
+        self.assertEqual(utils.normalise_sql("SELECT *\n  FROM  Album"),
+                         "SELECT *\nFROM Album")
+        self.assertEqual(utils.normalise_sql("SELECT 'a  b'  FROM \"My  Table\""),
+                         "SELECT 'a  b' FROM \"My  Table\"")
+
+    def test_native_sql_is_memoized(self):
+        first = utils.get_native_sql(self.datasource, self.roles, 'SELECT * FROM Album')
+        with patch('terno.utils.generate_native_sql') as generate_native_sql:
+            second = utils.get_native_sql(
+                self.datasource, self.roles, 'SELECT *  FROM Album;')
+            generate_native_sql.assert_not_called()
+        self.assertEqual(first, second)
+        metrics = utils.get_native_sql_cache_metrics()
+        self.assertEqual((metrics['hits'], metrics['misses']), (1, 1))
+        self.assertEqual(metrics['hit_ratio'], 0.5)
+
+    def test_comments_do_not_collide(self):
+        commented = utils.get_native_sql(
+            self.datasource, self.roles, 'SELECT * FROM Album -- newest\nWHERE AlbumId = 1')
+        whole_line = utils.get_native_sql(
+            self.datasource, self.roles, 'SELECT * FROM Album -- newest WHERE AlbumId = 1')
+        self.assertEqual(utils.get_native_sql_cache_metrics()['misses'], 2)
+        self.assertNotEqual(commented['native_sql'], whole_line['native_sql'])
+
+    def test_quote_in_comment_does_not_start_a_literal(self):
+        self.assertNotEqual(
+            utils.normalise_sql("-- it's\nSELECT 'a  b' FROM t -- '"),
+            utils.normalise_sql("-- it's\nSELECT 'a b' FROM t -- '"))
+        self.assertEqual(
+            utils.normalise_sql("/* it's */  SELECT\n\n 'a  b'"),
+            "/* it's */ SELECT\n'a  b'")
+
+    def test_metadata_change_invalidates(self):
+        utils.get_native_sql(self.datasource, self.roles, 'SELECT * FROM Album')
+        utils.bump_metadata_version(self.datasource)
+        utils.get_native_sql(self.datasource, self.roles, 'SELECT * FROM Album')
+        self.assertEqual(utils.get_native_sql_cache_metrics()['misses'], 2)
+
+    def test_errors_are_not_cached(self):
+        response = utils.get_native_sql(self.datasource, self.roles, 'SELECT * FROM Invalid')
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual(utils.get_native_sql_cache_metrics()['size'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        with patch.object(settings, 'NATIVE_SQL_CACHE_SIZE', 1):
+            utils.get_native_sql(self.datasource, self.roles, 'SELECT * FROM Album')
+            utils.get_native_sql(self.datasource, self.roles, 'SELECT * FROM Artist')
+        metrics = utils.get_native_sql_cache_metrics()
+        self.assertEqual((metrics['size'], metrics['evictions']), (1, 1))
+
+
+class SubsetMDatabaseTestCase(BaseTestCase):
+    queries = [
+        'SELECT * FROM Album',
+        'SELECT a.Title, ar.Name FROM Album a JOIN Artist ar ON a.ArtistId = ar.ArtistId',
+        'WITH t AS (SELECT * FROM Track) SELECT COUNT(*) FROM t',
+        'SELECT * FROM Album WHERE ArtistId IN (SELECT ArtistId FROM Artist)',
+    ]
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.mDb = utils.prepare_mdb(self.datasource, self.user.groups.all())
+
+    def test_get_referenced_tables(self):
+        self.assertEqual(utils.get_referenced_tables(self.queries[1]), {'Album', 'Artist'})
+        self.assertEqual(utils.get_referenced_tables(self.queries[2]), {'Track'})
+        self.assertIsNone(utils.get_referenced_tables('SELECT * FROM ('))
+
+    def test_subset_mdb(self):
+        subset = utils.subset_mdb(self.mDb, self.queries[1])
+        self.assertEqual(set(subset.tables), {'Album', 'Artist'})
+        self.assertIs(subset.tables['Album'], self.mDb.tables['Album'])
+        self.assertIs(utils.subset_mdb(self.mDb, 'SELECT * FROM Unknown'), self.mDb)
+
+    def test_public_name_matching_other_table(self):
+        self.mDb.tables['Album'].pub_name = 'Artist'
+        subset = utils.subset_mdb(self.mDb, 'SELECT * FROM Artist')
+        self.assertEqual(set(subset.tables), {'Album', 'Artist'})
+
+    def test_same_native_sql(self):
+        for query in self.queries:
+            self.assertEqual(
+                utils.generate_native_sql(utils.subset_mdb(self.mDb, query), query, 'sqlite'),
+                utils.generate_native_sql(self.mDb, query, 'sqlite'))
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        for key in utils._single_flight_metrics:
+            utils._single_flight_metrics[key] = 0
+        self.settings_patch = patch.object(settings, 'SINGLE_FLIGHT_POLL_INTERVAL', 0.01)
+        self.settings_patch.start()
+
+    def tearDown(self) -> None:
+        self.settings_patch.stop()
+
+    def test_concurrent_calls_share_one_execution(self):
+        started = threading.Event()
+        release = threading.Event()
+        execute = MagicMock()
+
+        def slow_execute():
+            started.set()
+            release.wait(5)
+            execute()
+            return {'status': 'success', 'table_data': {'data': [1]}}
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(utils.single_flight('key', slow_execute)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(
+            target=lambda: results.append(utils.single_flight('key', slow_execute)))
+            for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        # Give the followers time to join the flight of the leader
+        time.sleep(0.2)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(execute.call_count, 1)
+        metrics = utils.get_single_flight_metrics()
+        self.assertEqual(metrics['saved_executions'], 3)
+        self.assertEqual(metrics['in_flight'], 0)
+
+    def test_cancelled_result_is_not_shared(self):
+        utils._in_flight['key'] = flight = {'done': threading.Event(), 'result': None}
+        flight['result'] = {'status': 'error', 'error_type': 'cancelled'}
+        flight['done'].set()
+        result = utils.single_flight('key', lambda: {'status': 'success'})
+        self.assertEqual(result, {'status': 'success'})
+        self.assertEqual(utils.get_single_flight_metrics()['fallbacks'], 1)
+        utils._in_flight.clear()
+
+    def test_result_of_other_process_is_shared(self):
+        lock_key = 'result_key_in_flight'
+        cache.add(lock_key, 'running')
+        cache.set('result_key', {'data': [1]})
+        threading.Timer(0.05, cache.set, [lock_key, 'done']).start()
+        execute = MagicMock()
+        result = utils.single_flight('key', execute, result_cache_key='result_key')
+        execute.assert_not_called()
+        self.assertEqual(result, {'status': 'success', 'table_data': {'data': [1]}})
+        self.assertEqual(utils.get_single_flight_metrics()['shared_remote'], 1)
+
+    def test_leader_publishes_its_state(self):
+        utils.single_flight('key', lambda: {'status': 'error', 'error': 'failed'},
+                            result_cache_key='result_key')
+        self.assertEqual(cache.get('result_key_in_flight'), 'uncacheable')
+        # The next caller runs at once instead of waiting for a result
+        utils._in_flight.clear()
+        cache.set('result_key_in_flight', 'uncacheable')
+        execute = MagicMock(return_value={'status': 'success'})
+        self.assertEqual(utils.single_flight('key', execute, result_cache_key='result_key'),
+                         {'status': 'success'})
+        self.assertEqual(utils.get_single_flight_metrics()['fallbacks'], 1)
+
+    def test_wait_is_bounded(self):
+        cache.add('result_key_in_flight', 'running')
+        execute = MagicMock(return_value={'status': 'success'})
+        start = time.monotonic()
+        utils.single_flight('key', execute, result_cache_key='result_key', timeout=0.1)
+        self.assertLess(time.monotonic() - start, 1)
+        execute.assert_called_once()
+
+    def test_timeout_follows_statement_timeout(self):
+        datasource = models.DataSource(statement_timeout=10)
+        with patch.multiple(settings, ADMISSION_QUEUE_TIMEOUT=30, ROW_COUNT_TIMEOUT=30):
+            self.assertEqual(utils.get_single_flight_timeout(datasource), 80)
+            datasource.statement_timeout = 0
+            self.assertEqual(utils.get_single_flight_timeout(datasource),
+                             settings.SINGLE_FLIGHT_TIMEOUT)
+
+
+class GenerateMDBTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+
+    def test_constant_number_of_queries(self):
+        with self.assertNumQueries(3):
+            mdb = utils.generate_mdb(self.datasource)
+        self.assertEqual(len(mdb.tables),
+                         models.Table.objects.filter(data_source=self.datasource).count())
+        album = mdb.tables['Album']
+        self.assertEqual(list(album.columns), ['AlbumId', 'Title', 'ArtistId'])
+        self.assertEqual(len(album.Foreign_Keys), 1)
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('benchmark_generate_mdb', '--tables', '5', '--columns', '2', stdout=out)
+        self.assertIn('5 tables: 5 loaded with 3 queries', out.getvalue())
+        self.assertFalse(models.DataSource.objects.filter(
+            display_name='generate_mdb benchmark').exists())
+
+
+class PrepareMDBTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        organisation, _ = super().create_organisation(self.user)
+        super().create_organisationdatasource(self.datasource, organisation)
+        self.roles = self.user.groups.all()
+
+    def count_prepare_mdb_queries(self):
+        cache.clear()
+        utils._mdb_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            mDb = utils.prepare_mdb(self.datasource, self.roles)
+        return len(queries), mDb
+
+    def test_queries_do_not_grow_with_schema(self):
+        query_count, mDb = self.count_prepare_mdb_queries()
+        tables = models.Table.objects.bulk_create(
+            [models.Table(name=f'extra_{i}', data_source=self.datasource) for i in range(20)])
+        models.TableColumn.objects.bulk_create(
+            [models.TableColumn(name=f'column_{j}', table=table)
+             for table in tables for j in range(5)])
+        models.TableRowFilter.objects.bulk_create(
+            [models.TableRowFilter(data_source=self.datasource, table=table,
+                                   filter_str='column_0 > 0') for table in tables])
+        extra_query_count, extra_mDb = self.count_prepare_mdb_queries()
+        self.assertEqual(extra_query_count, query_count)
+        self.assertEqual(len(extra_mDb.tables), len(mDb.tables) + 20)
+        self.assertEqual(extra_mDb.tables['extra_0'].filters, 'WHERE (column_0 > 0)')
+
+    def test_private_columns_are_dropped(self):
+        album = models.Table.objects.get(data_source=self.datasource, name='Album')
+        models.Table.objects.filter(id=album.id).update(public_name='Albums')
+        title = models.TableColumn.objects.get(table=album, name='Title')
+        selector = models.PrivateColumnSelector.objects.create(data_source=self.datasource)
+        selector.columns.add(title)
+        _, mDb = self.count_prepare_mdb_queries()
+        self.assertEqual(list(mDb.tables['Album'].columns), ['AlbumId', 'ArtistId'])
+        self.assertEqual(mDb.tables['Album'].pub_name, 'Albums')
+
+    def test_descriptions_are_scoped_to_datasource(self):
+        other_datasource = super().create_datasource(display_name='other_db')
+        models.Table.objects.filter(data_source=self.datasource, name='Album').update(
+            description='first')
+        models.Table.objects.filter(data_source=other_datasource, name='Album').update(
+            description='second')
+        cache.clear()
+        mDb = utils.prepare_mdb(other_datasource, self.roles)
+        self.assertEqual(mDb.tables['Album'].desc, 'second')
+
+    def test_role_sets_share_base_schema(self):
+        album = models.Table.objects.get(data_source=self.datasource, name='Album')
+        private = models.PrivateTableSelector.objects.create(data_source=self.datasource)
+        private.tables.add(models.Table.objects.get(data_source=self.datasource, name='Invoice'))
+        title = models.TableColumn.objects.get(table=album, name='Title')
+        private_columns = models.PrivateColumnSelector.objects.create(data_source=self.datasource)
+        private_columns.columns.add(title)
+        models.TableRowFilter.objects.create(
+            data_source=self.datasource, table=album, filter_str='AlbumId > 1')
+        group = Group.objects.create(name='sales')
+        models.GroupTableSelector.objects.create(group=group).tables.add(
+            models.Table.objects.get(data_source=self.datasource, name='Invoice'))
+
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        sales_mDb = utils.prepare_mdb(self.datasource, Group.objects.filter(id=group.id))
+        base_mDb = utils.get_base_mdb(self.datasource)
+        self.assertNotIn('Invoice', mDb.tables)
+        self.assertIs(sales_mDb.tables['Invoice'], base_mDb.tables['Invoice'])
+        self.assertIs(mDb.tables['Artist'], sales_mDb.tables['Artist'])
+        # Changed tables are copies, the base is left as it was
+        self.assertEqual(list(mDb.tables['Album'].columns), ['AlbumId', 'ArtistId'])
+        self.assertEqual(mDb.tables['Album'].filters, 'WHERE (AlbumId > 1)')
+        self.assertIn('Title', base_mDb.tables['Album'].columns)
+        self.assertIsNone(base_mDb.tables['Album'].filters)
+        overlay = utils.get_mdb_overlay(self.datasource, self.roles, [])
+        self.assertEqual(overlay['denied_tables'], {'Invoice'})
+        self.assertEqual(overlay['drop_columns'], {'Album': ['Title']})
+
+
+class MetadataVersionTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.roles = self.user.groups.all()
+
+    def test_save_invalidates_mdb(self):
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        self.assertEqual(mDb.tables['Album'].pub_name, 'Album')
+        table = models.Table.objects.get(data_source=self.datasource, name='Album')
+        table.public_name = 'Albums'
+        table.save()
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        self.assertEqual(mDb.tables['Album'].pub_name, 'Albums')
+
+    def test_invalidation_does_not_depend_on_users(self):
+        table = models.Table.objects.select_related('data_source').get(
+            data_source=self.datasource, name='Album')
+        version = utils.get_metadata_version(self.datasource)
+        # No organisation is needed and no per user keys are rebuilt
+        with self.assertNumQueries(1):
+            table.save()
+        self.assertEqual(utils.get_metadata_version(self.datasource), version + 1)
+
+    def test_group_selector_invalidates(self):
+        group = Group.objects.create(name='analysts')
+        selector = models.GroupTableSelector.objects.create(group=group)
+        selector.tables.add(models.Table.objects.get(data_source=self.datasource, name='Album'))
+        version = utils.get_metadata_version(self.datasource)
+        selector.save()
+        self.assertEqual(utils.get_metadata_version(self.datasource), version + 1)
+
+
+class MDBCacheTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        utils._mdb_cache.clear()
+        for key in utils._mdb_cache_metrics:
+            utils._mdb_cache_metrics[key] = 0
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.roles = self.user.groups.all()
+
+    def test_local_hit_returns_same_object(self):
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        self.assertIs(utils.prepare_mdb(self.datasource, self.roles), mDb)
+        metrics = utils.get_mdb_cache_metrics()
+        self.assertEqual(metrics['misses'], 1)
+        self.assertEqual(metrics['local_hits'], 1)
+        # The base and the composed MDatabase
+        self.assertEqual(metrics['size'], 2)
+        self.assertGreater(metrics['bytes'], 0)
+
+    def test_shared_hit_after_local_miss(self):
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        # As seen by another process
+        utils._mdb_cache.clear()
+        with self.assertNumQueries(1):
+            shared_mDb = utils.prepare_mdb(self.datasource, self.roles)
+        self.assertIsNot(shared_mDb, mDb)
+        self.assertEqual(list(shared_mDb.tables), list(mDb.tables))
+        self.assertEqual(utils.get_mdb_cache_metrics()['shared_hits'], 1)
+
+    def test_evicts_by_bytes(self):
+        utils.prepare_mdb(self.datasource, self.roles)
+        size = utils.get_mdb_cache_metrics()['bytes']
+        other_datasource = super().create_datasource(display_name='other_db')
+        with self.settings(MDB_LOCAL_CACHE_MAX_BYTES=size + size // 2):
+            utils.prepare_mdb(other_datasource, self.roles)
+        metrics = utils.get_mdb_cache_metrics()
+        self.assertEqual(metrics['evictions'], 1)
+        self.assertLessEqual(metrics['bytes'], size + size // 2)
+        # The least recently used entry, the base MDatabase of the first datasource
+        self.assertFalse([cache_key for cache_key in utils._mdb_cache
+                          if cache_key.startswith(f'datasource_{self.datasource.id}_')
+                          and cache_key.endswith('_base')])
+
+    def test_version_bump_drops_local_entries(self):
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        utils.bump_metadata_version(self.datasource)
+        self.assertEqual(utils.get_mdb_cache_metrics()['size'], 0)
+        self.assertIsNot(utils.prepare_mdb(self.datasource, self.roles), mDb)
+        self.assertEqual(utils.get_mdb_cache_metrics()['misses'], 2)
+
+
+class SchemaCacheTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        utils._mdb_cache.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.roles = self.user.groups.all()
+
+    def test_full_schema_matches_mdb(self):
+        schema = utils.get_schema(self.datasource, self.roles)
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        self.assertEqual(schema['schema'], mDb.generate_schema())
+        self.assertGreater(schema['tokens'], 0)
+        # Only the roles are looked up
+        with self.assertNumQueries(1):
+            self.assertEqual(utils.get_schema(self.datasource, self.roles), schema)
+
+    def test_table_subset(self):
+        mDb = utils.prepare_mdb(self.datasource, self.roles)
+        album = mDb.tables['Album'].generate_schema()
+        track = mDb.tables['Track'].generate_schema()
+        # In schema order, unknown tables are left out
+        schema = utils.get_schema(self.datasource, self.roles, ['Track', 'Album', 'Unknown'])
+        self.assertEqual(schema['schema'], f'{album}\n{track}')
+        self.assertEqual(schema['tokens'],
+                         utils.estimate_tokens(album) + utils.estimate_tokens(track))
+
+    def test_metadata_change_regenerates_schema(self):
+        utils.get_schema(self.datasource, self.roles)
+        table = models.Table.objects.get(data_source=self.datasource, name='Album')
+        table.public_name = 'Albums'
+        table.save()
+        self.assertIn('[Albums]', utils.get_schema(self.datasource, self.roles)['schema'])
+
+
+class AclIndexTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        utils._mdb_cache.clear()
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        self.group = Group.objects.create(name='sales')
+        self.user.groups.add(self.group)
+        self.roles = self.user.groups.all()
+
+    def get_table(self, name, datasource=None):
+        return models.Table.objects.get(data_source=datasource or self.datasource, name=name)
+
+    def allowed_table_names(self):
+        tables, _ = utils.get_admin_config_object(self.datasource, self.roles)
+        return set(tables.values_list('name', flat=True))
+
+    def test_every_selector_is_honoured(self):
+        for name in ['Invoice', 'Customer']:
+            selector = models.PrivateTableSelector.objects.create(data_source=self.datasource)
+            selector.tables.add(self.get_table(name))
+        other_group = Group.objects.create(name='support')
+        self.user.groups.add(other_group)
+        for group, name in [(self.group, 'Invoice'), (other_group, 'Customer')]:
+            selector = models.GroupTableSelector.objects.create(group=group)
+            selector.tables.add(self.get_table(name))
+        self.assertLessEqual({'Invoice', 'Customer'}, self.allowed_table_names())
+        self.user.groups.remove(other_group)
+        allowed = self.allowed_table_names()
+        self.assertIn('Invoice', allowed)
+        self.assertNotIn('Customer', allowed)
+
+    def test_selection_changes_update_index(self):
+        self.assertIn('Invoice', self.allowed_table_names())
+        selector = models.PrivateTableSelector.objects.create(data_source=self.datasource)
+        selector.tables.add(self.get_table('Invoice'))
+        self.assertNotIn('Invoice', self.allowed_table_names())
+        self.assertNotIn('Invoice', utils.prepare_mdb(self.datasource, self.roles).tables)
+        selector.tables.clear()
+        self.assertIn('Invoice', self.allowed_table_names())
+        selector.tables.add(self.get_table('Invoice'))
+        selector.delete()
+        self.assertIn('Invoice', self.allowed_table_names())
+
+    def test_selector_moved_to_another_group(self):
+        private = models.PrivateTableSelector.objects.create(data_source=self.datasource)
+        private.tables.add(self.get_table('Invoice'))
+        selector = models.GroupTableSelector.objects.create(group=self.group)
+        selector.tables.add(self.get_table('Invoice'))
+        self.assertIn('Invoice', self.allowed_table_names())
+        selector.group = Group.objects.create(name='support')
+        selector.save()
+        self.assertNotIn('Invoice', self.allowed_table_names())
+
+    def test_private_selector_moved_to_another_datasource(self):
+        other_datasource = super().create_datasource(display_name='other_db')
+        private = models.PrivateTableSelector.objects.create(data_source=self.datasource)
+        private.tables.add(self.get_table('Invoice'))
+        self.assertNotIn('Invoice', self.allowed_table_names())
+        private.data_source = other_datasource
+        private.save()
+        self.assertIn('Invoice', self.allowed_table_names())
+
+    def test_parts_expire(self):
+        utils.get_allowed_ids(self.datasource, self.roles)
+        version = utils.get_metadata_version(self.datasource)
+        cache_key = utils.get_acl_cache_key(self.datasource.id, version, f'group_{self.group.id}')
+        expiry = cache._expire_info[cache.make_and_validate_key(cache_key)]
+        self.assertLessEqual(expiry, time.time() + settings.MDB_CACHE_TIMEOUT)
+
+    def test_private_and_group_columns(self):
+        album = self.get_table('Album')
+        title = models.TableColumn.objects.get(table=album, name='Title')
+        private = models.PrivateColumnSelector.objects.create(data_source=self.datasource)
+        private.columns.add(title)
+        _, columns = utils.get_admin_config_object(self.datasource, self.roles)
+        self.assertFalse(columns.filter(id=title.id).exists())
+        selector = models.GroupColumnSelector.objects.create(group=self.group)
+        selector.columns.add(title)
+        _, columns = utils.get_admin_config_object(self.datasource, self.roles)
+        self.assertTrue(columns.filter(id=title.id).exists())
+
+    def test_group_selection_of_other_datasource(self):
+        other_datasource = super().create_datasource(display_name='other_db')
+        selector = models.PrivateTableSelector.objects.create(data_source=self.datasource)
+        selector.tables.add(self.get_table('Invoice'))
+        group_selector = models.GroupTableSelector.objects.create(group=self.group)
+        group_selector.tables.add(self.get_table('Invoice', other_datasource))
+        self.assertNotIn('Invoice', self.allowed_table_names())
+
+    def test_resolution_uses_index(self):
+        utils.get_allowed_ids(self.datasource, self.roles)
+        # Only the roles are looked up
+        with self.assertNumQueries(1):
+            allowed_ids = utils.get_allowed_ids(self.datasource, self.roles)
+        self.assertEqual(
+            allowed_ids['tables'],
+            set(models.Table.objects.filter(data_source=self.datasource).values_list('id', flat=True)))
+        self.assertFalse(allowed_ids['denied_tables'])
+
+
+class CacheWarmingTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        utils._mdb_cache.clear()
+        for key in utils._mdb_cache_metrics:
+            utils._mdb_cache_metrics[key] = 0
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        organisation, _ = super().create_organisation(self.user)
+        super().create_organisationdatasource(self.datasource, organisation)
+        self.group = Group.objects.create(name='sales')
+        self.user.groups.add(self.group)
+        other_user = User.objects.create_user(username='otheruser', password='12345')
+        OrganisationUser.objects.create(user=other_user, organisation=organisation)
+
+    def test_active_role_sets(self):
+        self.assertEqual(utils.get_active_role_sets(self.datasource), [(), (self.group.id,)])
+
+    def test_warm_datasource_caches(self):
+        progress = []
+        report = utils.warm_datasource_caches(
+            self.datasource, workers=1,
+            progress=lambda done, total, role_ids, error: progress.append((done, total, error)))
+        self.assertEqual(report['warmed'], 2)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(progress, [(1, 2, None), (2, 2, None)])
+        misses = utils.get_mdb_cache_metrics()['misses']
+        roles = self.user.groups.all()
+        utils.prepare_mdb(self.datasource, roles)
+        with self.assertNumQueries(1):
+            utils.get_schema(self.datasource, roles)
+        self.assertEqual(utils.get_mdb_cache_metrics()['misses'], misses)
+
+    def test_acl_changes_schedule_one_warming(self):
+        with patch('terno.receivers.warm_caches.apply_async') as apply_async, \
+                self.captureOnCommitCallbacks(execute=True):
+            selector = models.PrivateTableSelector.objects.create(data_source=self.datasource)
+            selector.tables.add(models.Table.objects.get(data_source=self.datasource, name='Album'))
+            selector.tables.add(models.Table.objects.get(data_source=self.datasource, name='Track'))
+        apply_async.assert_called_once_with(
+            (self.datasource.id,), countdown=settings.CACHE_WARMING_DELAY)
+
+    def test_warm_caches_command(self):
+        out = io.StringIO()
+        call_command('warm_caches', datasources=[self.datasource.id], workers=1, stdout=out)
+        self.assertIn('[2/2]', out.getvalue())
+        self.assertIn('Caches warmed.', out.getvalue())
+
+
+class SyncMetadataTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.datasource = super().create_datasource()
+
+    def reflected_mdb(self):
+        # The stored metadata, as if reflected again
+        return utils.generate_mdb(self.datasource)
+
+    def test_unchanged_schema(self):
+        table_ids = set(models.Table.objects.values_list('id', flat=True))
+        fk_count = models.ForeignKey.objects.count()
+        report = utils.sync_datasource_metadata(self.datasource, self.reflected_mdb())
+        self.assertEqual(report['changed_tables'], [])
+        self.assertEqual(report['columns'], {'added': 0, 'updated': 0, 'deleted': 0})
+        self.assertEqual(report['foreign_keys'], {'added': 0, 'deleted': 0})
+        self.assertEqual(set(models.Table.objects.values_list('id', flat=True)), table_ids)
+        self.assertEqual(models.ForeignKey.objects.count(), fk_count)
+
+    def test_changes_are_applied(self):
+        album = models.Table.objects.get(data_source=self.datasource, name='Album')
+        models.Table.objects.filter(id=album.id).update(public_name='Albums')
+        mdb = self.reflected_mdb()
+        del mdb.tables['InvoiceLine']
+        mdb.tables['Album'].drop_columns(['Title'])
+        mdb.tables['Artist'].columns['Name'].type = 'TEXT'
+        column = {'type': 'INTEGER', 'primary_key': '', 'nullable': '', 'desc': ''}
+        new_mdb = MDatabase.from_data(
+            {'Label': {'name': 'Label', 'public_name': 'Label', 'description': None},
+             'Artist': {'name': 'Artist', 'public_name': 'Artist', 'description': None}},
+            {'Label': [dict(column, name='LabelId', pub_name='LabelId'),
+                       dict(column, name='ArtistId', pub_name='ArtistId')],
+             'Artist': [dict(column, name='ArtistId', pub_name='ArtistId')]},
+            {'Label': [{'constrained_columns': ['ArtistId'], 'referred_table': 'Artist',
+                        'referred_columns': ['ArtistId'], 'referred_schema': ''}],
+             'Artist': []})
+        mdb.tables['Label'] = new_mdb.tables['Label']
+
+        report = utils.sync_datasource_metadata(self.datasource, mdb)
+        self.assertEqual(report['tables'], {'added': ['Label'], 'deleted': ['InvoiceLine']})
+        self.assertEqual(report['columns'], {'added': 2, 'updated': 1, 'deleted': 1})
+        # The foreign keys of InvoiceLine went with it
+        self.assertEqual(report['foreign_keys'], {'added': 1, 'deleted': 0})
+        self.assertEqual(report['changed_tables'], ['Album', 'Artist', 'Label'])
+
+        tables = models.Table.objects.filter(data_source=self.datasource)
+        self.assertFalse(tables.filter(name='InvoiceLine').exists())
+        self.assertEqual(tables.get(name='Album'), album)
+        self.assertEqual(tables.get(name='Album').public_name, 'Albums')
+        self.assertFalse(models.TableColumn.objects.filter(table=album, name='Title').exists())
+        self.assertEqual(models.TableColumn.objects.get(
+            table__data_source=self.datasource, table__name='Artist', name='Name').data_type, 'TEXT')
+        self.assertTrue(models.ForeignKey.objects.filter(
+            constrained_table__name='Label', constrained_table__data_source=self.datasource,
+            referred_table__name='Artist').exists())
+        report = utils.sync_datasource_metadata(self.datasource, mdb)
+        self.assertEqual(report['changed_tables'], [])
+
+    def test_queries_do_not_grow_with_schema(self):
+        mdb = self.reflected_mdb()
+        mdb.tables['Album'].drop_columns(['Title'])
+        with CaptureQueriesContext(connection) as queries:
+            utils.sync_datasource_metadata(self.datasource, mdb)
+        self.assertLess(len(queries), 20)
+
+
+class IncrementalReflectionTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.datasource = super().create_datasource()
+
+    def load_metadata(self, **kwargs):
+        with patch('terno.tasks.is_ERP') as is_ERP, patch('terno.tasks.warm_caches.delay'):
+            report = load_metadata(self.datasource.id, **kwargs)
+        return report, is_ERP
+
+    def test_fingerprints_are_stored(self):
+        self.assertFalse(models.Table.objects.filter(
+            data_source=self.datasource, schema_fingerprint__isnull=True).exists())
+
+    def test_unchanged_tables_are_not_reflected(self):
+        version = utils.get_metadata_version(self.datasource)
+        report, is_ERP = self.load_metadata()
+        self.assertEqual(report['reflected_tables'], 0)
+        self.assertEqual(report['changed_tables'], [])
+        is_ERP.assert_not_called()
+        self.assertEqual(utils.get_metadata_version(self.datasource), version)
+
+    def test_only_changed_tables_are_reflected(self):
+        models.Table.objects.filter(data_source=self.datasource, name='Album').update(
+            schema_fingerprint='outdated')
+        # Stored, but no longer in the database
+        models.Table.objects.create(name='Dropped', data_source=self.datasource)
+        version = utils.get_metadata_version(self.datasource)
+        report, is_ERP = self.load_metadata()
+        # Album and Artist, which it refers to
+        self.assertEqual(report['reflected_tables'], 2)
+        self.assertEqual(report['tables']['deleted'], ['Dropped'])
+        self.assertEqual(report['changed_tables'], [])
+        is_ERP.assert_called_once_with(self.datasource.id)
+        self.assertGreater(utils.get_metadata_version(self.datasource), version)
+        self.assertNotEqual(models.Table.objects.get(
+            data_source=self.datasource, name='Album').schema_fingerprint, 'outdated')
+        # Foreign keys of tables that were not reflected are kept
+        self.assertTrue(models.ForeignKey.objects.filter(
+            constrained_table__data_source=self.datasource,
+            constrained_table__name='Track').exists())
+
+    def test_full_reflection(self):
+        report, _ = self.load_metadata(full=True)
+        self.assertEqual(report['reflected_tables'],
+                         models.Table.objects.filter(data_source=self.datasource).count())
+        self.assertEqual(report['changed_tables'], [])
+
+    def test_changed_tables_are_described_again(self):
+        tables = models.Table.objects.filter(data_source=self.datasource)
+        tables.update(complete_description=True)
+        tables.filter(name='Album').update(schema_fingerprint='outdated')
+        models.TableColumn.objects.filter(table__in=tables, table__name='Album',
+                                          name='Title').update(data_type='TEXT')
+        with patch('terno.tasks.generate_table_and_column_descriptions_task') as task, \
+                patch('terno.tasks.warm_caches') as warm_caches, \
+                patch('terno.tasks.is_ERP') as is_ERP:
+            report = load_metadata(self.datasource.id)
+        self.assertEqual(report['changed_tables'], ['Album'])
+        task.delay.assert_called_once_with(
+            datasource_id=self.datasource.id, input_table_names=['Album'])
+        self.assertEqual(list(tables.filter(complete_description=False).values_list(
+            'name', flat=True)), ['Album'])
+        warm_caches.delay.assert_called_once_with(self.datasource.id)
+        # No table was added or deleted
+        is_ERP.assert_not_called()
+
+    def test_sqlite_fingerprint_follows_alter_table(self):
+        db_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, db_dir)
+        engine = create_engine(f"sqlite:///{os.path.join(db_dir, 'test.db')}")
+        with engine.begin() as con:
+            con.execute(text("CREATE TABLE a (id INTEGER PRIMARY KEY)"))
+            con.execute(text("CREATE TABLE b (id INTEGER PRIMARY KEY)"))
+        fingerprints = utils.get_table_fingerprints(engine)
+        with engine.begin() as con:
+            con.execute(text("ALTER TABLE a ADD COLUMN name TEXT"))
+        changed = utils.get_table_fingerprints(engine)
+        engine.dispose()
+        self.assertNotEqual(changed['a'], fingerprints['a'])
+        self.assertEqual(changed['b'], fingerprints['b'])
+
+
+class TableDataFormatTestCase(TestCase):
+    def setUp(self) -> None:
+        self.factory = RequestFactory()
+        self.table_data = {
+            'columns': ['id', 'price', 'created'],
+            'total_pages': 1,
+            'row_count': 2,
+            'row_count_status': 'exact',
+            'page': 1,
+            'data': [
+                {'id': 1, 'price': Decimal('1.50'), 'created': datetime.date(2024, 1, 2)},
+                {'id': 2, 'price': None, 'created': datetime.date(2024, 3, 4)},
+            ],
+        }
+
+    def test_get_table_data_format(self):
+        request = self.factory.post('/', HTTP_ACCEPT=utils.ARROW_STREAM_CONTENT_TYPE)
+        self.assertEqual(utils.get_table_data_format(request, {}), 'arrow')
+        self.assertEqual(utils.get_table_data_format(request, {'format': 'columnar'}), 'columnar')
+        request = self.factory.post('/')
+        self.assertEqual(utils.get_table_data_format(request, {}), 'rows')
+        self.assertEqual(utils.get_table_data_format(request, {'format': 'invalid'}), 'rows')
+
+    def test_columnar_response(self):
+        request = self.factory.post('/')
+        response = utils.table_data_response(request, self.table_data, 'columnar')
+        table_data = json.loads(response.content)['table_data']
+        self.assertEqual(table_data['format'], 'columnar')
+        self.assertEqual(table_data['columns'], ['id', 'price', 'created'])
+        self.assertEqual(table_data['data'], [
+            [1, 2], ['1.50', None], ['2024-01-02', '2024-03-04']])
+        self.assertEqual(table_data['row_count'], 2)
+
+    def test_arrow_response(self):
+        request = self.factory.post('/')
+        response = utils.table_data_response(request, self.table_data, 'arrow')
+        self.assertEqual(response['Content-Type'], utils.ARROW_STREAM_CONTENT_TYPE)
+        table = pa.ipc.open_stream(response.content).read_all()
+        self.assertEqual(table.column_names, ['id', 'price', 'created'])
+        self.assertEqual(table.column('price').to_pylist(), [Decimal('1.50'), None])
+        details = json.loads(table.schema.metadata[b'terno'])
+        self.assertEqual(details['row_count'], 2)
+
+    def test_gzip_response(self):
+        self.table_data['data'] = self.table_data['data'] * 50
+        request = self.factory.post('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = utils.table_data_response(request, self.table_data)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        table_data = json.loads(gzip.decompress(response.content))['table_data']
+        self.assertEqual(len(table_data['data']), 100)
+        self.assertEqual(table_data['data'][0]['price'], '1.50')
+
+
 class ExportResultTestCase(BaseTestCase):
     def setUp(self) -> None:
         self.ds = super().create_datasource()
@@ -376,17 +1768,51 @@ class ExportResultTestCase(BaseTestCase):
     def test_export_native_sql_result(self):
         native_sql = 'SELECT * FROM Album;'
         response = utils.export_native_sql_result(self.ds, native_sql)
-        self.assertIsInstance(response, HttpResponse)
+        self.assertIsInstance(response, StreamingHttpResponse)
         self.assertEqual(response['Content-Type'], 'text/csv')
 
         # Check CSV content
-        content = response.content.decode('utf-8')
+        content = b''.join(response.streaming_content).decode('utf-8')
         csv_reader = csv.reader(io.StringIO(content))
         rows = list(csv_reader)
 
         self.assertEqual(rows[0], ['AlbumId', 'Title', 'ArtistId'])
         self.assertEqual(rows[1], ['1', 'For Those About To Rock We Salute You', '1'])
         self.assertEqual(rows[2], ['2', 'Balls to the Wall', '2'])
+        self.assertEqual(len(rows), 348)
+
+    @patch.object(settings, 'EXPORT_CHUNK_SIZE', 100)
+    def test_export_native_sql_result_gzip(self):
+        native_sql = 'SELECT * FROM Album;'
+        response = utils.export_native_sql_result(self.ds, native_sql,
+                                                  compress=True)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('.csv.gz', response['Content-Disposition'])
+
+        content = gzip.decompress(b''.join(response.streaming_content))
+        rows = list(csv.reader(io.StringIO(content.decode('utf-8'))))
+        self.assertEqual(rows[0], ['AlbumId', 'Title', 'ArtistId'])
+        self.assertEqual(len(rows), 348)
+
+    def test_export_stopped_while_streaming(self):
+        user = super().create_user()
+        organisation, _ = super().create_organisation(user)
+        super().create_organisationdatasource(self.ds, organisation)
+        request = RequestFactory().post('/', content_type='application/json', data=json.dumps(
+            {'sql': 'SELECT * FROM Album', 'datasourceId': self.ds.id}))
+        request.org_id = organisation.id
+        request.user = user
+
+        def stream_native_sql(*args):
+            yield ['AlbumId']
+            yield [(1,)]
+            raise utils.StatementTimeoutException("Query exceeded the statement timeout.")
+        with patch('terno.utils.stream_native_sql', side_effect=stream_native_sql):
+            response = views.export_sql_result(request)
+            with self.assertRaises(utils.StatementTimeoutException):
+                b''.join(response.streaming_content)
+        self.assertTrue(models.QueryHistory.objects.filter(
+            data_type='timed_out_sql', data_source=self.ds).exists())
 
 
 class SubstituteTestCase(BaseTestCase):
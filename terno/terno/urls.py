@@ -7,14 +7,20 @@ app_name = 'terno'
 
 urlpatterns = [
     path('', views.index, name='index'),
-    path('console', views.console, name='console'),
+    path('console', views.aconsole if settings.ASYNC_VIEWS else views.console, name='console'),
     path('settings', views.usersettings, name='usersettings'),
     path('get-datasources', views.get_datasources, name='get_datasources'),
-    path('get-sql/', views.get_sql, name='get_sql'),
-    path('execute-sql', views.execute_sql, name='execute_sql'),
+    path('get-sql/', views.aget_sql if settings.ASYNC_VIEWS else views.get_sql, name='get_sql'),
+    path('execute-sql', views.aexecute_sql if settings.ASYNC_VIEWS else views.execute_sql,
+         name='execute_sql'),
     path('export-sql-result', views.export_sql_result, name='export_sql_result'),
+    path('cancel-sql', views.cancel_sql, name='cancel_sql'),
+    path('query-jobs/<uuid:job_id>', views.query_job_status, name='query_job_status'),
+    path('query-jobs/<uuid:job_id>/page', views.query_job_page, name='query_job_page'),
+    path('query-jobs/<uuid:job_id>/cancel', views.query_job_cancel, name='query_job_cancel'),
     path('get-tables/<int:datasource_id>', views.get_tables, name='get_tables'),
     path('get-user-details/', views.get_user_details, name='get_user_details'),
+    path('metrics', views.get_metrics, name='get_metrics'),
     path('sso-login', views.sso_login, name='sso_login'),
     path('file-upload', views.file_upload, name='file_upload'),
     path('datasources/<str:ds_id>/', views.get_datasource_name, name="get-datasource-name"),
@@ -1,10 +1,30 @@
 import io
+import os
 import re
+import json
+import pickle
+import time
+import hashlib
+import threading
+import contextlib
+import concurrent.futures
+import itertools
+import zlib
+import collections
+import asyncio
+import functools
+import copy
+import uuid
+import datetime
+import decimal
 import terno.models as models
-from django.contrib.auth.models import Group, Permission
+from django.contrib.auth.models import User, Group, Permission
 from sqlshield.shield import Session
 from sqlshield.models import MDatabase
 import sqlalchemy
+import sqlglot
+import pyarrow as pa
+import pyarrow.ipc
 from terno.llm.base import LLMFactory
 import math
 from django.template import Template, Context, Engine
@@ -13,9 +33,15 @@ from terno.pipeline.pipeline import Pipeline
 from terno.pipeline.step import Step
 from terno.prompt import query_generation
 import csv
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
 from django.utils import timezone
 from django.core.cache import cache
+from django import db
+from django.db.models import QuerySet
+from asgiref.sync import sync_to_async
 from terno.llm.base import NoSufficientCreditsException, NoDefaultLLMException
 from subscription.models import LLMCredit
 from subscription.utils import deduct_llm_credits
@@ -27,71 +53,1013 @@ from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String,
 logger = logging.getLogger(__name__)
 
 
-def create_db_engine(db_type, connection_string, **kwargs):
+def create_db_engine(db_type, connection_string, credentials_info=None,
+                     **engine_kwargs):
     if db_type == 'bigquery':
-        credentials_info = kwargs.get('credentials_info')
         if not credentials_info:
             raise ValueError("BigQuery requires credentials_info")
-        engine = sqlalchemy.create_engine(connection_string, credentials_info=credentials_info)
+        engine = sqlalchemy.create_engine(connection_string,
+                                          credentials_info=credentials_info,
+                                          **engine_kwargs)
     else:
-        engine = sqlalchemy.create_engine(connection_string)
+        engine = sqlalchemy.create_engine(connection_string, **engine_kwargs)
 
     return engine
 
 
+# Process wide registry of pooled engines.
+# key: datasource id, value: {'key': connection hash, 'engine': engine, 'metrics': {...}}
+_datasource_engines = {}
+_datasource_engines_lock = threading.Lock()
+
+
+def _get_connection_hash(datasource):
+    connection_json = json.dumps(datasource.connection_json, sort_keys=True)
+    connection = f"{datasource.type}|{datasource.connection_str}|{connection_json}"
+    return hashlib.sha256(connection.encode('utf-8')).hexdigest()
+
+
+def _get_pool_kwargs(connection_string):
+    pool_kwargs = {
+        'pool_pre_ping': settings.DATASOURCE_POOL_PRE_PING,
+        'pool_recycle': settings.DATASOURCE_POOL_RECYCLE,
+    }
+    url = sqlalchemy.engine.make_url(connection_string)
+    pool_class = url.get_dialect().get_pool_class(url)
+    # Only QueuePool accepts size limits, e.g. in-memory SQLite does not.
+    if issubclass(pool_class, sqlalchemy.pool.QueuePool):
+        pool_kwargs.update({
+            'pool_size': settings.DATASOURCE_POOL_SIZE,
+            'max_overflow': settings.DATASOURCE_POOL_MAX_OVERFLOW,
+            'pool_timeout': settings.DATASOURCE_POOL_TIMEOUT,
+        })
+    return pool_kwargs
+
+
+def _add_pool_listeners(engine, metrics):
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        metrics['connects'] += 1
+
+    @sqlalchemy.event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics['checkouts'] += 1
+
+    @sqlalchemy.event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        metrics['checkins'] += 1
+
+
+def get_datasource_engine(datasource):
+    """
+    Returns the pooled engine for the datasource, creating it on first use.
+    The engine is recreated when the connection details of the datasource
+    change.
+    """
+    connection_hash = _get_connection_hash(datasource)
+    with _datasource_engines_lock:
+        entry = _datasource_engines.get(datasource.id)
+        if entry is not None and entry['key'] == connection_hash:
+            return entry['engine']
+        if entry is not None:
+            entry['engine'].dispose()
+
+        engine = create_db_engine(datasource.type, datasource.connection_str,
+                                  credentials_info=datasource.connection_json,
+                                  **_get_pool_kwargs(datasource.connection_str))
+        metrics = {
+            'connects': 0,
+            'checkouts': 0,
+            'checkins': 0,
+            'waits': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0,
+        }
+        _add_pool_listeners(engine, metrics)
+        _datasource_engines[datasource.id] = {
+            'key': connection_hash,
+            'engine': engine,
+            'metrics': metrics,
+        }
+        return engine
+
+
+def dispose_datasource_engine(datasource_id):
+    with _datasource_engines_lock:
+        entry = _datasource_engines.pop(datasource_id, None)
+    if entry is not None:
+        entry['engine'].dispose()
+
+
+@contextlib.contextmanager
+def datasource_connection(datasource):
+    """
+    Checks out a connection from the datasource pool and records how long
+    the checkout waited.
+    """
+    engine = get_datasource_engine(datasource)
+    start = time.monotonic()
+    with engine.connect() as con:
+        wait_time = time.monotonic() - start
+        entry = _datasource_engines.get(datasource.id)
+        if entry is not None:
+            metrics = entry['metrics']
+            metrics['waits'] += 1
+            metrics['total_wait_time'] += wait_time
+            metrics['max_wait_time'] = max(metrics['max_wait_time'], wait_time)
+        yield con
+
+
+class StatementTimeoutException(Exception):
+    pass
+
+
+class StatementCancelledException(Exception):
+    pass
+
+
+# key: request id, value: state of the statement running in this process
+_running_statements = {}
+
+
+def get_statement_timeout(datasource):
+    if datasource.statement_timeout is not None:
+        return datasource.statement_timeout
+    return settings.DEFAULT_STATEMENT_TIMEOUT
+
+
+def _get_running_statement_cache_key(request_id):
+    return f"running_statement_{request_id}"
+
+
+def _get_cancelled_statement_cache_key(request_id):
+    return f"cancelled_statement_{request_id}"
+
+
+def _set_bigquery_job_timeout(dbapi_connection, timeout_ms):
+    from google.cloud import bigquery
+    client = dbapi_connection._client
+    job_config = client.default_query_job_config or bigquery.QueryJobConfig()
+    job_config.job_timeout_ms = timeout_ms
+    client.default_query_job_config = job_config
+
+
+@contextlib.contextmanager
+def statement_guard(con, datasource, request_id=None, user_id=None):
+    """
+    Applies the statement timeout of the datasource to `con` in the
+    dialect native way and, when a request_id is given, registers the
+    statement so that `cancel_statement` can kill it.
+
+    Raises StatementTimeoutException or StatementCancelledException
+    instead of the driver error when the statement was stopped.
+    """
+    timeout = get_statement_timeout(datasource)
+    timeout_ms = int(timeout * 1000)
+    state = {
+        'user_id': user_id,
+        'cancelled': False,
+        'deadline': time.monotonic() + timeout if timeout else None,
+        'interrupt': None,
+    }
+    dialect = con.dialect.name
+    dbapi_connection = con.connection.dbapi_connection
+    connection_id = None
+
+    def is_stopped():
+        if state['cancelled']:
+            return True
+        return state['deadline'] is not None and time.monotonic() > state['deadline']
+
+    # The connection id is only needed to cancel from another process
+    if dialect == 'postgresql':
+        if timeout_ms:
+            # Local to the transaction, reset when the connection is returned
+            con.execute(sqlalchemy.text(f"SET LOCAL statement_timeout = {timeout_ms}"))
+        if request_id is not None:
+            connection_id = con.execute(sqlalchemy.text("SELECT pg_backend_pid()")).scalar()
+        state['interrupt'] = getattr(dbapi_connection, 'cancel', None)
+    elif dialect == 'mysql':
+        if timeout_ms:
+            # Saved in the same round trip, the session may have its own value
+            con.execute(sqlalchemy.text(
+                "SET @terno_max_execution_time = @@SESSION.max_execution_time, "
+                f"SESSION max_execution_time = {timeout_ms}"))
+        if request_id is not None:
+            connection_id = con.execute(sqlalchemy.text("SELECT CONNECTION_ID()")).scalar()
+            # The driver cannot cancel, the statement is killed server side
+            state['interrupt'] = functools.partial(
+                _kill_statement, datasource, dialect, connection_id)
+    elif dialect == 'sqlite':
+        dbapi_connection.set_progress_handler(lambda: 1 if is_stopped() else 0, 1000)
+        state['interrupt'] = dbapi_connection.interrupt
+    elif dialect == 'bigquery' and timeout_ms:
+        try:
+            _set_bigquery_job_timeout(dbapi_connection, timeout_ms)
+        except Exception as e:
+            logger.warning(f"Could not set BigQuery job timeout: {e}")
+
+    if request_id is not None:
+        _running_statements[request_id] = state
+        if connection_id is not None:
+            cache.set(_get_running_statement_cache_key(request_id), {
+                'datasource_id': datasource.id,
+                'dialect': dialect,
+                'connection_id': connection_id,
+                'user_id': user_id,
+            }, timeout=timeout or None)
+    try:
+        yield state
+    except Exception as e:
+        if state['cancelled'] or (request_id is not None and cache.get(
+                _get_cancelled_statement_cache_key(request_id))):
+            raise StatementCancelledException("Query was cancelled.") from e
+        if state['deadline'] is not None and time.monotonic() >= state['deadline']:
+            raise StatementTimeoutException(
+                f"Query exceeded the statement timeout of {timeout} seconds.") from e
+        raise
+    finally:
+        if request_id is not None:
+            _running_statements.pop(request_id, None)
+            cache.delete(_get_running_statement_cache_key(request_id))
+        try:
+            if dialect == 'sqlite':
+                dbapi_connection.set_progress_handler(None, 1000)
+            elif dialect == 'mysql' and timeout_ms:
+                con.execute(sqlalchemy.text(
+                    "SET SESSION max_execution_time = @terno_max_execution_time"))
+        except Exception as e:
+            logger.warning(f"Could not reset statement timeout: {e}")
+
+
+@contextlib.contextmanager
+def deadline_paused(state):
+    """
+    Stops the clock of the statement guarded by `statement_guard` while
+    the database is idle, e.g. while a generator waits at a yield for a
+    slow consumer.
+    """
+    paused_at = time.monotonic()
+    try:
+        yield
+    finally:
+        if state['deadline'] is not None:
+            state['deadline'] += time.monotonic() - paused_at
+
+
+def cancel_statement(request_id, user_id=None):
+    """
+    Kills the statement registered under request_id. Statements running
+    in another process are killed server side (Postgres and MySQL), this
+    needs a cache shared between the processes.
+    Returns True if a running statement was found.
+    """
+    state = _running_statements.get(request_id)
+    if state is not None:
+        if user_id is not None and state['user_id'] not in (None, user_id):
+            return False
+        state['cancelled'] = True
+        if state['interrupt'] is not None:
+            state['interrupt']()
+        return True
+
+    handle = cache.get(_get_running_statement_cache_key(request_id))
+    if handle is None:
+        return False
+    if user_id is not None and handle['user_id'] not in (None, user_id):
+        return False
+    cache.set(_get_cancelled_statement_cache_key(request_id), True, timeout=600)
+    datasource = models.DataSource.objects.get(id=handle['datasource_id'])
+    _kill_statement(datasource, handle['dialect'], handle['connection_id'])
+    return True
+
+
+def _kill_statement(datasource, dialect, connection_id):
+    # Server side, from another connection
+    with datasource_connection(datasource) as con:
+        connection_id = int(connection_id)
+        if dialect == 'postgresql':
+            con.execute(sqlalchemy.text(f"SELECT pg_cancel_backend({connection_id})"))
+        elif dialect == 'mysql':
+            con.execute(sqlalchemy.text(f"KILL QUERY {connection_id}"))
+
+
+class DatasourceBusyException(Exception):
+    pass
+
+
+ADMISSION_PRIORITIES = ('interactive', 'export')
+
+# key: datasource id, value: admission counters of this process
+_admission_metrics = {}
+_admission_metrics_lock = threading.Lock()
+
+
+def get_max_concurrent_queries(datasource):
+    if datasource.max_concurrent_queries is not None:
+        return datasource.max_concurrent_queries
+    return settings.DATASOURCE_MAX_CONCURRENT_QUERIES
+
+
+def _get_admission_slot_cache_key(datasource_id, slot):
+    return f"datasource_{datasource_id}_admission_slot_{slot}"
+
+
+def _get_admission_waiter_cache_key(datasource_id, position):
+    return f"datasource_{datasource_id}_admission_waiter_{position}"
+
+
+def _take_queue_position(datasource_id, priority, token):
+    # A waiter holds a position of the queue as a lease it refreshes while
+    # waiting, so the position of a killed process expires
+    for position in range(settings.ADMISSION_QUEUE_SIZE):
+        key = _get_admission_waiter_cache_key(datasource_id, position)
+        if cache.add(key, (priority, token), timeout=settings.ADMISSION_WAITER_LEASE):
+            return key
+    return None
+
+
+def _refresh_queue_position(datasource_id, priority, token, key):
+    if key is not None and cache.get(key) == (priority, token) \
+            and cache.touch(key, settings.ADMISSION_WAITER_LEASE):
+        return key
+    # Expired, and possibly taken by another waiter
+    return _take_queue_position(datasource_id, priority, token)
+
+
+def _leave_queue(priority, token, key):
+    if key is not None and cache.get(key) == (priority, token):
+        cache.delete(key)
+
+
+def get_admission_queue_depth(datasource_id, priority=None):
+    keys = [_get_admission_waiter_cache_key(datasource_id, position)
+            for position in range(settings.ADMISSION_QUEUE_SIZE)]
+    return sum(1 for waiter_priority, _ in cache.get_many(keys).values()
+               if priority in (None, waiter_priority))
+
+
+def _acquire_admission_slot(datasource_id, limit, token):
+    # cache.add is atomic, so only one request can take a slot
+    for slot in range(limit):
+        key = _get_admission_slot_cache_key(datasource_id, slot)
+        if cache.add(key, token, timeout=settings.ADMISSION_SLOT_LEASE):
+            return key
+    return None
+
+
+def _record_admission(datasource_id, outcome, wait_time=0):
+    with _admission_metrics_lock:
+        metrics = _admission_metrics.setdefault(datasource_id, {
+            'admitted': 0,
+            'queued': 0,
+            'rejected': 0,
+            'timed_out': 0,
+            'total_wait_time': 0,
+            'max_wait_time': 0,
+        })
+        metrics[outcome] += 1
+        metrics['total_wait_time'] += wait_time
+        metrics['max_wait_time'] = max(metrics['max_wait_time'], wait_time)
+
+
+@contextlib.contextmanager
+def admission_slot(datasource, priority='interactive', wait=True):
+    """
+    Limits the number of queries running on a datasource at the same time
+    to its max_concurrent_queries. Requests over the limit wait in a queue
+    of at most ADMISSION_QUEUE_SIZE, exports only take a free slot while
+    no interactive request is waiting. Without wait, only a free slot is
+    taken.
+
+    Slots live in the cache, so the limit holds across processes when the
+    cache is shared. Raises DatasourceBusyException when the queue is full
+    or the wait exceeds ADMISSION_QUEUE_TIMEOUT.
+    """
+    limit = get_max_concurrent_queries(datasource)
+    if not limit:
+        yield
+        return
+
+    datasource_id = datasource.id
+    token = uuid.uuid4().hex
+
+    def can_acquire():
+        if priority != 'interactive' and get_admission_queue_depth(
+                datasource_id, 'interactive') > 0:
+            return None
+        return _acquire_admission_slot(datasource_id, limit, token)
+
+    start = time.monotonic()
+    slot_key = can_acquire()
+    if slot_key is None and not wait:
+        raise DatasourceBusyException("Datasource is busy, please try again later.")
+    if slot_key is None:
+        position_key = _take_queue_position(datasource_id, priority, token)
+        if position_key is None:
+            _record_admission(datasource_id, 'rejected')
+            raise DatasourceBusyException(
+                "Datasource is busy, please try again later.")
+        try:
+            _record_admission(datasource_id, 'queued')
+            logger.info(f"Queued query on datasource {datasource_id} at depth "
+                        f"{get_admission_queue_depth(datasource_id)}")
+            deadline = start + settings.ADMISSION_QUEUE_TIMEOUT
+            while slot_key is None:
+                if time.monotonic() >= deadline:
+                    _record_admission(datasource_id, 'timed_out',
+                                      time.monotonic() - start)
+                    raise DatasourceBusyException(
+                        "Datasource is busy, timed out waiting for a free slot.")
+                time.sleep(settings.ADMISSION_POLL_INTERVAL)
+                position_key = _refresh_queue_position(
+                    datasource_id, priority, token, position_key)
+                if priority == 'interactive':
+                    slot_key = _acquire_admission_slot(datasource_id, limit, token)
+                else:
+                    slot_key = can_acquire()
+        finally:
+            _leave_queue(priority, token, position_key)
+
+    _record_admission(datasource_id, 'admitted', time.monotonic() - start)
+    try:
+        yield
+    finally:
+        # The slot may have expired and been taken by another request
+        if cache.get(slot_key) == token:
+            cache.delete(slot_key)
+
+
+def get_admission_metrics():
+    with _admission_metrics_lock:
+        admission_metrics = {
+            datasource_id: dict(metrics)
+            for datasource_id, metrics in _admission_metrics.items()}
+    for datasource_id, metrics in admission_metrics.items():
+        metrics['queue_depth'] = {
+            priority: get_admission_queue_depth(datasource_id, priority)
+            for priority in ADMISSION_PRIORITIES}
+        admitted = metrics['admitted']
+        metrics['avg_wait_time'] = metrics['total_wait_time'] / admitted if admitted else 0
+    return admission_metrics
+
+
+# Bounded pool for blocking calls made from async views
+_blocking_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.ASYNC_BLOCKING_WORKERS, thread_name_prefix='terno-blocking')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking call, e.g. a DB-API round trip or sqlglot, in the
+    bounded thread pool so that it does not block the event loop.
+    `func` must not use the Django ORM, use sync_to_async for that.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _blocking_executor, functools.partial(func, *args, **kwargs))
+
+
+def get_engine_pool_metrics():
+    pool_metrics = {}
+    with _datasource_engines_lock:
+        entries = list(_datasource_engines.items())
+    for datasource_id, entry in entries:
+        pool = entry['engine'].pool
+        metrics = dict(entry['metrics'])
+        metrics['pool'] = pool.status()
+        if isinstance(pool, sqlalchemy.pool.QueuePool):
+            metrics['size'] = pool.size()
+            metrics['checked_out'] = pool.checkedout()
+            metrics['overflow'] = pool.overflow()
+        pool_metrics[datasource_id] = metrics
+    return pool_metrics
+
+
+def get_mdb_cache_key(datasource, role_ids):
+    version = get_metadata_version(datasource)
+    return f"datasource_{datasource.id}_v{version}_roles_{'_'.join(map(str, role_ids))}"
+
+
+# Unpickled MDatabases by cache key, with their pickled size in bytes
+_mdb_cache = collections.OrderedDict()
+_mdb_cache_lock = threading.Lock()
+_mdb_cache_metrics = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def _get_local_mdb(cache_key):
+    with _mdb_cache_lock:
+        entry = _mdb_cache.get(cache_key)
+        if entry is None:
+            return None
+        _mdb_cache.move_to_end(cache_key)
+        _mdb_cache_metrics['local_hits'] += 1
+        return entry[0]
+
+
+def _set_local_mdb(cache_key, mDb, size):
+    with _mdb_cache_lock:
+        _mdb_cache[cache_key] = (mDb, size)
+        _mdb_cache.move_to_end(cache_key)
+        cache_bytes = sum(entry_size for _, entry_size in _mdb_cache.values())
+        # The newest entry is kept even if it alone is over the byte limit
+        while len(_mdb_cache) > 1 and (
+                len(_mdb_cache) > settings.MDB_LOCAL_CACHE_SIZE or
+                cache_bytes > settings.MDB_LOCAL_CACHE_MAX_BYTES):
+            _, (_, evicted_size) = _mdb_cache.popitem(last=False)
+            cache_bytes -= evicted_size
+            _mdb_cache_metrics['evictions'] += 1
+
+
+def _drop_local_mdbs(datasource):
+    prefix = f"datasource_{datasource.id}_"
+    with _mdb_cache_lock:
+        for cache_key in [key for key in _mdb_cache if key.startswith(prefix)]:
+            del _mdb_cache[cache_key]
+
+
+def get_mdb_cache_metrics():
+    with _mdb_cache_lock:
+        metrics = dict(_mdb_cache_metrics)
+        metrics['size'] = len(_mdb_cache)
+        metrics['bytes'] = sum(size for _, size in _mdb_cache.values())
+    lookups = metrics['local_hits'] + metrics['shared_hits'] + metrics['misses']
+    metrics['hit_ratio'] = (
+        (metrics['local_hits'] + metrics['shared_hits']) / lookups if lookups else 0)
+    return metrics
+
+
+def get_base_mdb(datasource):
+    """
+    Returns the MDatabase of all tables of the datasource, shared by every
+    role set through the per-process LRU and the shared cache.
+    """
+    cache_key = f"datasource_{datasource.id}_v{get_metadata_version(datasource)}_base"
+    mDb = _get_local_mdb(cache_key)
+    if mDb is not None:
+        return mDb
+
+    pickled_mdb = cache.get(cache_key)
+    if pickled_mdb is not None:
+        with _mdb_cache_lock:
+            _mdb_cache_metrics['shared_hits'] += 1
+        mDb = pickle.loads(pickled_mdb)
+    else:
+        with _mdb_cache_lock:
+            _mdb_cache_metrics['misses'] += 1
+        mDb = generate_mdb(datasource)
+        # Pickled here so the size is known for the local tier
+        pickled_mdb = pickle.dumps(mDb, protocol=pickle.HIGHEST_PROTOCOL)
+        cache.set(cache_key, pickled_mdb, timeout=settings.MDB_CACHE_TIMEOUT)
+    _set_local_mdb(cache_key, mDb, len(pickled_mdb))
+    return mDb
+
+
+def get_mdb_overlay(datasource, roles, role_ids):
+    """
+    Returns what sets the MDatabase of the roles apart from the base one,
+    the names of the hidden tables, the hidden column names by table name
+    and the row filters by table name. Its size grows with the ACL, not
+    with the schema.
+    """
+    cache_key = f"{get_mdb_cache_key(datasource, role_ids)}_overlay"
+    overlay = cache.get(cache_key)
+    if overlay is not None:
+        return overlay
+
+    allowed_ids = get_allowed_ids(datasource, roles)
+    drop_columns = {}
+    if allowed_ids['denied_columns']:
+        for table_name, name in models.TableColumn.objects.filter(
+                id__in=allowed_ids['denied_columns']).values_list('table__name', 'name'):
+            drop_columns.setdefault(table_name, []).append(name)
+    overlay = {
+        'denied_tables': set(models.Table.objects.filter(
+            id__in=allowed_ids['denied_tables']).values_list('name', flat=True))
+        if allowed_ids['denied_tables'] else set(),
+        'drop_columns': drop_columns,
+        'filters': get_table_filters(datasource, roles),
+    }
+    cache.set(cache_key, overlay, timeout=settings.MDB_CACHE_TIMEOUT)
+    return overlay
+
+
+def compose_mdb(base_mdb, overlay):
+    """
+    Returns an MDatabase of the tables of base_mdb not hidden by overlay.
+    Tables the overlay does not change are shared with base_mdb, the
+    others are copied before their columns and row filter are changed.
+    """
+    tables = {}
+    for name, table in base_mdb.tables.items():
+        if name in overlay['denied_tables']:
+            continue
+        drop_columns = overlay['drop_columns'].get(name)
+        filters = overlay['filters'].get(name)
+        if drop_columns or filters:
+            table = copy.copy(table)
+            table.columns = dict(table.columns)
+            if drop_columns:
+                table.drop_columns(drop_columns)
+            if filters:
+                table.filters = filters
+        tables[name] = table
+    mDb = MDatabase()
+    mDb.tables = tables
+    return mDb
+
+
 def prepare_mdb(datasource, roles):
+    """
+    Returns the MDatabase of the roles, composed from the base MDatabase
+    of the datasource and the overlay of the roles. Composed MDatabases
+    are kept in the per-process LRU only, the shared cache holds the base
+    and the overlays. Keys contain the metadata version kept in the shared
+    cache, so a process never uses an MDatabase of an older version.
+    The returned MDatabase is shared, callers must not modify it.
+    """
     role_ids = sorted(roles.values_list('id', flat=True))
-    cache_key = f"datasource_{datasource.id}_roles_{'_'.join(map(str, role_ids))}"
-    cached_mdb = cache.get(cache_key)
+    cache_key = get_mdb_cache_key(datasource, role_ids)
+    mDb = _get_local_mdb(cache_key)
+    if mDb is not None:
+        return mDb
+
+    overlay = get_mdb_overlay(datasource, roles, role_ids)
+    mDb = compose_mdb(get_base_mdb(datasource), overlay)
+    # Most tables are shared with the base, count the overlay only
+    _set_local_mdb(cache_key, mDb, len(pickle.dumps(overlay)))
+    return mDb
 
-    if cached_mdb is not None:
-        return cached_mdb
 
-    allowed_tables, allowed_columns = get_admin_config_object(datasource, roles)
+def estimate_tokens(text):
+    """
+    Rough prompt token count of text, about four characters per token
+    for English text and DDL.
+    """
+    return math.ceil(len(text) / 4)
+
 
-    mDb = generate_mdb(datasource)
-    mDb.keep_only_tables(allowed_tables.values_list('name', flat=True))
-    keep_only_columns(mDb, allowed_tables, allowed_columns)
+def get_schema_fragments(datasource, roles):
+    """
+    Returns table name -> (schema text, token estimate) of the MDatabase
+    of the roles, cached with it under the same metadata version.
+    """
+    role_ids = sorted(roles.values_list('id', flat=True))
+    cache_key = f"{get_mdb_cache_key(datasource, role_ids)}_schema_fragments"
+    fragments = cache.get(cache_key)
+    if fragments is None:
+        mDb = prepare_mdb(datasource, roles)
+        fragments = {}
+        for name, table in mDb.tables.items():
+            fragment = table.generate_schema()
+            fragments[name] = (fragment, estimate_tokens(fragment))
+        cache.set(cache_key, fragments, timeout=settings.MDB_CACHE_TIMEOUT)
+    return fragments
+
+
+def get_schema(datasource, roles, table_names=None):
+    """
+    Returns the schema text of the MDatabase of the roles for the prompt
+    and its token estimate, limited to table_names when given. Tables the
+    roles may not see are left out. Cached per table subset.
+    """
+    role_ids = sorted(roles.values_list('id', flat=True))
+    cache_key = f"{get_mdb_cache_key(datasource, role_ids)}_schema"
+    if table_names is not None:
+        table_names = sorted(set(table_names))
+        subset_hash = hashlib.sha256('\n'.join(table_names).encode()).hexdigest()
+        cache_key = f"{cache_key}_{subset_hash}"
+    schema = cache.get(cache_key)
+    if schema is not None:
+        return schema
+
+    fragments = get_schema_fragments(datasource, roles)
+    if table_names is None:
+        selected = list(fragments.values())
+    else:
+        wanted = set(table_names)
+        # In schema order, like MDatabase.generate_schema
+        selected = [fragment for name, fragment in fragments.items() if name in wanted]
+    schema = {
+        'schema': '\n'.join(fragment for fragment, _ in selected),
+        'tokens': sum(tokens for _, tokens in selected),
+    }
+    cache.set(cache_key, schema, timeout=settings.MDB_CACHE_TIMEOUT)
+    return schema
+
+
+def get_active_role_sets(datasource):
+    """
+    Returns the distinct sorted group id tuples of the users of the
+    organisations the datasource belongs to.
+    """
+    user_groups = {
+        user_id: set() for user_id in models.OrganisationUser.objects.filter(
+            organisation__organisationdatasource__datasource=datasource).values_list(
+                'user_id', flat=True)}
+    for user_id, group_id in User.groups.through.objects.filter(
+            user_id__in=list(user_groups)).values_list('user_id', 'group_id'):
+        user_groups[user_id].add(group_id)
+    return sorted({tuple(sorted(group_ids)) for group_ids in user_groups.values()})
 
-    tables = mDb.get_table_dict()
-    update_table_descriptions(tables)
-    update_filters(tables, datasource, roles)
 
-    cache.set(cache_key, mDb, timeout=3600)
+def _warm_role_set(datasource, role_ids):
+    roles = Group.objects.filter(id__in=role_ids)
+    get_allowed_ids(datasource, roles)
+    # Builds the MDatabase and its schema fragments on a miss
+    get_schema(datasource, roles)
 
-    return mDb
 
+def _warm_role_set_in_thread(datasource, role_ids):
+    try:
+        _warm_role_set(datasource, role_ids)
+    finally:
+        db.connection.close()
 
-def keep_only_columns(mDb, tables, columns):
-    '''
-    As there is no keep_only_columns method on mDb
-    we use the drop columns method on table
-    '''
-    for _, table in mDb.tables.items():
-        table_obj = tables.filter(name=table.name)
-        if table_obj:
-            table.pub_name = table_obj.first().public_name
-            keep_columns = columns.filter(table__name=table.name).values_list('name', flat=True)
-            table_columns = models.TableColumn.objects.filter(
-                table__in=table_obj).values_list('name', flat=True)
-            drop_columns = set(table_columns).difference(keep_columns)
-            table.drop_columns(drop_columns)
-            for _, col in table.columns.items():
-                allowed_column = columns.filter(table=table_obj.first(), name=col.name)
-                if allowed_column:
-                    col.pub_name = allowed_column.first().public_name
-
-
-def update_table_descriptions(tables):
-    for tbl_name, tbl_object in tables.items():
-        table_description = models.Table.objects.filter(
-            name=tbl_name).first().description
-        tbl_object.desc = table_description
+
+def get_cache_warming_cache_key(datasource_id):
+    return f"datasource_{datasource_id}_cache_warming_scheduled"
+
+
+def warm_datasource_caches(datasource, role_sets=None, workers=None, progress=None):
+    """
+    Builds the ACL index, MDatabase and schema text of every active role
+    set of the datasource, so the first question does not pay for them.
+    Up to `workers` role sets are warmed at once. `progress` is called
+    with (done, total, role_ids, error) after each role set.
+    """
+    if role_sets is None:
+        role_sets = get_active_role_sets(datasource)
+    if workers is None:
+        workers = settings.CACHE_WARMING_WORKERS
+    report = {'role_sets': len(role_sets), 'warmed': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    def record(done, role_ids, error):
+        if error is None:
+            report['warmed'] += 1
+        else:
+            report['failed'] += 1
+            logger.error(f"Warming datasource {datasource.id} for roles {list(role_ids)} failed: {error}")
+        if progress is not None:
+            progress(done, len(role_sets), role_ids, error)
+
+    if workers <= 1:
+        for done, role_ids in enumerate(role_sets, start=1):
+            try:
+                _warm_role_set(datasource, role_ids)
+                error = None
+            except Exception as e:
+                error = e
+            record(done, role_ids, error)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='terno-cache-warming') as executor:
+            futures = {
+                executor.submit(_warm_role_set_in_thread, datasource, role_ids): role_ids
+                for role_ids in role_sets}
+            for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                record(done, futures[future], future.exception())
+
+    report['elapsed'] = time.perf_counter() - start
+    logger.info(f"Warmed {report['warmed']} of {report['role_sets']} role sets of "
+                f"datasource {datasource.id} in {report['elapsed']:.2f}s")
+    return report
+
+
+def _new_metadata_report():
+    return {
+        'tables': {'added': [], 'deleted': []},
+        'columns': {'added': 0, 'updated': 0, 'deleted': 0},
+        'foreign_keys': {'added': 0, 'deleted': 0},
+        'changed_tables': [],
+    }
+
+
+def _sqlite_table_definitions(con):
+    # The CREATE TABLE statement holds the columns and constraints and
+    # is rewritten by ALTER TABLE
+    return dict(con.execute(sqlalchemy.text(
+        "SELECT name, sql FROM sqlite_master "
+        "WHERE type = 'table' AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'")).all())
+
+
+def _mysql_table_definitions(con):
+    definitions = {}
+    for table_name, *column in con.execute(sqlalchemy.text(
+            "SELECT c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.COLUMN_KEY "
+            "FROM information_schema.COLUMNS c JOIN information_schema.TABLES t "
+            "ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME "
+            "WHERE c.TABLE_SCHEMA = DATABASE() AND t.TABLE_TYPE = 'BASE TABLE' "
+            "ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION")):
+        definitions.setdefault(table_name, {'columns': [], 'foreign_keys': []})
+        definitions[table_name]['columns'].append(column)
+    for table_name, *fk in con.execute(sqlalchemy.text(
+            "SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, REFERENCED_TABLE_SCHEMA, "
+            "REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+            "FROM information_schema.KEY_COLUMN_USAGE "
+            "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL "
+            "ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION")):
+        if table_name in definitions:
+            definitions[table_name]['foreign_keys'].append(fk)
+    return definitions
+
+
+def _inspector_table_definitions(con):
+    inspector = sqlalchemy.inspect(con)
+    foreign_keys = inspector.get_multi_foreign_keys()
+    primary_keys = inspector.get_multi_pk_constraint()
+    definitions = {}
+    for (schema, table_name), columns in inspector.get_multi_columns().items():
+        definitions[table_name] = {
+            'columns': [[column['name'], str(column['type'])] for column in columns],
+            'primary_key': primary_keys.get((schema, table_name), {}).get(
+                'constrained_columns'),
+            'foreign_keys': sorted(
+                [fk['constrained_columns'], fk['referred_schema'], fk['referred_table'],
+                 fk['referred_columns']]
+                for fk in foreign_keys.get((schema, table_name), [])),
+        }
+    return definitions
+
+
+# The inspector reads SQLite and MySQL tables one by one, their catalogs
+# are read in bulk instead
+TABLE_DEFINITION_READERS = {
+    'sqlite': _sqlite_table_definitions,
+    'mysql': _mysql_table_definitions,
+}
+
+
+def get_table_fingerprints(engine):
+    """
+    Returns table name -> hash of the column names and types, primary key
+    and foreign keys of every table, listed in bulk without reflecting the
+    tables.
+    """
+    reader = TABLE_DEFINITION_READERS.get(engine.dialect.name, _inspector_table_definitions)
+    with engine.connect() as con:
+        definitions = reader(con)
+    return {
+        table_name: hashlib.sha256(json.dumps(definition, default=str).encode()).hexdigest()
+        for table_name, definition in definitions.items()}
+
+
+def sync_datasource_metadata(datasource, mdb, table_names=None, fingerprints=None):
+    """
+    Brings the Table, TableColumn and ForeignKey rows of the datasource in
+    line with the reflected mdb in one transaction. Rows are added, updated
+    and deleted in bulk, with a fixed number of queries. Existing tables
+    and columns keep their ids, public names and descriptions.
+    When mdb holds only some of the tables, table_names are the names of
+    all tables of the database, stored tables not in it are deleted.
+    fingerprints are stored for the tables of mdb.
+    Returns a report of what changed.
+    """
+    if table_names is None:
+        table_names = mdb.tables.keys()
+    if fingerprints is None:
+        fingerprints = {}
+    report = _new_metadata_report()
+    changed_tables = set()
+    with db.transaction.atomic():
+        # Tables, the first one is used when a name is duplicated
+        table_ids = {}
+        stored_fingerprints = {}
+        for table_id, name, fingerprint in models.Table.objects.filter(
+                data_source=datasource).order_by('id').values_list(
+                    'id', 'name', 'schema_fingerprint'):
+            if name not in table_ids:
+                table_ids[name] = table_id
+                stored_fingerprints[name] = fingerprint
+
+        new_tables = [name for name in mdb.tables if name not in table_ids]
+        stale_tables = [name for name in table_ids if name not in table_names]
+        updated_fingerprints = [
+            models.Table(id=table_ids[name], schema_fingerprint=fingerprints[name])
+            for name in mdb.tables
+            if name in table_ids and name in fingerprints
+            and fingerprints[name] != stored_fingerprints[name]]
+        if new_tables:
+            models.Table.objects.bulk_create(
+                [models.Table(name=name, public_name=name, data_source=datasource,
+                              schema_fingerprint=fingerprints.get(name))
+                 for name in new_tables], batch_size=1000)
+            # Not every database returns the ids of bulk created rows
+            for table_id, name in models.Table.objects.filter(
+                    data_source=datasource, name__in=new_tables).order_by('id').values_list(
+                        'id', 'name'):
+                table_ids.setdefault(name, table_id)
+        if updated_fingerprints:
+            models.Table.objects.bulk_update(
+                updated_fingerprints, ['schema_fingerprint'], batch_size=1000)
+        if stale_tables:
+            models.Table.objects.filter(
+                data_source=datasource, name__in=stale_tables).delete()
+        report['tables']['added'] = new_tables
+        report['tables']['deleted'] = stale_tables
+        changed_tables.update(new_tables)
+
+        # Columns of the reflected tables
+        mdb_table_ids = {table_ids[name]: name for name in mdb.tables}
+        columns = {}
+        for column_id, table_id, name, data_type, primary_key in models.TableColumn.objects.filter(
+                table_id__in=list(mdb_table_ids)).order_by('id').values_list(
+                    'id', 'table_id', 'name', 'data_type', 'primary_key'):
+            columns.setdefault((table_id, name), (column_id, data_type, primary_key))
+
+        new_columns = []
+        updated_columns = []
+        reflected_columns = set()
+        for table_id, table_name in mdb_table_ids.items():
+            for name, col in mdb.tables[table_name].columns.items():
+                reflected_columns.add((table_id, name))
+                data_type = str(col.type)
+                primary_key = bool(col.primary_key)
+                existing = columns.get((table_id, name))
+                if existing is None:
+                    new_columns.append(models.TableColumn(
+                        name=name, public_name=name, table_id=table_id, data_type=data_type,
+                        primary_key=primary_key))
+                    changed_tables.add(table_name)
+                elif existing[1:] != (data_type, primary_key):
+                    updated_columns.append(models.TableColumn(
+                        id=existing[0], data_type=data_type, primary_key=primary_key))
+                    changed_tables.add(table_name)
+        stale_columns = []
+        for (table_id, name), (column_id, *_) in columns.items():
+            if (table_id, name) not in reflected_columns:
+                stale_columns.append(column_id)
+                changed_tables.add(mdb_table_ids[table_id])
+        if new_columns:
+            models.TableColumn.objects.bulk_create(new_columns, batch_size=1000)
+        if updated_columns:
+            models.TableColumn.objects.bulk_update(
+                updated_columns, ['data_type', 'primary_key'], batch_size=1000)
+        if stale_columns:
+            models.TableColumn.objects.filter(id__in=stale_columns).delete()
+        report['columns'] = {
+            'added': len(new_columns),
+            'updated': len(updated_columns),
+            'deleted': len(stale_columns),
+        }
+
+        # Foreign keys, after the columns so that new ones can be referred to
+        column_ids = {}
+        if new_columns or stale_columns:
+            for column_id, table_id, name in models.TableColumn.objects.filter(
+                    table_id__in=list(mdb_table_ids)).order_by('id').values_list(
+                        'id', 'table_id', 'name'):
+                column_ids.setdefault((table_id, name), column_id)
+        else:
+            column_ids = {key: column_id for key, (column_id, *_) in columns.items()}
+
+        foreign_keys = {}
+        for fk_id, *fk_key in models.ForeignKey.objects.filter(
+                constrained_table_id__in=list(mdb_table_ids)).order_by('id').values_list(
+                    'id', 'constrained_table_id', 'constrained_columns_id',
+                    'referred_table_id', 'referred_columns_id'):
+            foreign_keys.setdefault(tuple(fk_key), fk_id)
+
+        reflected_fks = {}
+        for table_id, table_name in mdb_table_ids.items():
+            for fk in mdb.tables[table_name].Foreign_Keys:
+                referred_table_id = table_ids.get(fk.referred_table.name)
+                fk_key = (
+                    table_id,
+                    column_ids.get((table_id, fk.constrained_columns[0].name)),
+                    referred_table_id,
+                    column_ids.get((referred_table_id, fk.referred_columns[0].name)),
+                )
+                # Tables of other schemas are not reflected
+                if None not in fk_key:
+                    reflected_fks.setdefault(fk_key, table_name)
+        new_fks = [fk_key for fk_key in reflected_fks if fk_key not in foreign_keys]
+        stale_fks = [fk_id for fk_key, fk_id in foreign_keys.items() if fk_key not in reflected_fks]
+        if new_fks:
+            models.ForeignKey.objects.bulk_create(
+                [models.ForeignKey(constrained_table_id=constrained_table_id,
+                                   constrained_columns_id=constrained_column_id,
+                                   referred_table_id=referred_table_id,
+                                   referred_columns_id=referred_column_id)
+                 for constrained_table_id, constrained_column_id, referred_table_id,
+                 referred_column_id in new_fks], batch_size=1000)
+            changed_tables.update(reflected_fks[fk_key] for fk_key in new_fks)
+        if stale_fks:
+            changed_tables.update(
+                mdb_table_ids[fk_key[0]] for fk_key in foreign_keys
+                if fk_key not in reflected_fks and fk_key[0] in mdb_table_ids)
+            models.ForeignKey.objects.filter(id__in=stale_fks).delete()
+        report['foreign_keys'] = {'added': len(new_fks), 'deleted': len(stale_fks)}
+
+    report['changed_tables'] = sorted(changed_tables)
+    return report
 
 
 def _get_base_filters(datasource):
     tbl_base_filters = {}
-    for trf in models.TableRowFilter.objects.filter(data_source=datasource):
+    for trf in models.TableRowFilter.objects.filter(
+            data_source=datasource).select_related('table'):
         filter_str = trf.filter_str.strip()
         if len(filter_str) > 0:
             tbl_base_filters[trf.table.name] = ["(" + filter_str + ")"]
@@ -100,7 +1068,8 @@ def _get_base_filters(datasource):
 
 def _get_grp_filters(datasource, roles):
     tbls_grp_filter = {}  # key: table_name, value = [filter1, filter2]
-    for gtrf in models.GroupTableRowFilter.objects.filter(data_source=datasource, group__in=roles):
+    for gtrf in models.GroupTableRowFilter.objects.filter(
+            data_source=datasource, group__in=roles).select_related('table'):
         filter_str = gtrf.filter_str.strip()
         if len(filter_str) > 0:
             tbl_name = gtrf.table.name
@@ -129,65 +1098,155 @@ def _merge_grp_filters(tbl_base_filters, tbls_grp_filter):
         all_filters.append(role_filter_str)
 
 
-def update_filters(tables, datasource, roles):
+def get_table_filters(datasource, roles):
     tbl_base_filters = _get_base_filters(datasource) # table_name -> ["(a=2)", "(x = 1) or (y = 2)"]
     tbls_grp_filter = _get_grp_filters(datasource, roles)
     _merge_grp_filters(tbl_base_filters, tbls_grp_filter)
-    for tbl, filters_list in tbl_base_filters.items():
-        if len(filters_list) > 0:
-            tables[tbl].filters = 'WHERE ' + ' AND '.join(filters_list)
-
-
-def get_all_group_tables(datasource, roles):
-    # Get all tables from datasource
-    global_tables = models.Table.objects.filter(
-        data_source=datasource)
-    # Get private tables in datasource
-    private_table_object = models.PrivateTableSelector.objects.filter(
-        data_source=datasource).first()
-    if private_table_object:
-        private_tables_ids = private_table_object.tables.all().values_list('id', flat=True)
-        # Get tables excluding private tables
-        global_tables = global_tables.exclude(id__in=private_tables_ids)
-
-    # Add tables accessible by the user's groups
-    group_tables_object = models.GroupTableSelector.objects.filter(
-        group__in=roles,
-        tables__data_source=datasource).first()
-    if group_tables_object:
-        group_tables = group_tables_object.tables.all()
-        all_group_tables = global_tables.union(group_tables)
-        # Using subquery to allow filtering after union
-        all_group_tables = models.Table.objects.filter(
-            id__in=all_group_tables.values('id'))
+    return {
+        tbl: 'WHERE ' + ' AND '.join(filters_list)
+        for tbl, filters_list in tbl_base_filters.items()
+        if len(filters_list) > 0}
+
+
+def get_acl_cache_key(datasource_id, version, part):
+    return f"datasource_{datasource_id}_v{version}_acl_{part}"
+
+
+def _build_acl_structure(datasource_id):
+    # Column ids by table id, tables without columns included
+    table_columns = {}
+    for table_id, column_id in models.Table.objects.filter(
+            data_source_id=datasource_id).values_list('id', 'tablecolumn__id'):
+        columns = table_columns.setdefault(table_id, set())
+        if column_id is not None:
+            columns.add(column_id)
+    return table_columns
+
+
+def _build_acl_private(datasource_id):
+    PrivateTables = models.PrivateTableSelector.tables.through
+    PrivateColumns = models.PrivateColumnSelector.columns.through
+    return {
+        'tables': set(PrivateTables.objects.filter(
+            privatetableselector__data_source_id=datasource_id).values_list(
+                'table_id', flat=True)),
+        'columns': set(PrivateColumns.objects.filter(
+            privatecolumnselector__data_source_id=datasource_id).values_list(
+                'tablecolumn_id', flat=True)),
+    }
+
+
+def _build_acl_group(datasource_id, group_id):
+    GroupTables = models.GroupTableSelector.tables.through
+    GroupColumns = models.GroupColumnSelector.columns.through
+    return {
+        'tables': set(GroupTables.objects.filter(
+            grouptableselector__group_id=group_id,
+            table__data_source_id=datasource_id).values_list('table_id', flat=True)),
+        'columns': set(GroupColumns.objects.filter(
+            groupcolumnselector__group_id=group_id,
+            tablecolumn__table__data_source_id=datasource_id).values_list(
+                'tablecolumn_id', flat=True)),
+    }
+
+
+def refresh_acl_index(datasource_id, group_id=None):
+    """
+    Rebuilds the private part of the ACL index of the datasource, or the
+    part of group_id when given, under the current metadata version.
+    Called by the selector receivers after they bump the version.
+    """
+    if group_id is None:
+        part, value = 'private', _build_acl_private(datasource_id)
     else:
-        all_group_tables = global_tables
-    return all_group_tables
+        part, value = f'group_{group_id}', _build_acl_group(datasource_id, group_id)
+    version = get_metadata_version(models.DataSource(id=datasource_id))
+    cache.set(get_acl_cache_key(datasource_id, version, part), value,
+              timeout=settings.MDB_CACHE_TIMEOUT)
 
 
-def get_all_group_columns(datasource, tables, roles):
-    tables_ids = list(tables.values_list('id', flat=True))
-    # Get all columns for the tables
-    table_columns = models.TableColumn.objects.filter(table_id__in=tables_ids)
-    # Get private columns for tables
-    private_columns_object = models.PrivateColumnSelector.objects.filter(
-        data_source=datasource).first()
-    if private_columns_object:
-        private_columns_ids = private_columns_object.columns.all().values_list('id', flat=True)
-        table_columns = table_columns.exclude(id__in=private_columns_ids)
-
-    # Add columns accessible by the user's groups
-    group_columns_object = models.GroupColumnSelector.objects.filter(
-        group__in=roles,
-        columns__table__in=tables).first()
-    if group_columns_object:
-        group_columns = group_columns_object.columns.all()
-        all_table_columns = table_columns.union(group_columns)
-        # Using subquery to allow filtering after union
-        all_table_columns = models.TableColumn.objects.filter(
-            id__in=all_table_columns.values('id'))
+def get_acl_index(datasource, role_ids):
+    """
+    Returns the parts of the ACL index of the datasource needed for the
+    roles, the column ids by table id, the private tables and columns, and
+    the tables and columns of each role. Parts are kept per metadata
+    version, which every ACL change bumps. Missing parts are built and
+    cached, all in one cache round trip when none are missing.
+    """
+    version = get_metadata_version(datasource)
+    builders = {
+        'columns': lambda: _build_acl_structure(datasource.id),
+        'private': lambda: _build_acl_private(datasource.id),
+    }
+    for role_id in role_ids:
+        builders[f'group_{role_id}'] = functools.partial(
+            _build_acl_group, datasource.id, role_id)
+
+    cache_keys = {part: get_acl_cache_key(datasource.id, version, part) for part in builders}
+    cached = cache.get_many(cache_keys.values())
+    parts = {}
+    missing = {}
+    for part, cache_key in cache_keys.items():
+        if cache_key in cached:
+            parts[part] = cached[cache_key]
+        else:
+            parts[part] = missing[cache_key] = builders[part]()
+    if missing:
+        cache.set_many(missing, timeout=settings.MDB_CACHE_TIMEOUT)
+
+    return {
+        'columns': parts['columns'],
+        'private': parts['private'],
+        'groups': [parts[f'group_{role_id}'] for role_id in role_ids],
+    }
+
+
+def get_allowed_ids(datasource, roles):
+    """
+    Returns the ids of the tables and columns of the datasource the roles
+    may see, and the ids of the remaining ones. Private tables and columns
+    are hidden unless a selector of any of the roles includes them.
+    """
+    if isinstance(roles, QuerySet):
+        role_ids = sorted(roles.values_list('id', flat=True))
     else:
-        all_table_columns = table_columns
+        role_ids = sorted(role.id for role in roles)
+    acl_index = get_acl_index(datasource, role_ids)
+    table_columns = acl_index['columns']
+    private = acl_index['private']
+    group_tables = set().union(*(group['tables'] for group in acl_index['groups']))
+    group_columns = set().union(*(group['columns'] for group in acl_index['groups']))
+
+    all_tables = set(table_columns)
+    allowed_tables = (all_tables - private['tables']) | (group_tables & all_tables)
+    visible_columns = set().union(*(table_columns[table_id] for table_id in allowed_tables))
+    allowed_columns = (visible_columns - private['columns']) | (group_columns & visible_columns)
+    return {
+        'tables': allowed_tables,
+        'columns': allowed_columns,
+        'denied_tables': all_tables - allowed_tables,
+        'denied_columns': visible_columns - allowed_columns,
+    }
+
+
+def get_all_group_tables(datasource, roles, allowed_ids=None):
+    if allowed_ids is None:
+        allowed_ids = get_allowed_ids(datasource, roles)
+    # Excluded ids, usually far fewer than the allowed ones
+    all_group_tables = models.Table.objects.filter(data_source=datasource)
+    if allowed_ids['denied_tables']:
+        all_group_tables = all_group_tables.exclude(id__in=allowed_ids['denied_tables'])
+    return all_group_tables
+
+
+def get_all_group_columns(datasource, roles, allowed_ids=None):
+    if allowed_ids is None:
+        allowed_ids = get_allowed_ids(datasource, roles)
+    all_table_columns = models.TableColumn.objects.filter(table__data_source=datasource)
+    if allowed_ids['denied_tables']:
+        all_table_columns = all_table_columns.exclude(table_id__in=allowed_ids['denied_tables'])
+    if allowed_ids['denied_columns']:
+        all_table_columns = all_table_columns.exclude(id__in=allowed_ids['denied_columns'])
     return all_table_columns
 
 
@@ -196,8 +1255,9 @@ def get_admin_config_object(datasource, roles):
     """
     Return Tables and columns accessible for user
     """
-    all_group_tables = get_all_group_tables(datasource, roles)
-    group_columns = get_all_group_columns(datasource, all_group_tables, roles)
+    allowed_ids = get_allowed_ids(datasource, roles)
+    all_group_tables = get_all_group_tables(datasource, roles, allowed_ids)
+    group_columns = get_all_group_columns(datasource, roles, allowed_ids)
     return all_group_tables, group_columns
 
 
@@ -246,23 +1306,61 @@ def llm_response(user, user_query, db_schema, organisation, datasource):
         return {'status': 'error', 'error': str(e)}
 
     if is_default_llm:
-        try:
-            if organisation.name == 'demo':
-                llm_credit, created = LLMCredit.objects.get_or_create(owner=user)
-                if created:
-                    llm_credit.credit = settings.FREE_LLM_CREDITS
-                    llm_credit.save()
-                deduct_llm_credits(llm_credit, response)
-            else:
-                deduct_llm_credits(organisation.llm_credit, response)
-        except Exception as e:
-            logger.exception(e)
-            disable_default_llm()
+        deduct_default_llm_credits(user, organisation, response)
+
+    response_sql['status'] = 'success'
+    return response_sql
+
+
+async def allm_response(user, user_query, db_schema, organisation, datasource,
+                        messages=None):
+    """
+    Async version of `llm_response`, the LLM is called with its async
+    client. When messages are given they are sent as they are instead
+    of the query generation prompt.
+    """
+    try:
+        llm, is_default_llm = await sync_to_async(LLMFactory.create_llm)(organisation)
+        if messages is None:
+            pipeline = await sync_to_async(create_pipeline)(
+                llm, 'one_step_pipeline', user, db_schema, datasource, user_query)
+        else:
+            pipeline = Pipeline([Step(llm, messages)])
+            await models.PromptLog.objects.acreate(user=user, llm_prompt=messages)
+        response = await pipeline.arun()
+        response_sql = response[0][0]
+    except NoSufficientCreditsException as e:
+        logger.exception(e)
+        return {'status': 'error', 'error': str(e)}
+    except NoDefaultLLMException as e:
+        logger.exception(e)
+        return {'status': 'error', 'error': str(e)}
+    except Exception as e:
+        logger.exception(e)
+        return {'status': 'error', 'error': str(e)}
+
+    if is_default_llm:
+        await sync_to_async(deduct_default_llm_credits)(user, organisation, response)
 
     response_sql['status'] = 'success'
     return response_sql
 
 
+def deduct_default_llm_credits(user, organisation, response):
+    try:
+        if organisation.name == 'demo':
+            llm_credit, created = LLMCredit.objects.get_or_create(owner=user)
+            if created:
+                llm_credit.credit = settings.FREE_LLM_CREDITS
+                llm_credit.save()
+            deduct_llm_credits(llm_credit, response)
+        else:
+            deduct_llm_credits(organisation.llm_credit, response)
+    except Exception as e:
+        logger.exception(e)
+        disable_default_llm()
+
+
 def create_pipeline(llm, name, user, db_schema, datasource, user_query):
     steps = []
     if name == 'one_step_pipeline':
@@ -293,45 +1391,112 @@ def get_response_from_pipeline(pipeline):
 
 # @cache_page(24*3600)
 def generate_mdb(datasource):
+    """
+    Builds the MDatabase of all tables of the datasource with three
+    queries, one each for tables, columns and foreign keys.
+    """
     tables = {}
-    dbtables = models.Table.objects.filter(data_source=datasource)
-    columns = {}
-    for dbt in dbtables:
-        tables[dbt.name] = {
-            'name': dbt.name,
-            'public_name': dbt.public_name,
-            'description': dbt.description
+    table_names = {}
+    dbtables = models.Table.objects.filter(data_source=datasource).order_by('id')
+    for table_id, name, public_name, description in dbtables.values_list(
+            'id', 'name', 'public_name', 'description').iterator():
+        table_names[table_id] = name
+        tables[name] = {
+            'name': name,
+            'public_name': public_name,
+            'description': description
         }
-        dbcolumns = models.TableColumn.objects.filter(table=dbt)
-        column_data = []
-        for dbc in dbcolumns:
-            column_data.append({
-                'name': dbc.name,
-                'pub_name': dbc.public_name,
-                'type': dbc.data_type,
-                'primary_key': '',
-                'nullable': '',
-                'desc': ''
-            })
-        columns[dbt.name] = column_data
 
+    column_data = {table_id: [] for table_id in table_names}
+    dbcolumns = models.TableColumn.objects.filter(
+        table__data_source=datasource).order_by('id')
+    for table_id, name, public_name, data_type, primary_key in dbcolumns.values_list(
+            'table_id', 'name', 'public_name', 'data_type', 'primary_key').iterator():
+        column_data[table_id].append({
+            'name': name,
+            'pub_name': public_name,
+            'type': data_type,
+            'primary_key': primary_key,
+            'nullable': '',
+            'desc': ''
+        })
+
+    fk_data = {table_id: [] for table_id in table_names}
+    dbfks = models.ForeignKey.objects.filter(
+        constrained_table__data_source=datasource).order_by('id')
+    for table_id, constrained_column, referred_table, referred_column in dbfks.values_list(
+            'constrained_table_id', 'constrained_columns__name',
+            'referred_table__name', 'referred_columns__name').iterator():
+        fk_data[table_id].append({
+            'constrained_columns': [constrained_column],
+            'referred_table': referred_table,
+            'referred_columns': [referred_column],
+            'referred_schema': '',
+        })
+
+    # A later table with the same name replaces the earlier one
+    columns = {}
     foreign_keys = {}
-    for dbt in dbtables:
-        dbfks = models.ForeignKey.objects.filter(constrained_table=dbt)
-        fk_data = []
-        for dbfk in dbfks:
-            fk_data.append({
-                'constrained_columns': [dbfk.constrained_columns.name],
-                'referred_table': dbfk.referred_table.name,
-                'referred_columns': [dbfk.referred_columns.name],
-                'referred_schema': '',
-            })
-        foreign_keys[dbt.name] = fk_data
+    for table_id, name in table_names.items():
+        columns[name] = column_data[table_id]
+        foreign_keys[name] = fk_data[table_id]
 
     mdb = MDatabase.from_data(tables, columns, foreign_keys)
     return mdb
 
 
+def get_referenced_tables(user_sql, dialect=None):
+    """
+    Returns the names of the tables user_sql reads from, without the
+    names of its CTEs. Returns None if the SQL can not be parsed.
+    """
+    try:
+        expressions = sqlglot.parse(user_sql, read=get_sqlglot_dialect(dialect))
+    except sqlglot.errors.SqlglotError:
+        return None
+    tables = set()
+    ctes = set()
+    for expression in expressions:
+        if expression is None:
+            continue
+        ctes.update(cte.alias_or_name for cte in expression.find_all(sqlglot.exp.CTE))
+        for table in expression.find_all(sqlglot.exp.Table):
+            tables.add(table.name)
+            if table.db:
+                tables.add(f"{table.db}.{table.name}")
+    return tables - ctes
+
+
+def subset_mdb(mDb, user_sql, dialect=None):
+    """
+    Returns an MDatabase holding only the tables of mDb referenced by
+    user_sql, matched on name or public name. A name matching several
+    tables, say the public name of one and the name of another, brings all
+    of them. The tables are shared with mDb, so their allowed columns and
+    row filters are kept.
+    Returns mDb itself when the tables can not be worked out.
+    """
+    referenced = get_referenced_tables(user_sql, dialect)
+    if not referenced:
+        return mDb
+    lookup = collections.defaultdict(set)
+    for name, table in mDb.tables.items():
+        lookup[name.lower()].add(name)
+        if table.pub_name:
+            lookup[table.pub_name.lower()].add(name)
+    tables = {}
+    for referenced_name in referenced:
+        names = lookup.get(referenced_name.lower())
+        if not names:
+            # Unknown to this schema, let sqlshield report it
+            return mDb
+        for name in names:
+            tables[name] = mDb.tables[name]
+    subset = MDatabase()
+    subset.tables = tables
+    return subset
+
+
 def generate_native_sql(mDb, user_sql, dialect):
     sess = Session(mDb, '')
     try:
@@ -347,36 +1512,842 @@ def generate_native_sql(mDb, user_sql, dialect):
         }
 
 
-def execute_native_sql(datasource, native_sql, page, per_page):
-    engine = create_db_engine(datasource.type, datasource.connection_str,
-                              credentials_info=datasource.connection_json)
-    with engine.connect() as con:
+# key: (datasource id, metadata version, role ids, dialect, normalised sql),
+# value: native sql. Most recently used entries are at the end.
+_native_sql_cache = collections.OrderedDict()
+_native_sql_cache_lock = threading.Lock()
+_native_sql_cache_metrics = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# Whitespace outside of quoted strings and identifiers
+# Comments go ahead of the literals so a quote in a comment does not start
+# one, both are kept as they are
+_SQL_WHITESPACE = re.compile(
+    r"""(--[^\n]*|#[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)|\s+""",
+    re.DOTALL)
+
+
+def _normalise_whitespace(match):
+    if match.group(1):
+        return match.group(1)
+    # A line break ends a -- or # comment, so it is kept
+    return '\n' if '\n' in match.group(0) else ' '
+
+
+def normalise_sql(sql):
+    sql = _SQL_WHITESPACE.sub(_normalise_whitespace, sql)
+    return sql.strip().rstrip(';').strip()
+
+
+def get_native_sql(datasource, roles, user_sql):
+    """
+    Returns `generate_native_sql` for user_sql on the MDatabase of the
+    roles, memoized in a bounded in-process LRU. The key contains the
+    metadata version so the entries of a changed datasource are not used.
+    """
+    role_ids = tuple(sorted(roles.values_list('id', flat=True)))
+    cache_key = (datasource.id, get_metadata_version(datasource), role_ids,
+                 datasource.dialect_name, normalise_sql(user_sql))
+    with _native_sql_cache_lock:
+        native_sql = _native_sql_cache.get(cache_key)
+        if native_sql is not None:
+            _native_sql_cache.move_to_end(cache_key)
+            _native_sql_cache_metrics['hits'] += 1
+            return {
+                'status': 'success',
+                'native_sql': native_sql
+            }
+        _native_sql_cache_metrics['misses'] += 1
+
+    mDb = subset_mdb(prepare_mdb(datasource, roles), user_sql, datasource.dialect_name)
+    native_sql_response = generate_native_sql(mDb, user_sql, datasource.dialect_name)
+    if native_sql_response['status'] != 'success':
+        return native_sql_response
+
+    with _native_sql_cache_lock:
+        _native_sql_cache[cache_key] = native_sql_response['native_sql']
+        _native_sql_cache.move_to_end(cache_key)
+        while len(_native_sql_cache) > settings.NATIVE_SQL_CACHE_SIZE:
+            _native_sql_cache.popitem(last=False)
+            _native_sql_cache_metrics['evictions'] += 1
+    return native_sql_response
+
+
+def get_native_sql_cache_metrics():
+    with _native_sql_cache_lock:
+        metrics = dict(_native_sql_cache_metrics)
+        metrics['size'] = len(_native_sql_cache)
+    lookups = metrics['hits'] + metrics['misses']
+    metrics['hit_ratio'] = metrics['hits'] / lookups if lookups else 0
+    return metrics
+
+
+_row_count_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.ROW_COUNT_WORKERS, thread_name_prefix='terno-row-count')
+
+
+def get_metadata_version_cache_key(datasource):
+    return f"datasource_{datasource.id}_metadata_version"
+
+
+def _new_metadata_version():
+    # Milliseconds, so a version lost from the cache restarts above the
+    # old counter instead of colliding with stale entries.
+    return time.time_ns() // 1000000
+
+
+def get_metadata_version(datasource):
+    cache_key = get_metadata_version_cache_key(datasource)
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, _new_metadata_version(), timeout=None)
+        version = cache.get(cache_key)
+    return version
+
+
+def bump_metadata_version(datasource):
+    """
+    Invalidates everything cached for the datasource under the current
+    metadata version, the old entries expire on their own.
+    """
+    _drop_local_mdbs(datasource)
+    cache_key = get_metadata_version_cache_key(datasource)
+    try:
+        return cache.incr(cache_key)
+    except ValueError:
+        version = _new_metadata_version()
+        cache.set(cache_key, version, timeout=None)
+        return version
+
+
+def get_row_count_cache_key(datasource, native_sql):
+    fingerprint = hashlib.sha256(native_sql.encode('utf-8')).hexdigest()
+    version = get_metadata_version(datasource)
+    return f"datasource_{datasource.id}_v{version}_row_count_{fingerprint}"
+
+
+def get_result_cache_key(datasource, native_sql, page, per_page, cursor):
+    page_key = json.dumps([native_sql, page, per_page, cursor], default=str)
+    fingerprint = hashlib.sha256(page_key.encode('utf-8')).hexdigest()
+    version = get_metadata_version(datasource)
+    return f"datasource_{datasource.id}_v{version}_result_{fingerprint}"
+
+
+def cache_table_data(cache_key, table_data):
+    """
+    Caches one page of results unless it is larger than
+    RESULT_CACHE_MAX_BYTES. Pages with an approximate row count are not
+    cached, the exact count may be known on the next request.
+    """
+    if table_data['row_count_status'] != 'exact':
+        return False
+    try:
+        size = len(pickle.dumps(table_data, pickle.HIGHEST_PROTOCOL))
+    except Exception as e:
+        logger.warning(f"Result is not cacheable: {e}")
+        return False
+    if size > settings.RESULT_CACHE_MAX_BYTES:
+        return False
+    cache.set(cache_key, table_data, timeout=settings.RESULT_CACHE_TIMEOUT)
+    return True
+
+
+def count_native_sql_rows(datasource, native_sql, count_sql, request_id=None,
+                          should_stop=None):
+    """
+    Runs the COUNT(*) for native_sql and caches it, so that the other
+    pages of the same result do not count again. `should_stop` is called
+    once the statement is registered under request_id, returning True
+    aborts the count before it runs.
+    """
+    with datasource_connection(datasource) as con, \
+            statement_guard(con, datasource, request_id):
+        if should_stop is not None and should_stop():
+            raise StatementCancelledException("Row count was cancelled.")
+        row_count = con.execute(sqlalchemy.text(count_sql)).scalar()
+    cache.set(get_row_count_cache_key(datasource, native_sql), row_count,
+              timeout=settings.ROW_COUNT_CACHE_TIMEOUT)
+    return row_count
+
+
+def _bigquery_dry_run(con, native_sql):
+    from google.cloud import bigquery
+    client = con.connection.dbapi_connection._client
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    query_job = client.query(native_sql, job_config=job_config)
+    return {'method': 'dry_run', 'bytes_processed': query_job.total_bytes_processed}
+
+
+def _postgres_explain(con, native_sql):
+    plan = con.execute(sqlalchemy.text(f"EXPLAIN (FORMAT JSON) {native_sql}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]['Plan']
+    return {
+        'method': 'explain',
+        'rows': int(plan['Plan Rows']),
+        'cost': plan['Total Cost'],
+    }
+
+
+def _mysql_explain(con, native_sql):
+    execute_result = con.execute(sqlalchemy.text(f"EXPLAIN {native_sql}"))
+    # For nested loop joins the rows examined is the product of the rows
+    # of each table in the plan.
+    rows = 1
+    for row in execute_result.mappings():
+        if row.get('rows') is not None:
+            rows *= int(row['rows'])
+    return {'method': 'explain', 'rows': rows}
+
+
+COST_ESTIMATORS = {
+    'bigquery': _bigquery_dry_run,
+    'postgresql': _postgres_explain,
+    'mysql': _mysql_explain,
+}
+
+
+def get_query_cost_cache_key(datasource, native_sql):
+    fingerprint = hashlib.sha256(native_sql.encode('utf-8')).hexdigest()
+    version = get_metadata_version(datasource)
+    return f"datasource_{datasource.id}_v{version}_cost_{fingerprint}"
+
+
+def estimate_native_sql_cost(datasource, native_sql):
+    """
+    Estimates the cost of native_sql without running it, with a BigQuery
+    dry run or EXPLAIN for Postgres and MySQL. Estimates are cached per
+    native SQL and metadata version, so paging through a result does not
+    estimate it again.
+    Returns None when the dialect has no estimator or estimation failed.
+    """
+    estimator = COST_ESTIMATORS.get(datasource.dialect_name)
+    if estimator is None:
+        return None
+    cache_key = get_query_cost_cache_key(datasource, native_sql)
+    cost_estimate = cache.get(cache_key)
+    if cost_estimate is not None:
+        return cost_estimate
+    try:
+        with admission_slot(datasource, 'interactive'), \
+                datasource_connection(datasource) as con:
+            cost_estimate = estimator(con, native_sql)
+    except Exception as e:
+        logger.warning(f"Could not estimate query cost: {e}")
+        return None
+    cache.set(cache_key, cost_estimate, timeout=settings.QUERY_COST_CACHE_TIMEOUT)
+    return cost_estimate
+
+
+def check_query_cost(organisation, cost_estimate):
+    """
+    Compares cost_estimate with the limits of the organisation.
+    Returns None if the query may run, else a dict with the error and
+    `cost_guard_action` of the organisation.
+    """
+    if cost_estimate is None:
+        return None
+    bytes_processed = cost_estimate.get('bytes_processed')
+    rows = cost_estimate.get('rows')
+    error = None
+    if (organisation.max_bytes_processed is not None and bytes_processed is not None
+            and bytes_processed > organisation.max_bytes_processed):
+        error = (f"Query would process an estimated {bytes_processed} bytes, "
+                 f"the limit is {organisation.max_bytes_processed} bytes.")
+    elif (organisation.max_estimated_rows is not None and rows is not None
+            and rows > organisation.max_estimated_rows):
+        error = (f"Query would examine an estimated {rows} rows, "
+                 f"the limit is {organisation.max_estimated_rows} rows.")
+    if error is None:
+        return None
+    return {
+        'error': error,
+        'action': organisation.cost_guard_action,
+    }
+
+
+# key: flight key, value: execution in progress in this process
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_single_flight_metrics = {
+    'executions': 0,
+    'shared': 0,
+    'shared_remote': 0,
+    'fallbacks': 0,
+}
+
+
+def _record_single_flight(outcome):
+    with _in_flight_lock:
+        _single_flight_metrics[outcome] += 1
+
+
+def get_single_flight_metrics():
+    with _in_flight_lock:
+        metrics = dict(_single_flight_metrics)
+        metrics['in_flight'] = len(_in_flight)
+    metrics['saved_executions'] = metrics['shared'] + metrics['shared_remote']
+    return metrics
+
+
+def _is_shareable(result):
+    # A cancelled leader says nothing about the result of the followers
+    return result is not None and result.get('error_type') != 'cancelled'
+
+
+# States of a flight of another process, the lock holds them
+_FLIGHT_RUNNING = 'running'
+_FLIGHT_DONE = 'done'
+_FLIGHT_UNCACHEABLE = 'uncacheable'
+# Long enough for the followers polling the lock to see the final state
+_FLIGHT_STATE_TIMEOUT = 10
+
+
+def get_single_flight_timeout(datasource):
+    """
+    Longest an execution on the datasource can take, waiting for an
+    admission slot and running the page query and the row count, which
+    bounds how long the other callers wait for it.
+    """
+    statement_timeout = get_statement_timeout(datasource)
+    if not statement_timeout:
+        return settings.SINGLE_FLIGHT_TIMEOUT
+    return min(settings.SINGLE_FLIGHT_TIMEOUT,
+               settings.ADMISSION_QUEUE_TIMEOUT + 2 * statement_timeout
+               + settings.ROW_COUNT_TIMEOUT)
+
+
+def _wait_for_remote_flight(result_cache_key, execute, timeout):
+    """
+    Runs execute unless another process holds the in flight lock of
+    result_cache_key, in which case its cached result is used. Once done
+    the leader replaces the lock with its final state, so the others stop
+    waiting at once and do not look for a result that was not cached.
+    """
+    lock_key = f"{result_cache_key}_in_flight"
+    if cache.add(lock_key, _FLIGHT_RUNNING, timeout=timeout):
+        result = None
+        try:
+            _record_single_flight('executions')
+            result = execute()
+            return result
+        finally:
+            state = _FLIGHT_UNCACHEABLE
+            if result is not None and result.get('status') == 'success':
+                state = _FLIGHT_DONE
+            cache.set(lock_key, state, timeout=_FLIGHT_STATE_TIMEOUT)
+
+    deadline = time.monotonic() + timeout
+    state = cache.get(lock_key)
+    while state == _FLIGHT_RUNNING and time.monotonic() < deadline:
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        state = cache.get(lock_key)
+    if state != _FLIGHT_UNCACHEABLE:
+        table_data = cache.get(result_cache_key)
+        if table_data is not None:
+            _record_single_flight('shared_remote')
+            return {
+                'status': 'success',
+                'table_data': table_data
+            }
+    # The result was not cacheable or the other process failed
+    _record_single_flight('fallbacks')
+    _record_single_flight('executions')
+    return execute()
+
+
+def single_flight(flight_key, execute, result_cache_key=None, timeout=None):
+    """
+    Runs execute once for concurrent calls with the same flight_key, the
+    other callers wait for it, at most timeout seconds, and get the same
+    result. With a result_cache_key the calls of other processes are
+    coalesced too, through a lock in the cache and the cached result.
+    """
+    if timeout is None:
+        timeout = settings.SINGLE_FLIGHT_TIMEOUT
+    with _in_flight_lock:
+        flight = _in_flight.get(flight_key)
+        is_leader = flight is None
+        if is_leader:
+            flight = {'done': threading.Event(), 'result': None}
+            _in_flight[flight_key] = flight
+
+    if not is_leader:
+        flight['done'].wait(timeout=timeout)
+        if _is_shareable(flight['result']):
+            _record_single_flight('shared')
+            return flight['result']
+        _record_single_flight('fallbacks')
+        _record_single_flight('executions')
+        return execute()
+
+    try:
+        if result_cache_key is not None:
+            flight['result'] = _wait_for_remote_flight(result_cache_key, execute, timeout)
+        else:
+            _record_single_flight('executions')
+            flight['result'] = execute()
+        return flight['result']
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(flight_key, None)
+        flight['done'].set()
+
+
+def execute_native_sql(datasource, native_sql, page, per_page, cursor=None,
+                       count_rows=True, request_id=None, user_id=None,
+                       unique_keys=None):
+    """
+    unique_keys are `get_unique_keys` of the datasource, looked up when
+    not given. Async callers look them up first, the ORM is not used from
+    the blocking pool.
+    """
+    result_cache_key = get_result_cache_key(datasource, native_sql, page,
+                                            per_page, cursor)
+    if settings.RESULT_CACHE_ENABLED:
+        table_data = cache.get(result_cache_key)
+        if table_data is not None:
+            return {
+                'status': 'success',
+                'table_data': table_data
+            }
+    else:
+        result_cache_key = None
+    if unique_keys is None:
+        unique_keys = get_unique_keys(datasource)
+
+    def execute():
         try:
-            execute_result = con.execute(sqlalchemy.text(native_sql))
-            table_data = prepare_table_data_from_execute(execute_result, page, per_page)
+            with admission_slot(datasource, 'interactive'):
+                return _execute_native_sql(datasource, native_sql, page, per_page,
+                                           cursor, count_rows, result_cache_key,
+                                           request_id, user_id, unique_keys)
+        except DatasourceBusyException as e:
+            return {
+                'status': 'error',
+                'error': str(e),
+                'error_type': 'busy'
+            }
+
+    if not settings.SINGLE_FLIGHT_ENABLED:
+        return execute()
+    flight_key = (datasource.id, native_sql, page, per_page, cursor, bool(count_rows))
+    return single_flight(flight_key, execute, result_cache_key,
+                         timeout=get_single_flight_timeout(datasource))
+
+
+def _execute_native_sql(datasource, native_sql, page, per_page, cursor,
+                        count_rows, result_cache_key, request_id, user_id,
+                        unique_keys):
+    dialect = get_sqlglot_dialect(datasource.dialect_name)
+    try:
+        paginated = paginate_native_sql(native_sql, dialect, page, per_page, cursor,
+                                        unique_keys=unique_keys)
+    except sqlglot.errors.SqlglotError as e:
+        # Could not rewrite the query, page through the full result instead.
+        logger.warning(f"Pagination pushdown failed, falling back to fetchall: {e}")
+        paginated = None
+
+    total_count = None
+    count_future = None
+    count_request_id = uuid.uuid4().hex
+    count_stopped = threading.Event()
+    if paginated is not None:
+        total_count = cache.get(get_row_count_cache_key(datasource, native_sql))
+        if total_count is None and count_rows:
+            if settings.ROW_COUNT_CONCURRENT:
+                count_future = _row_count_executor.submit(
+                    _count_native_sql_rows_concurrently, datasource, native_sql,
+                    paginated['count_sql'], count_request_id, count_stopped.is_set)
+            else:
+                total_count = _count_native_sql_rows(
+                    datasource, native_sql, paginated['count_sql'])
+
+    with datasource_connection(datasource) as con:
+        try:
+            with statement_guard(con, datasource, request_id, user_id):
+                if paginated is None:
+                    execute_result = con.execute(sqlalchemy.text(native_sql))
+                    table_data = prepare_table_data_from_execute(execute_result, page, per_page)
+                else:
+                    execute_result = con.execute(sqlalchemy.text(paginated['page_sql']))
+                    rows = execute_result.fetchmany(per_page)
+            if paginated is not None:
+                if count_future is not None:
+                    try:
+                        total_count = count_future.result(
+                            timeout=settings.ROW_COUNT_TIMEOUT)
+                    except Exception as e:
+                        logger.warning(f"Row count not available: {e}")
+                    else:
+                        if total_count is None:
+                            # No free slot for the count, it runs in the
+                            # slot of this request now that the page is read
+                            total_count = _count_native_sql_rows(
+                                datasource, native_sql, paginated['count_sql'])
+                table_data = prepare_table_data_from_page(
+                    execute_result.keys(), rows, page, per_page, total_count,
+                    order_key=paginated['order_key'])
+            if result_cache_key is not None:
+                cache_table_data(result_cache_key, table_data)
             return {
                 'status': 'success',
                 'table_data': table_data
             }
+        except StatementTimeoutException as e:
+            return {
+                'status': 'error',
+                'error': str(e),
+                'error_type': 'timeout'
+            }
+        except StatementCancelledException as e:
+            return {
+                'status': 'error',
+                'error': str(e),
+                'error_type': 'cancelled'
+            }
         except Exception as e:
             return {
                 'status': 'error',
                 'error': str(e)
             }
+        finally:
+            if count_future is not None and not count_future.done():
+                # Nobody waits for the count any more
+                count_stopped.set()
+                if not count_future.cancel():
+                    cancel_statement(count_request_id)
 
 
-def export_native_sql_result(datasource, native_sql):
-    engine = sqlalchemy.create_engine(datasource.connection_str)
+def _count_native_sql_rows(datasource, native_sql, count_sql):
+    try:
+        return count_native_sql_rows(datasource, native_sql, count_sql)
+    except Exception as e:
+        logger.warning(f"Row count failed: {e}")
+        return None
+
+
+def _count_native_sql_rows_concurrently(datasource, native_sql, count_sql,
+                                        request_id, should_stop):
+    """
+    Runs the count next to the page query in an admission slot of its own.
+    Returns None when no slot is free right away.
+    """
+    try:
+        with admission_slot(datasource, 'interactive', wait=False):
+            return count_native_sql_rows(datasource, native_sql, count_sql,
+                                         request_id, should_stop)
+    except DatasourceBusyException:
+        return None
+
+
+def _read_bigquery_result(con, native_sql):
+    """
+    Runs native_sql as a BigQuery job and returns the column names and an
+    iterator of Arrow record batches. Results of at least
+    BIGQUERY_STORAGE_MIN_ROWS rows are read through the Storage Read API,
+    smaller ones page through the REST API.
+    """
+    dbapi_connection = con.connection.dbapi_connection
+    client = dbapi_connection._client
+    rows = client.query(native_sql).result(page_size=settings.EXPORT_CHUNK_SIZE)
+    columns = [field.name for field in rows.schema]
+
+    bqstorage_client = None
+    if rows.total_rows is not None and rows.total_rows >= settings.BIGQUERY_STORAGE_MIN_ROWS:
+        bqstorage_client = getattr(dbapi_connection, '_bqstorage_client', None)
+        if bqstorage_client is None:
+            try:
+                from google.cloud import bigquery_storage
+                bqstorage_client = bigquery_storage.BigQueryReadClient(
+                    credentials=client._credentials)
+            except Exception as e:
+                logger.warning(f"BigQuery Storage Read API not available: {e}")
+    return columns, rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
+
+
+def stream_native_sql(datasource, native_sql, request_id=None, user_id=None):
+    """
+    Executes native_sql with a server side cursor where the driver supports
+    it. Yields the column names first and then lists of at most
+    EXPORT_CHUNK_SIZE rows, so the full result is never held in memory.
+    BigQuery results are yielded as Arrow record batches instead, see
+    `_read_bigquery_result`.
+    The admission slot is held until the generator is closed, the
+    statement timeout only counts while the generator is running.
+    """
+    with admission_slot(datasource, 'export'), \
+            datasource_connection(datasource) as con, \
+            statement_guard(con, datasource, request_id, user_id) as state:
+        if con.dialect.name == 'bigquery' and settings.BIGQUERY_STORAGE_ENABLED:
+            columns, batches = _read_bigquery_result(con, native_sql)
+            yield columns
+            yield from batches
+            return
+        con = con.execution_options(stream_results=True,
+                                    yield_per=settings.EXPORT_CHUNK_SIZE)
+        execute_result = con.execute(sqlalchemy.text(native_sql))
+        with deadline_paused(state):
+            yield list(execute_result.keys())
+        for partition in execute_result.partitions():
+            with deadline_paused(state):
+                yield partition
+
+
+def _arrow_string_array(values):
+    return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def _arrow_batch(columns, rows, unknown_type=pa.string()):
+    """
+    Builds a RecordBatch from rows with the types inferred from their
+    values. Columns of only nulls get unknown_type.
+    """
+    values = list(zip(*rows)) if rows else [[] for _ in columns]
+    arrays = []
+    for column_values in values:
+        column_values = list(column_values)
+        try:
+            array = pa.array(column_values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Mixed types, e.g. from SQLite's dynamic typing
+            array = _arrow_string_array(column_values)
+        if pa.types.is_null(array.type):
+            # Type is unknown until a non null value shows up
+            array = pa.array(column_values, type=unknown_type)
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+
+def _is_number_type(arrow_type):
+    return pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type)
+
+
+def _widen_arrow_type(current, new):
+    """
+    Returns a type that holds the values of both types, e.g. when a later
+    chunk of a result has decimals of a larger scale or floats in a
+    column that only had integers so far. Falls back to string.
+    """
+    if current == new or pa.types.is_null(new):
+        return current
+    if pa.types.is_null(current):
+        return new
+    if pa.types.is_integer(current) and pa.types.is_integer(new):
+        return pa.int64()
+    if _is_number_type(current) and _is_number_type(new):
+        return pa.float64()
+    if pa.types.is_decimal(current) and pa.types.is_decimal(new):
+        scale = max(current.scale, new.scale)
+        precision = max(current.precision - current.scale, new.precision - new.scale) + scale
+        if precision <= 38:
+            return pa.decimal128(precision, scale)
+    return pa.string()
+
+
+def _widen_arrow_schema(schema, batch):
+    return pa.schema([
+        field.with_type(_widen_arrow_type(field.type, batch_field.type))
+        for field, batch_field in zip(schema, batch.schema)])
+
+
+def _with_string_fields(schema, indices):
+    for i in indices:
+        schema = schema.set(i, schema.field(i).with_type(pa.string()))
+    return schema
+
+
+def _cast_arrow_batch(batch, schema):
+    """
+    Casts batch to schema. Returns (batch, []), or (None, indices) with
+    the columns that do not fit without loss, e.g. a huge integer in a
+    float column.
+    """
+    arrays = []
+    failed = []
+    for i, (column, field) in enumerate(zip(batch.columns, schema)):
+        if column.type == field.type:
+            arrays.append(column)
+        elif pa.types.is_string(field.type):
+            arrays.append(_arrow_string_array(column.to_pylist()))
+        else:
+            try:
+                arrays.append(column.cast(field.type))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                failed.append(i)
+    if failed:
+        return None, failed
+    return pa.RecordBatch.from_arrays(arrays, schema=schema), []
+
+
+def _fit_arrow_batch(batch, schema):
+    """
+    Returns the schema widened to hold batch too, and batch cast to it.
+    """
+    schema = _widen_arrow_schema(schema, batch)
+    while True:
+        cast_batch, failed = _cast_arrow_batch(batch, schema)
+        if not failed:
+            return schema, cast_batch
+        schema = _with_string_fields(schema, failed)
+
+
+def _respool(path, respool_path, schema):
+    """
+    Writes the batches spooled at path to respool_path, cast to the wider
+    schema. Returns the open writer and the schema, which has the columns
+    that still did not fit as strings.
+    """
+    while True:
+        writer = pa.ipc.new_file(respool_path, schema)
+        failed = []
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch, failed = _cast_arrow_batch(reader.get_batch(i), schema)
+                if failed:
+                    break
+                writer.write_batch(batch)
+        if not failed:
+            return writer, schema
+        writer.close()
+        schema = _with_string_fields(schema, failed)
+
+
+def get_query_job_path(job_id):
+    return os.path.join(settings.QUERY_JOB_SPOOL_DIR, f'{job_id}.arrow')
+
+
+def spool_native_sql_result(datasource, native_sql, path, should_stop=None,
+                            request_id=None, user_id=None):
+    """
+    Streams the result of native_sql into an Arrow IPC file at path.
+    `should_stop` is called between chunks, returning True aborts the
+    spooling. Returns (columns, row_count) or None when aborted.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partitions = stream_native_sql(datasource, native_sql, request_id, user_id)
+    writer = None
+    row_count = 0
+    tmp_path = path + '.tmp'
+    respool_path = path + '.respool'
+    try:
+        columns = next(partitions)
+        schema = None
+        for partition in partitions:
+            if isinstance(partition, pa.RecordBatch):
+                batch = partition
+            else:
+                batch = _arrow_batch(columns, partition, unknown_type=pa.null())
+            if writer is None:
+                schema = batch.schema
+                writer = pa.ipc.new_file(tmp_path, schema)
+            elif batch.schema != schema:
+                new_schema, cast_batch = _fit_arrow_batch(batch, schema)
+                if new_schema != schema:
+                    # The types of a file are fixed, so what was spooled
+                    # is rewritten. Types only get wider, so this happens
+                    # at most a few times per column.
+                    writer.close()
+                    writer = None
+                    writer, new_schema = _respool(tmp_path, respool_path, new_schema)
+                    os.remove(tmp_path)
+                    tmp_path, respool_path = respool_path, tmp_path
+                    new_schema, cast_batch = _fit_arrow_batch(batch, new_schema)
+                    schema = new_schema
+                batch = cast_batch
+            writer.write_batch(batch)
+            row_count += batch.num_rows
+            if should_stop is not None and should_stop():
+                return None
+        if writer is None:
+            schema = _arrow_batch(columns, []).schema
+            writer = pa.ipc.new_file(tmp_path, schema)
+        writer.close()
+        writer = None
+        os.replace(tmp_path, path)
+        return columns, row_count
+    finally:
+        partitions.close()
+        if writer is not None:
+            writer.close()
+        for leftover in (tmp_path, respool_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def read_spooled_page(path, page, per_page):
+    # The file is uncompressed so that memory mapping it is zero copy and
+    # only the rows of the requested page are materialised.
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+        offset = (page - 1) * per_page
+        rows = table.slice(offset, per_page).to_pylist()
+    columns = table.column_names
+    data = [[row[column] for column in columns] for row in rows]
+    return prepare_table_data_from_page(columns, data, page, per_page,
+                                        table.num_rows)
+
+
+def delete_spooled_result(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def _csv_chunks(columns, partitions, compress=False, on_stopped=None):
+    """
+    Yields the CSV of the partitions. When the statement is stopped while
+    streaming, on_stopped is called with 'timeout' or 'cancelled' and the
+    error is raised again so that the download does not look complete.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    try:
+        writer.writerow(columns)  # Write the headers (column names)
+        for partition in itertools.chain([[]], partitions):
+            if isinstance(partition, pa.RecordBatch):
+                # Converting whole columns is much faster than row by row
+                partition = zip(*(column.to_pylist() for column in partition.columns))
+            writer.writerows(partition)
+            chunk = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        if compressor is not None:
+            yield compressor.flush()
+    except (StatementTimeoutException, StatementCancelledException) as e:
+        if on_stopped is not None:
+            on_stopped('timeout' if isinstance(e, StatementTimeoutException) else 'cancelled')
+        raise
+    finally:
+        partitions.close()
+
+
+def export_native_sql_result(datasource, native_sql, compress=False,
+                             request_id=None, user_id=None, on_stopped=None):
     utc_time = timezone.now().strftime('%Y-%m-%d_%H-%M-%S')
     file_name = f'terno_{datasource.display_name}_{utc_time}.csv'
-    with engine.connect() as con:
-        execute_result = con.execute(sqlalchemy.text(native_sql))
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename={file_name}'
-        writer = csv.writer(response)
-        writer.writerow(execute_result.keys())  # Write the headers (column names)
-        writer.writerows(execute_result)  # Write all rows of data
-        return response
+    partitions = stream_native_sql(datasource, native_sql, request_id, user_id)
+    # Run the query before streaming so errors are raised here.
+    columns = next(partitions)
+    if compress:
+        file_name += '.gz'
+        content_type = 'application/gzip'
+    else:
+        content_type = 'text/csv'
+    response = StreamingHttpResponse(
+        _csv_chunks(columns, partitions, compress=compress, on_stopped=on_stopped),
+        content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename={file_name}'
+    return response
+
+
+def get_total_pages(total_count, per_page):
+    return math.ceil(total_count / per_page)
 
 
 def prepare_table_data_from_execute(execute_result, page, per_page):
@@ -388,9 +2359,10 @@ def prepare_table_data_from_execute(execute_result, page, per_page):
     total_count = execute_result.rowcount
     if total_count <= 0:
         total_count = len(fetch_result)
-    total_pages = math.ceil(total_count // per_page)
+    total_pages = get_total_pages(total_count, per_page)
     table_data['total_pages'] = total_pages
     table_data['row_count'] = total_count
+    table_data['row_count_status'] = 'exact'
     table_data['page'] = page
 
     offset = (page - 1) * per_page
@@ -405,26 +2377,310 @@ def prepare_table_data_from_execute(execute_result, page, per_page):
     return table_data
 
 
-'''
-def extract_limit_from_query(query):
-    expression = sqlglot.parse_one(query)
-    limit_expression = expression.args.get('limit')
-    offset_expression = expression.args.get('offset')
+def prepare_table_data_from_page(columns, rows, page, per_page, total_count,
+                                 order_key=None):
+    """
+    Builds table_data from the rows of one page, see `paginate_native_sql`.
+
+    When total_count is not known yet the row count is approximated from
+    the rows seen so far and `row_count_status` is set to 'approximate'.
+    """
+    columns = list(columns)
+    data = []
+    for row in rows:
+        data.append(dict(zip(columns, row)))
+
+    row_count_status = 'exact'
+    if total_count is None:
+        total_count = (page - 1) * per_page + len(data)
+        if len(data) == per_page:
+            row_count_status = 'approximate'
+    total_pages = get_total_pages(total_count, per_page)
+    if row_count_status == 'approximate':
+        # There is at least one more page
+        total_pages = page + 1
+
+    table_data = {}
+    table_data['columns'] = columns
+    table_data['total_pages'] = total_pages
+    table_data['row_count'] = total_count
+    table_data['row_count_status'] = row_count_status
+    table_data['page'] = page
+    table_data['data'] = data
+
+    if order_key is not None:
+        next_cursor = None
+        if len(data) == per_page and data[-1][order_key[0]] is not None:
+            next_cursor = data[-1][order_key[0]]
+        table_data['next_cursor'] = next_cursor
+    return table_data
+
+
+TABLE_DATA_FORMATS = ('rows', 'columnar', 'arrow')
+COLUMNAR_JSON_CONTENT_TYPE = 'application/vnd.terno.columnar+json'
+ARROW_STREAM_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+# Responses smaller than this are not worth compressing
+GZIP_MIN_LENGTH = 200
+
+_json_encoder = DjangoJSONEncoder()
+# Converters for the values json can not serialise, picked once per column
+_JSON_CONVERTERS = {
+    decimal.Decimal: str,
+    datetime.date: datetime.date.isoformat,
+    datetime.datetime: _json_encoder.default,
+    datetime.time: _json_encoder.default,
+}
+
+
+def get_table_data_format(request, data):
+    """
+    Returns the format table_data is sent in. It is taken from the
+    `format` field of the request body, else from the Accept header.
+    """
+    table_data_format = data.get('format')
+    if table_data_format in TABLE_DATA_FORMATS:
+        return table_data_format
+    accept = request.headers.get('Accept', '')
+    if ARROW_STREAM_CONTENT_TYPE in accept:
+        return 'arrow'
+    if COLUMNAR_JSON_CONTENT_TYPE in accept:
+        return 'columnar'
+    return 'rows'
+
+
+def _json_column(values):
+    value_type = next((type(v) for v in values if v is not None), None)
+    convert = _JSON_CONVERTERS.get(value_type)
+    if convert is None:
+        return values
+    # Values of other types are left to the encoder
+    return [convert(v) if type(v) is value_type else v for v in values]
+
+
+def to_columnar_table_data(table_data):
+    """
+    Returns a copy of table_data whose `data` holds one array per column
+    instead of one dict per row, so column names are sent only once.
+    """
+    columns = table_data['columns']
+    rows = table_data['data']
+    columnar_data = dict(table_data)
+    columnar_data['format'] = 'columnar'
+    columnar_data['data'] = [
+        _json_column([row.get(column) for row in rows]) for column in columns]
+    return columnar_data
+
+
+def to_arrow_stream(table_data):
+    """
+    Serialises table_data as an Arrow IPC stream. Everything except the
+    rows is stored as json in the `terno` schema metadata.
+    """
+    columns = table_data['columns']
+    rows = [[row.get(column) for column in columns] for row in table_data['data']]
+    batch = _arrow_batch(columns, rows)
+    details = {k: v for k, v in table_data.items() if k not in ('columns', 'data')}
+    schema = batch.schema.with_metadata(
+        {'terno': json.dumps(details, cls=DjangoJSONEncoder)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+    return sink.getvalue().to_pybytes()
+
+
+def _gzip_response(request, response):
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if ('gzip' not in request.headers.get('Accept-Encoding', '')
+            or len(response.content) < GZIP_MIN_LENGTH):
+        return response
+    response.content = compress_string(response.content)
+    response['Content-Encoding'] = 'gzip'
+    response['Content-Length'] = str(len(response.content))
+    return response
+
+
+def table_data_response(request, table_data, table_data_format='rows'):
+    """
+    Returns the http response for table_data in the negotiated format,
+    see `get_table_data_format`. The body is gzipped when the client
+    accepts it.
+    """
+    if table_data_format == 'arrow':
+        response = HttpResponse(to_arrow_stream(table_data),
+                                content_type=ARROW_STREAM_CONTENT_TYPE)
+    elif table_data_format == 'columnar':
+        response = HttpResponse(
+            json.dumps({
+                'status': 'success',
+                'table_data': to_columnar_table_data(table_data)
+            }, cls=DjangoJSONEncoder),
+            content_type='application/json')
+    else:
+        response = JsonResponse({
+            'status': 'success',
+            'table_data': table_data
+        })
+    return _gzip_response(request, response)
+
+
+# SQLAlchemy dialect names which are spelled differently in sqlglot
+SQLGLOT_DIALECTS = {
+    'postgresql': 'postgres',
+    'mssql': 'tsql',
+}
+
+
+def get_sqlglot_dialect(dialect_name):
+    if not dialect_name:
+        return None
+    return SQLGLOT_DIALECTS.get(dialect_name, dialect_name)
 
-    limit, offset = None, None
-    if limit_expression:
-        limit = int(limit_expression.expression.this)
-    if offset_expression:
-        offset = int(offset_expression.expression.this)
 
-    return limit, offset
+def _get_int_arg(expression, name):
+    node = expression.args.get(name)
+    if node is None:
+        return None
+    value = node.expression
+    if not isinstance(value, sqlglot.exp.Literal) or value.is_string:
+        raise sqlglot.errors.SqlglotError(f"Unsupported {name} expression")
+    return int(value.this)
 
 
-def add_limit_offset_to_query(query, set_limit, set_offset):
-    expression = sqlglot.parse_one(query)
-    query = expression.limit(set_limit).offset(set_offset).sql()
-    return query
-'''
+def get_unique_keys(datasource):
+    """
+    Returns table name -> column name of the tables of the datasource
+    with a single column primary key.
+    """
+    version = get_metadata_version(datasource)
+    cache_key = f"datasource_{datasource.id}_v{version}_unique_keys"
+    unique_keys = cache.get(cache_key)
+    if unique_keys is None:
+        primary_keys = collections.defaultdict(list)
+        for table_name, column_name in models.TableColumn.objects.filter(
+                table__data_source=datasource, primary_key=True).values_list(
+                    'table__name', 'name'):
+            primary_keys[table_name].append(column_name)
+        unique_keys = {table_name: columns[0]
+                       for table_name, columns in primary_keys.items() if len(columns) == 1}
+        cache.set(cache_key, unique_keys, timeout=settings.MDB_CACHE_TIMEOUT)
+    return unique_keys
+
+
+def _get_source_column(select, name):
+    """
+    Follows the output column name of select through the subqueries of its
+    FROM down to a table. Returns (table_name, column_name), or None when
+    the column is computed or the rows are joined or grouped.
+    """
+    if not isinstance(select, sqlglot.exp.Select) or select.args.get('joins') \
+            or select.args.get('group') or select.args.get('from') is None:
+        return None
+    for projection in select.expressions:
+        if isinstance(projection, sqlglot.exp.Star):
+            column_name = name
+            break
+        if projection.alias_or_name == name:
+            column = projection.unalias()
+            if not isinstance(column, sqlglot.exp.Column):
+                return None
+            column_name = column.name
+            break
+    else:
+        return None
+    source = select.args['from'].this
+    if isinstance(source, sqlglot.exp.Table):
+        return source.name, column_name
+    if isinstance(source, sqlglot.exp.Subquery):
+        return _get_source_column(source.this, column_name)
+    return None
+
+
+def get_order_key(expression, unique_keys):
+    """
+    Returns (column_name, descending) when the query is ordered by a
+    single output column that is the primary key of the only table it
+    selects from, which can then be used for keyset pagination. Other keys
+    may repeat or be null, comparing to the cursor would skip those rows.
+    """
+    if not isinstance(expression, sqlglot.exp.Select):
+        return None
+    order = expression.args.get('order')
+    if order is None or len(order.expressions) != 1:
+        return None
+    ordered = order.expressions[0]
+    column = ordered.this
+    if not isinstance(column, sqlglot.exp.Column):
+        return None
+    if column.name not in expression.named_selects:
+        return None
+    source_column = _get_source_column(expression, column.name)
+    if source_column is None:
+        return None
+    table_name, column_name = source_column
+    if unique_keys.get(table_name) != column_name:
+        return None
+    return column.name, bool(ordered.args.get('desc'))
+
+
+def paginate_native_sql(native_sql, dialect, page, per_page, cursor=None,
+                        unique_keys=None):
+    """
+    Rewrites native_sql so that the warehouse returns only one page.
+
+    Returns a dict with `page_sql`, `count_sql` and `order_key`.
+    Pages are fetched with LIMIT/OFFSET in the datasource dialect. When
+    the query is ordered by the primary key of its table, see
+    `get_order_key` and `unique_keys`, and a `cursor` (the key of the last
+    row of the previous page) is given, keyset pagination is used instead
+    so the warehouse does not have to skip offset rows.
+    """
+    expression = sqlglot.parse_one(native_sql, read=dialect)
+    if not isinstance(expression, sqlglot.exp.Query):
+        raise sqlglot.errors.SqlglotError("Only queries can be paginated")
+
+    count_expression = expression.copy()
+    if count_expression.args.get('limit') is None \
+            and count_expression.args.get('offset') is None:
+        count_expression.set('order', None)
+    count_sql = sqlglot.exp.select(
+        sqlglot.exp.Count(this=sqlglot.exp.Star())
+    ).from_(count_expression.subquery('terno_count')).sql(dialect=dialect)
+
+    limit = _get_int_arg(expression, 'limit')
+    offset = _get_int_arg(expression, 'offset') or 0
+    order_key = None
+    if limit is None and offset == 0 and unique_keys:
+        order_key = get_order_key(expression, unique_keys)
+
+    page_offset = (page - 1) * per_page
+    if order_key is not None and cursor is not None:
+        key, desc = order_key
+        inner = expression.copy()
+        inner.set('order', None)
+        key_column = sqlglot.exp.column(key, quoted=True)
+        condition = sqlglot.exp.LT if desc else sqlglot.exp.GT
+        page_expression = sqlglot.exp.select('*') \
+            .from_(inner.subquery('terno_page')) \
+            .where(condition(this=key_column,
+                             expression=sqlglot.exp.convert(cursor))) \
+            .order_by(sqlglot.exp.Ordered(this=key_column.copy(), desc=desc)) \
+            .limit(per_page)
+    else:
+        page_limit = per_page
+        if limit is not None:
+            page_limit = max(0, min(per_page, limit - page_offset))
+        page_expression = expression.copy()
+        page_expression.set('limit', None)
+        page_expression.set('offset', None)
+        page_expression = page_expression.limit(page_limit)
+        if offset + page_offset:
+            page_expression = page_expression.offset(offset + page_offset)
+
+    return {
+        'page_sql': page_expression.sql(dialect=dialect),
+        'count_sql': count_sql,
+        'order_key': order_key,
+    }
 
 
 def substitute_variables(template_str, context_dict):
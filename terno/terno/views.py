@@ -2,7 +2,7 @@ from django.shortcuts import render
 from django.http import HttpResponseRedirect, JsonResponse, HttpResponseForbidden
 from django.urls import reverse
 import terno.models as models
-from terno.tasks import load_metadata
+from terno.tasks import load_metadata, run_query_job
 import terno.utils as utils
 import json
 from django.contrib.auth.decorators import login_required
@@ -16,6 +16,9 @@ from django.contrib.auth.models import User
 from urllib.parse import unquote
 from allauth.account.utils import perform_login
 from suggestions.utils import search_vector_DB
+from django.utils import timezone
+from mysite.celery import app as celery_app
+from asgiref.sync import sync_to_async
 
 
 logger = logging.getLogger(__name__)
@@ -73,8 +76,8 @@ def console(request):
             user=request.user, data_source=datasource,
             data_type='user_prompt', data=user_prompt)
 
-        mDB = utils.prepare_mdb(datasource, roles)
-        schema_generated = mDB.generate_schema()
+        schema = utils.get_schema(datasource, roles)
+        schema_generated = schema['schema']
 
         context_dict = {
             'db_schema': schema_generated,
@@ -114,6 +117,7 @@ def console(request):
         return JsonResponse({
             'status': llm_response['status'],
             'generated_prompt': str(messages),
+            'schema_tokens': schema['tokens'],
             'generated_sql': llm_response['generated_sql'],
         })
     return render(request, 'frontend/index.html')
@@ -151,6 +155,40 @@ def get_datasources(request):
     })
 
 
+def _get_sql_schema(datasource, roles, question):
+    """
+    Returns the schema sent to the LLM, narrowed down to the tables
+    relevant to the question when the vector search finds any.
+    """
+    # Default: full schema
+    try:
+        allowed_tables, _ = utils.get_admin_config_object(datasource, roles)
+
+        # Convert from QuerySet to plain list of strings
+        allowed_tables = list(allowed_tables.values_list("name", flat=True))
+
+        # print(f"\nallowed_tables: {allowed_tables}\n")
+
+        relevant_tables = search_vector_DB(
+            datasource.id, question, allowed_tables,
+            threshold=0.72, max_results=15
+        )
+
+        if relevant_tables:
+            print(f"\nfound {len(relevant_tables)} relevant_tables\n")
+            print(f"\nrelevant_tables: {relevant_tables}\n")
+
+            return utils.get_schema(datasource, roles, relevant_tables)['schema']
+
+        else:
+            raise ValueError("No relevant tables found in vector search.")
+
+    except Exception as e:
+        print(f"\nFalling back to full schema due to: {e}\n")
+
+    return utils.get_schema(datasource, roles)['schema']
+
+
 @login_required
 def get_sql(request):
     data = json.loads(request.body)
@@ -177,45 +215,7 @@ def get_sql(request):
         })
     roles = request.user.groups.all()
 
-    # Default: full schema
-    try:
-        allowed_tables, allowed_columns = utils.get_admin_config_object(datasource, roles)
-
-        # Convert from QuerySet to plain list of strings
-        allowed_tables = list(allowed_tables.values_list("name", flat=True))
-
-        # print(f"\nallowed_tables: {allowed_tables}\n")
-
-        relevant_tables = search_vector_DB(
-            datasource_id, question, allowed_tables,
-            threshold=0.72, max_results=15
-        )
-
-        if relevant_tables:
-            print(f"\nfound {len(relevant_tables)} relevant_tables\n")
-            print(f"\nrelevant_tables: {relevant_tables}\n")
-
-            mDb = utils.generate_mdb(datasource)
-            print(f"\ncreated mdb using generate_mdb\n")
-
-            mDb.keep_only_tables(relevant_tables)
-            print(f"\nfiltered tables using keep_only_tables\n")
-
-            allowed_table_qs = models.Table.objects.filter(name__in=allowed_tables, data_source=datasource)
-            print(f"\nconverted allowed_tables into Queryset\n")
-            print(f"{allowed_table_qs}")
-
-            utils.keep_only_columns(mDb, allowed_table_qs, allowed_columns)
-            print(f"\nfiltered columns using keep_only_columns\n")
-
-        else:
-            raise ValueError("No relevant tables found in vector search.")
-
-    except Exception as e:
-        print(f"\nFalling back to full schema due to: {e}\n")
-        mDb = utils.prepare_mdb(datasource, roles)
-
-    schema_generated = mDb.generate_schema()
+    schema_generated = _get_sql_schema(datasource, roles, question)
 
     # Log user prompt
     models.QueryHistory.objects.create(
@@ -250,6 +250,53 @@ def get_sql(request):
     })
 
 
+def _log_stopped_sql(user, datasource, error_type, native_sql):
+    data_type = 'timed_out_sql' if error_type == 'timeout' else 'cancelled_sql'
+    models.QueryHistory.objects.create(
+        user=user, data_source=datasource,
+        data_type=data_type, data=native_sql)
+
+
+def _has_cost_limits(organisation):
+    return (organisation.max_bytes_processed is not None
+            or organisation.max_estimated_rows is not None)
+
+
+def _guard_query_cost(user, data, organisation, datasource, native_sql):
+    """
+    Estimates the cost of native_sql when the organisation has cost limits.
+    Returns the estimate and, when the query may not run, the response.
+    """
+    if not _has_cost_limits(organisation):
+        return None, None
+    cost_estimate = utils.estimate_native_sql_cost(datasource, native_sql)
+    return cost_estimate, _cost_guard_response(
+        user, data, organisation, datasource, native_sql, cost_estimate)
+
+
+def _cost_guard_response(user, data, organisation, datasource, native_sql, cost_estimate):
+    cost_check = utils.check_query_cost(organisation, cost_estimate)
+    if cost_check is None:
+        return None
+    if cost_check['action'] == 'confirm' and data.get('confirmCost', False):
+        return None
+
+    if cost_check['action'] == 'reject':
+        models.QueryHistory.objects.create(
+            user=user, data_source=datasource,
+            data_type='rejected_sql', data=native_sql,
+            cost_estimate=cost_estimate)
+        error_type = 'cost_rejected'
+    else:
+        error_type = 'cost_confirmation_required'
+    return JsonResponse({
+        'status': 'error',
+        'error': cost_check['error'],
+        'error_type': error_type,
+        'cost_estimate': cost_estimate,
+    })
+
+
 @login_required
 def execute_sql(request):
     data = json.loads(request.body)
@@ -257,6 +304,10 @@ def execute_sql(request):
     datasource_id = data.get('datasourceId')
     page = data.get('page', 1)
     per_page = data.get('per_page', 25)
+    cursor = data.get('cursor')
+    count_rows = data.get('count_rows', True)
+    run_async = data.get('async', False)
+    request_id = data.get('requestId')
     org_id = request.org_id
 
     organisation = models.Organisation.objects.get(id=org_id)
@@ -282,10 +333,7 @@ def execute_sql(request):
         user=request.user, data_source=datasource,
         data_type='user_executed_sql', data=user_sql)
 
-    mDB = utils.prepare_mdb(datasource, roles)
-
-    native_sql_response = utils.generate_native_sql(
-        mDB, user_sql, datasource.dialect_name)
+    native_sql_response = utils.get_native_sql(datasource, roles, user_sql)
 
     if native_sql_response['status'] == 'error':
         return JsonResponse({
@@ -293,26 +341,49 @@ def execute_sql(request):
             'error': native_sql_response['error'],
         })
 
+    cost_estimate, cost_guard_response = _guard_query_cost(
+        request.user, data, organisation, datasource,
+        native_sql_response['native_sql'])
+    if cost_guard_response is not None:
+        return cost_guard_response
+
     models.QueryHistory.objects.create(
         user=request.user,
         data_source=datasource,
         data_type='actual_executed_sql',
-        data=native_sql_response['native_sql'])
+        data=native_sql_response['native_sql'],
+        cost_estimate=cost_estimate)
+
+    if run_async:
+        job = models.QueryJob.objects.create(
+            user=request.user, data_source=datasource,
+            native_sql=native_sql_response['native_sql'])
+        task = run_query_job.delay(str(job.job_id))
+        models.QueryJob.objects.filter(id=job.id).update(task_id=task.id or '')
+        return JsonResponse({
+            'status': 'success',
+            'job_id': str(job.job_id),
+        })
 
     execute_sql_response = utils.execute_native_sql(
         datasource, native_sql_response['native_sql'],
-        page=page, per_page=per_page)
+        page=page, per_page=per_page, cursor=cursor, count_rows=count_rows,
+        request_id=request_id, user_id=request.user.id)
 
     if execute_sql_response['status'] == 'error':
+        error_type = execute_sql_response.get('error_type')
+        if error_type in ('timeout', 'cancelled'):
+            _log_stopped_sql(request.user, datasource, error_type,
+                             native_sql_response['native_sql'])
         return JsonResponse({
             'status': execute_sql_response['status'],
             'error': execute_sql_response['error'],
+            'error_type': error_type,
         })
 
-    return JsonResponse({
-        'status': execute_sql_response['status'],
-        'table_data': execute_sql_response['table_data']
-    })
+    return utils.table_data_response(
+        request, execute_sql_response['table_data'],
+        utils.get_table_data_format(request, data))
 
 
 @login_required
@@ -320,6 +391,8 @@ def export_sql_result(request):
     data = json.loads(request.body)
     user_sql = data.get('sql')
     datasource_id = data.get('datasourceId')
+    compress = data.get('gzip', False)
+    request_id = data.get('requestId')
     org_id = request.org_id
 
     organisation = models.Organisation.objects.get(id=org_id)
@@ -344,10 +417,7 @@ def export_sql_result(request):
         user=request.user, data_source=datasource,
         data_type='user_executed_sql', data=user_sql)
 
-    mDB = utils.prepare_mdb(datasource, roles)
-
-    native_sql_response = utils.generate_native_sql(
-        mDB, user_sql, datasource.dialect_name)
+    native_sql_response = utils.get_native_sql(datasource, roles, user_sql)
 
     if native_sql_response['status'] == 'error':
         return JsonResponse({
@@ -355,18 +425,367 @@ def export_sql_result(request):
             'error': native_sql_response['error'],
         })
 
+    cost_estimate, cost_guard_response = _guard_query_cost(
+        request.user, data, organisation, datasource,
+        native_sql_response['native_sql'])
+    if cost_guard_response is not None:
+        return cost_guard_response
+
     models.QueryHistory.objects.create(
         user=request.user,
         data_source=datasource,
         data_type='actual_executed_sql',
-        data=native_sql_response['native_sql'])
+        data=native_sql_response['native_sql'],
+        cost_estimate=cost_estimate)
+
+    def on_stopped(error_type):
+        _log_stopped_sql(request.user, datasource, error_type,
+                         native_sql_response['native_sql'])
 
-    execute_sql_response = utils.export_native_sql_result(
-        datasource, native_sql_response['native_sql'])
+    try:
+        execute_sql_response = utils.export_native_sql_result(
+            datasource, native_sql_response['native_sql'], compress=compress,
+            request_id=request_id, user_id=request.user.id, on_stopped=on_stopped)
+    except (utils.StatementTimeoutException, utils.StatementCancelledException) as e:
+        error_type = 'timeout' if isinstance(e, utils.StatementTimeoutException) else 'cancelled'
+        _log_stopped_sql(request.user, datasource, error_type,
+                         native_sql_response['native_sql'])
+        return JsonResponse({
+            'status': 'error',
+            'error': str(e),
+            'error_type': error_type,
+        })
+    except utils.DatasourceBusyException as e:
+        return JsonResponse({
+            'status': 'error',
+            'error': str(e),
+            'error_type': 'busy',
+        })
 
     return execute_sql_response
 
 
+async def _aget_organisation_datasource(request, user, datasource_id):
+    """
+    Async version of the organisation and datasource lookup of the views.
+    Returns (organisation, datasource, error response).
+    """
+    organisation = await models.Organisation.objects.aget(id=request.org_id)
+    if not await models.OrganisationUser.objects.filter(
+            user=user, organisation=organisation).aexists():
+        return organisation, None, HttpResponseForbidden(
+            "You do not belong to this organisation.")
+    try:
+        datasource = await models.DataSource.objects.aget(
+            id=datasource_id,
+            enabled=True,
+            organisationdatasource__organisation=organisation)
+    except ObjectDoesNotExist:
+        return organisation, None, JsonResponse({
+            'status': 'error',
+            'error': 'No Datasource found.'
+        })
+    return organisation, datasource, None
+
+
+@staff_member_required
+async def aconsole(request):
+    """Async version of `console`."""
+    if request.method != 'POST':
+        return render(request, 'frontend/index.html')
+    data = json.loads(request.body)
+    system_prompt = data.get('systemPrompt')
+    assistant_message = data.get('assistantMessage')
+    user_prompt = data.get('userPrompt')
+    user = await request.auser()
+
+    organisation, datasource, error_response = await _aget_organisation_datasource(
+        request, user, data.get('datasourceId'))
+    if error_response is not None:
+        return error_response
+    roles = user.groups.all()
+
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
+        data_type='user_prompt', data=user_prompt)
+
+    schema = await sync_to_async(utils.get_schema)(datasource, roles)
+    schema_generated = schema['schema']
+
+    context_dict = {
+        'db_schema': schema_generated,
+        'dialect_name': datasource.dialect_name,
+        'dialect_version': datasource.dialect_version,
+    }
+    system_prompt = utils.substitute_variables(template_str=system_prompt,
+                                               context_dict=context_dict)
+    assistant_message = utils.substitute_variables(template_str=assistant_message,
+                                                   context_dict=context_dict)
+    user_prompt = utils.substitute_variables(template_str=user_prompt,
+                                             context_dict=context_dict)
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "assistant", "content": assistant_message},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
+        data_type='user_prompt', data=user_prompt)
+
+    llm_response = await utils.allm_response(
+        user, None, None, organisation, datasource, messages=messages)
+
+    if llm_response['status'] == 'error':
+        return JsonResponse({
+            'status': llm_response['status'],
+            'error': llm_response['error'],
+        })
+
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
+        data_type='generated_sql', data=llm_response['generated_sql'])
+
+    return JsonResponse({
+        'status': llm_response['status'],
+        'generated_prompt': str(messages),
+        'schema_tokens': schema['tokens'],
+        'generated_sql': llm_response['generated_sql'],
+    })
+
+
+@login_required
+async def aget_sql(request):
+    """Async version of `get_sql`."""
+    data = json.loads(request.body)
+    question = data.get('prompt')
+    user = await request.auser()
+
+    organisation, datasource, error_response = await _aget_organisation_datasource(
+        request, user, data.get('datasourceId'))
+    if error_response is not None:
+        return error_response
+    roles = user.groups.all()
+
+    schema_generated = await sync_to_async(_get_sql_schema)(datasource, roles, question)
+
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
+        data_type='user_prompt', data=question)
+
+    llm_response = await utils.allm_response(
+        user, question, schema_generated, organisation, datasource)
+
+    if llm_response['status'] == 'error':
+        return JsonResponse({
+            'status': llm_response['status'],
+            'error': llm_response['error'],
+        })
+
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
+        data_type='generated_sql', data=llm_response['generated_sql'])
+
+    return JsonResponse({
+        'status': llm_response['status'],
+        'generated_sql': llm_response['generated_sql'],
+    })
+
+
+@login_required
+async def aexecute_sql(request):
+    """
+    Async version of `execute_sql`. The warehouse round trip runs in the
+    bounded thread pool of `utils.run_blocking`.
+    """
+    data = json.loads(request.body)
+    user_sql = data.get('sql')
+    page = data.get('page', 1)
+    per_page = data.get('per_page', 25)
+    cursor = data.get('cursor')
+    count_rows = data.get('count_rows', True)
+    run_async = data.get('async', False)
+    request_id = data.get('requestId')
+    user = await request.auser()
+
+    organisation, datasource, error_response = await _aget_organisation_datasource(
+        request, user, data.get('datasourceId'))
+    if error_response is not None:
+        return error_response
+    roles = user.groups.all()
+
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
+        data_type='user_executed_sql', data=user_sql)
+
+    native_sql_response = await sync_to_async(utils.get_native_sql)(
+        datasource, roles, user_sql)
+
+    if native_sql_response['status'] == 'error':
+        return JsonResponse({
+            'status': native_sql_response['status'],
+            'error': native_sql_response['error'],
+        })
+    native_sql = native_sql_response['native_sql']
+
+    cost_estimate = None
+    if _has_cost_limits(organisation):
+        # EXPLAIN or a dry run on the warehouse
+        cost_estimate = await utils.run_blocking(
+            utils.estimate_native_sql_cost, datasource, native_sql)
+        cost_guard_response = await sync_to_async(_cost_guard_response)(
+            user, data, organisation, datasource, native_sql, cost_estimate)
+        if cost_guard_response is not None:
+            return cost_guard_response
+
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
+        data_type='actual_executed_sql', data=native_sql,
+        cost_estimate=cost_estimate)
+
+    if run_async:
+        job = await models.QueryJob.objects.acreate(
+            user=user, data_source=datasource, native_sql=native_sql)
+        task = await utils.run_blocking(run_query_job.delay, str(job.job_id))
+        await models.QueryJob.objects.filter(id=job.id).aupdate(task_id=task.id or '')
+        return JsonResponse({
+            'status': 'success',
+            'job_id': str(job.job_id),
+        })
+
+    unique_keys = await sync_to_async(utils.get_unique_keys)(datasource)
+    execute_sql_response = await utils.run_blocking(
+        utils.execute_native_sql, datasource, native_sql,
+        page=page, per_page=per_page, cursor=cursor, count_rows=count_rows,
+        request_id=request_id, user_id=user.id, unique_keys=unique_keys)
+
+    if execute_sql_response['status'] == 'error':
+        error_type = execute_sql_response.get('error_type')
+        if error_type in ('timeout', 'cancelled'):
+            await sync_to_async(_log_stopped_sql)(user, datasource, error_type, native_sql)
+        return JsonResponse({
+            'status': execute_sql_response['status'],
+            'error': execute_sql_response['error'],
+            'error_type': error_type,
+        })
+
+    return utils.table_data_response(
+        request, execute_sql_response['table_data'],
+        utils.get_table_data_format(request, data))
+
+
+def _query_job_details(job):
+    return {
+        'job_id': str(job.job_id),
+        'status': job.status,
+        'columns': job.columns,
+        'row_count': job.row_count,
+        'error': job.error,
+        'created_at': job.created_at,
+        'finished_at': job.finished_at,
+    }
+
+
+def _cancel_query_job(job):
+    cancelled = models.QueryJob.objects.filter(
+        id=job.id, status__in=['queued', 'running']).update(
+            status='cancelled', finished_at=timezone.now())
+    if not cancelled:
+        return False
+    if job.status == 'queued' and job.task_id:
+        celery_app.control.revoke(job.task_id)
+    else:
+        utils.cancel_statement(str(job.job_id))
+    return True
+
+
+@login_required
+def query_job_status(request, job_id):
+    job = models.QueryJob.objects.filter(job_id=job_id, user=request.user).first()
+    if job is None:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Query Job found.'
+        })
+    return JsonResponse({
+        'status': 'success',
+        'job': _query_job_details(job),
+    })
+
+
+@login_required
+def query_job_page(request, job_id):
+    data = json.loads(request.body)
+    page = data.get('page', 1)
+    per_page = data.get('per_page', 25)
+
+    job = models.QueryJob.objects.filter(job_id=job_id, user=request.user).first()
+    if job is None:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Query Job found.'
+        })
+    if job.status != 'success':
+        return JsonResponse({
+            'status': 'error',
+            'error': f'Query Job is {job.status}.',
+            'job': _query_job_details(job),
+        })
+    try:
+        table_data = utils.read_spooled_page(job.result_path, page, per_page)
+    except FileNotFoundError:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'Query Job result has expired.'
+        })
+    return utils.table_data_response(
+        request, table_data, utils.get_table_data_format(request, data))
+
+
+@login_required
+def query_job_cancel(request, job_id):
+    job = models.QueryJob.objects.filter(job_id=job_id, user=request.user).first()
+    if job is None:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Query Job found.'
+        })
+    _cancel_query_job(job)
+    job.refresh_from_db()
+    return JsonResponse({
+        'status': 'success',
+        'job': _query_job_details(job),
+    })
+
+
+@login_required
+def cancel_sql(request):
+    data = json.loads(request.body)
+    request_id = data.get('requestId')
+    job_id = data.get('jobId')
+
+    if job_id:
+        job = models.QueryJob.objects.filter(job_id=job_id, user=request.user).first()
+        if job is None:
+            return JsonResponse({
+                'status': 'error',
+                'error': 'No Query Job found.'
+            })
+        cancelled = _cancel_query_job(job)
+    elif request_id:
+        cancelled = utils.cancel_statement(request_id, user_id=request.user.id)
+    else:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'requestId or jobId is required.'
+        })
+    return JsonResponse({
+        'status': 'success',
+        'cancelled': cancelled,
+    })
+
+
 @login_required
 def get_tables(request, datasource_id):
     org_id = request.org_id
@@ -427,6 +846,17 @@ def get_user_details(request):
     })
 
 
+@staff_member_required
+def get_metrics(request):
+    return JsonResponse({
+        'engine_pools': utils.get_engine_pool_metrics(),
+        'admission': utils.get_admission_metrics(),
+        'mdb_cache': utils.get_mdb_cache_metrics(),
+        'native_sql_cache': utils.get_native_sql_cache_metrics(),
+        'single_flight': utils.get_single_flight_metrics(),
+    })
+
+
 def sso_login(request):
     token = request.GET.get('token')
     org_id = request.GET.get('org_id')